@@ -1,10 +1,16 @@
 import os
 import asyncio
 import logging
+import random
 import signal
 from dotenv import load_dotenv
 from aiohttp import web
-from db import init_db
+from db import (
+    init_db, close_db, claim_update_id, economy_cross_check, ECONOMY_CHECK_SEC,
+    history_archive_run, ARCHIVE_EVERY_SEC, compact_config_log, CONFIG_COMPACT_EVERY_SEC,
+    bus_catch_up, BUS_CATCH_UP_SEC, request_scope, balance_cache_check, BALANCE_CHECK_SEC,
+    verify_balance_chains, CHAIN_VERIFY_SEC, backup_run, BACKUP_EVERY_SEC,
+)
 import aiogram
 from aiogram import Bot, Dispatcher
 import socket
@@ -26,6 +32,19 @@ async def _on_text(message: types.Message):
     await handle_message(message)
     
 
+async def _dedupe_updates(handler, update: types.Update, data):
+    # апдейты, обработанные до рестарта (update_id ≤ HWM), не пускаем дальше
+    if not await claim_update_id(update.update_id):
+        return None
+    return await handler(update, data)
+
+
+async def _request_scope(handler, update: types.Update, data):
+    # точечные чтения внутри одного апдейта запоминаются и склеиваются
+    with request_scope():
+        return await handler(update, data)
+
+
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
@@ -46,6 +65,44 @@ stop_event = asyncio.Event()
 def _stop(*_):
     stop_event.set()
 
+# фоновые задачи обслуживания БД: (имя, период в секундах, корутина)
+MAINTENANCE_TICK_SEC = 30
+MAINTENANCE_START_SPREAD_SEC = 15 * 60  # первые запуски разносим случайно по этому окну
+MAINTENANCE_JOBS = [
+    ("economy_cross_check", ECONOMY_CHECK_SEC, economy_cross_check),
+    ("history_archive", ARCHIVE_EVERY_SEC, history_archive_run),
+    ("config_log_compaction", CONFIG_COMPACT_EVERY_SEC, compact_config_log),
+    ("projections_catch_up", BUS_CATCH_UP_SEC, bus_catch_up),
+    ("balance_cache_check", BALANCE_CHECK_SEC, balance_cache_check),
+    ("balance_chain_verify", CHAIN_VERIFY_SEC, verify_balance_chains),
+    ("backup", BACKUP_EVERY_SEC, backup_run),
+]
+
+async def run_maintenance():
+    loop = asyncio.get_running_loop()
+    # после рестарта задачи не стартуют все разом: у каждой свой случайный сдвиг
+    # (не дальше её периода), дальше — по периоду от первого запуска
+    started = loop.time()
+    last_run = {
+        name: started - period + random.uniform(MAINTENANCE_TICK_SEC, min(period, MAINTENANCE_START_SPREAD_SEC))
+        for name, period, _ in MAINTENANCE_JOBS
+    }
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=MAINTENANCE_TICK_SEC)
+        except asyncio.TimeoutError:
+            pass
+        if stop_event.is_set():
+            break
+        for name, period, job in MAINTENANCE_JOBS:
+            if loop.time() - last_run[name] < period:
+                continue
+            last_run[name] = loop.time()
+            try:
+                await job()
+            except Exception:
+                logging.exception("maintenance job %s failed", name)
+
 async def main():
     logging.info(f"aiogram version: {aiogram.__version__}")
     # 1) токен и сессия
@@ -60,6 +117,8 @@ async def main():
 
     # 2) критично: БД + роутер
     await init_db()
+    dp.update.outer_middleware(_dedupe_updates)
+    dp.update.outer_middleware(_request_scope)
     dp.include_router(router)
 
     # 3) сигналы и параллельный запуск
@@ -70,6 +129,7 @@ async def main():
     try:
         await asyncio.gather(
             run_health(),
+            run_maintenance(),
             dp.start_polling(
                 bot,
                 stop_event=stop_event,
@@ -81,6 +141,8 @@ async def main():
     except Exception:
         logging.exception("BOT CRASH")
         raise
+    finally:
+        await close_db()
 
 
 if __name__ == "__main__":
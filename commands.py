@@ -1,11 +1,13 @@
 import re
 import os
-import sys
 import asyncio
 import random
 import logging
 from random import randint
 import html
+import gzip
+import tempfile
+import csv
 from typing import List, Tuple
 from datetime import datetime, timezone
 import aiosqlite
@@ -22,22 +24,29 @@ from db import (
     get_key_holders, get_known_users, hero_get_current, hero_set_for_today, hero_has_claimed_today, hero_record_claim,
     get_stipend_base, get_stipend_bonus, set_stipend_base, set_stipend_bonus, get_generosity_mult_pct, add_generosity_points,
     generosity_try_payout, get_market_turnover_days, codeword_get_active, codeword_mark_win, codeword_set, codeword_cancel_active, 
-    set_generosity_mult_pct, set_generosity_threshold, set_price_pin, set_price_pin_loud, insert_history, get_circulating, get_price_pin, 
+    set_generosity_mult_pct, set_generosity_threshold, set_price_pin, set_price_pin_loud, insert_history, record_offer_sold, get_circulating, get_price_pin, 
     get_price_pin_loud, get_generosity_points, get_generosity_threshold, hero_get_current_with_until, get_perk_shield_chance,
     set_perk_shield_chance, get_perk_croupier_chance, set_perk_croupier_chance, get_perk_philanthrope_chance, set_perk_philanthrope_chance,
-    get_perk_lucky_chance, set_perk_lucky_chance, cell_get_balance, cell_deposit, cell_withdraw, bank_touch_all_and_total, bank_zero_all_and_sum,
-    get_seconds_since_last_bank_rob, record_bank_rob, get_bank_rob_cooldown_days, set_bank_rob_cooldown_days, get_cell_dep_fee_pct, set_cell_dep_fee_pct,
+    get_perk_lucky_chance, set_perk_lucky_chance, cell_get_balance, cell_deposit_from_pocket, cell_withdraw_to_pocket, bank_touch_all_and_total, bank_rob,
+    get_bank_rob_cooldown_days, set_bank_rob_cooldown_days, get_cell_dep_fee_pct, set_cell_dep_fee_pct,
     get_cell_stor_fee_pct, set_cell_stor_fee_pct, get_perk_credits, perk_credit_add, perk_credit_use, create_perk_offer, get_perk_escrow_owner,
     perk_escrow_open, perk_escrow_close, get_pin_q_mult, get_bravo_window_sec, get_bravo_max_viewers, hero_save_claim_msg, hero_get_last_claim_msg,
     bravo_count_for_msg, bravo_already_claimed, record_bravo, get_vault_free_amount, get_perk_caps, set_perk_cap, get_perk_primary_left, add_perk_minted,
-    recalc_perk_minted, is_armageddon_on, set_armageddon, get_blacklist, add_to_blacklist, remove_from_blacklist, bank_zero_user, list_all_vouchers_counts,
+    recalc_perk_minted, is_armageddon_on, set_armageddon, get_blacklist, strip_user, remove_from_blacklist, list_all_vouchers_counts,
     get_vouchers_total_for_code, get_cleaned_users, set_cleaned_users, get_armageddon_price, set_armageddon_price,
+    get_pool_stats, get_query_plan_report,
 
     # анти-дубль
-    is_msg_processed, mark_msg_processed,
+    claim_msg, get_dedupe_stats, get_economy_check_report,
+    iter_history, get_archive_stats, HISTORY_COLS, compact_config_log, get_compaction_stats,
+    get_bus_stats, reconcile_projections, get_loader_stats, get_balance_cache_stats,
+    get_balance_at, get_statement, get_chain_stats, club_reset, get_epoch_stats,
+    backup_run, restore_backup, list_backups, get_backup_stats,
+    get_balances, get_perks_bulk, get_roles_bulk, get_perk_credits_bulk, cell_get_balances,
+    transfer, debit_if_sufficient, apply_movements,
 
     # перки
-    grant_perk, revoke_perk, get_perks, get_perk_holders, get_perks_summary,
+    grant_perk, revoke_perk, get_perks, user_has_perk, get_perk_holders, get_perks_summary,
 
     # ЗП/кража
     get_seconds_since_last_salary_claim, record_salary_claim,
@@ -53,18 +62,17 @@ from db import (
     get_price_perk, set_price_perk,
 
     # рынок
-    create_offer, cancel_offer, list_active_offers, record_burn,
+    create_offer, cancel_offer, list_active_offers,
 )
 
 from aiolimiter import AsyncLimiter
+from lanes import lane, get_lane_stats
 
 tg_limiter = AsyncLimiter(28, 1)  # ~28 запросов/сек
 KURATOR_ID = 164059195
 CLUB_CHAT_ID = -1002431055065
 ALLOWED_CONCERT_CHATS = {CLUB_CHAT_ID}
 
-DB_PATH = "/data/bot_data.sqlite"
-
 
 
 # ==== один раз, рядом с импортами ====
@@ -85,16 +93,18 @@ async def _gatekeep_message(message: types.Message) -> bool:
         txt = (message.text or "")
         is_command = bool(txt.startswith("/") or txt.startswith("."))
         if not is_command and author_id != KURATOR_ID:
-            bal = await get_balance(author_id) or 0
+            async with lane(author_id):
+                bal = await get_balance(author_id) or 0
+                if bal > 0:
+                    price = await get_armageddon_price()
+                    if price > 0:
+                        await change_balance(author_id, -price, "армагеддон", author_id)
             if bal <= 0:
                 try:
                     await message.delete()
                 except Exception:
                     pass
                 return False
-            price = await get_armageddon_price()
-            if price > 0:
-                await change_balance(author_id, -price, "армагеддон", author_id)
     return True
 
 
@@ -191,9 +201,8 @@ async def handle_message(message: types.Message):
         return
 
     # анти-дубль на «команды» (idempotency по конкретному message_id)
-    if await is_msg_processed(message.chat.id, message.message_id):
+    if not await claim_msg(message.chat.id, message.message_id):
         return
-    await mark_msg_processed(message.chat.id, message.message_id)
 
     # ЧС/армагеддон/и т.п. — общий предохранитель
     if not await _gatekeep_message(message):
@@ -245,6 +254,14 @@ async def handle_message(message: types.Message):
         await message.reply(f"У Вас в кармане {fmt_money(bal)}.")
         return
 
+    if text_l.startswith("баланс на дату"):
+        await handle_balance_at(message)
+        return
+
+    if text_l == "выписка" or text_l.startswith("выписка до "):
+        await handle_statement(message)
+        return
+
     if text_l == "моя роль":
         await handle_my_role(message)
         return
@@ -577,20 +594,8 @@ async def handle_message(message: types.Message):
 
         if text_l == "черная метка" and message.reply_to_message:
             uid = message.reply_to_message.from_user.id
-            # карман в ноль
-            bal = await get_balance(uid) or 0
-            if bal > 0:
-                await change_balance(uid, -bal, "чс", author_id)
-            # снять все перки (и minted--)
-            for code in await get_perks(uid):
-                await revoke_perk(uid, code)
-                await add_perk_minted(code, -1)
-            # снять роль
-            await set_role(uid, None, None)
-            # обнулить ячейку банка пользователя
-            await bank_zero_user(uid)
-            # занести в ЧС (persist)
-            await add_to_blacklist(uid)
+            # карман, перки (и minted--), роль, ячейка и занесение в ЧС — одной транзакцией
+            await strip_user(uid, "чс", blacklist=True)
             await message.reply("Чёрная метка поставлена. Игрок исключён из Клуба.")
             return
 
@@ -624,10 +629,12 @@ async def handle_message(message: types.Message):
             cleaned_users = set(await get_cleaned_users() or [])
             names = []
 
+            gone = []  # (uid, участник или None)
             for uid in await get_known_users():
                 # пропускаем уже почищенных
                 if uid in cleaned_users:
                     continue
+                mbr = None
                 try:
                     mbr = await message.bot.get_chat_member(message.chat.id, uid)
                     if mbr.status not in ("left", "kicked"):
@@ -635,32 +642,22 @@ async def handle_message(message: types.Message):
                 except Exception:
                     # нет инфы — считаем как выбыл
                     pass
-
-                any_change = False
-
-                # баланс кармана
-                bal = await get_balance(uid) or 0
-                if bal > 0:
-                    ok = await change_balance(uid, -bal, "clean", author_id)
-                    any_change = any_change or ok
-
-                # перки
-                user_perks = await get_perks(uid)
-                for code in list(user_perks):
-                    await revoke_perk(uid, code)
-                    await add_perk_minted(code, -1)
-                    any_change = True
-
-                # роль
-                await set_role(uid, None, None)
-
-                # банк (обнуление ячейки конкретного пользователя)
-                try:
-                    taken = await bank_zero_user(uid)
-                    if taken > 0:
-                        any_change = True
-                except Exception:
-                    pass
+                gone.append((uid, mbr))
+
+            # состояние выбывших — по одному запросу на таблицу
+            gone_ids = [uid for uid, _ in gone]
+            balances = await get_balances(gone_ids)
+            perks_by_uid = await get_perks_bulk(gone_ids)
+            roles = await get_roles_bulk(gone_ids)
+            cells = await cell_get_balances(gone_ids)
+
+            for uid, mbr in gone:
+                has_role = bool(roles[uid] and (roles[uid][0] or roles[uid][1]))
+                if not (balances[uid] > 0 or perks_by_uid[uid] or has_role or cells[uid] > 0):
+                    continue
+                # снимаем по состоянию на момент записи: карман, перки, роль, ячейка — одной транзакцией
+                taken = await strip_user(uid, "clean")
+                any_change = bool(taken["balance"] > 0 or taken["perks"] or taken["cell"] > 0)
 
                 if any_change:
                     cleaned += 1
@@ -688,6 +685,31 @@ async def handle_message(message: types.Message):
             await safe_reply(message, "📊 Учёт перков пересчитан.")
             return
 
+        if text_l == "метрики":
+            await handle_metrics(message)
+            return
+
+        if text_l.startswith("выгрузка истории"):
+            await handle_history_export(message)
+            return
+
+        if text_l in ("сверка", "сверка исправить"):
+            await handle_reconcile(message, fix=text_l.endswith("исправить"))
+            return
+
+        if text_l in ("бэкап", "бэкапы") or text_l.startswith("восстановить копию"):
+            await handle_backup(message)
+            return
+
+        if text_l == "сжать журнал конфигов":
+            rep = await compact_config_log()
+            await message.reply(
+                f"🧹 Журнал конфигов сжат: удалено строк {fmt_int(rep['rows'])} "
+                f"(~{fmt_int(rep['bytes'] // 1024)} КБ) по {fmt_int(rep['keys'])} ключам, "
+                f"хвост — {rep['tail']} значений на ключ."
+            )
+            return
+
         if text_l.startswith("назначить ") and message.reply_to_message:
             await handle_naznachit(message)
             return
@@ -1137,10 +1159,9 @@ async def handle_clear_db(message: types.Message):
         return
     try:
         await message.reply("🗑Клуб обнуляется...")
-        if os.path.exists(DB_PATH):
-            os.remove(DB_PATH)
+        # одна транзакция без перезапуска: журнал остаётся, состояние — с нуля
+        await club_reset(message.from_user.id)
         await message.answer("💢Код Армагедон. Клуб обнулен. Теперь только я и вы, Куратор.")
-        os.execv(sys.executable, [sys.executable] + sys.argv)
     except Exception as e:
         await message.reply(f"Ошибка при обнулении: {e}")
 
@@ -1238,16 +1259,20 @@ async def handle_peredat(message: types.Message):
     if giver_id == recipient_id:
         await message.reply("Нельзя передать нуары самому себе.")
         return
-    balance = await get_balance(giver_id)
-    if amount > balance:
-        await message.reply(f"У Вас недостаточно нуаров. Баланс: {fmt_money(balance)}")
-        return
-    await change_balance(giver_id, -amount, "передача", giver_id)
-    await change_balance(recipient_id, amount, "передача", giver_id)
-    pct = await get_generosity_mult_pct()
-    pts = (amount * pct) // 100
-    await add_generosity_points(giver_id, pts, "transfer")
-    payout = await generosity_try_payout(giver_id)
+    async with lane(giver_id, recipient_id):
+        if not await transfer(giver_id, recipient_id, amount, "передача"):
+            balance = await get_balance(giver_id)
+            if amount > balance:
+                await message.reply(f"У Вас недостаточно нуаров. Баланс: {fmt_money(balance)}")
+            else:
+                # получатель в ЧС: перевод отклоняется целиком (раньше списание
+                # проходило, а зачисление блокировалось — нуары пропадали)
+                await message.reply("Получатель не может принимать нуары.")
+            return
+        pct = await get_generosity_mult_pct()
+        pts = (amount * pct) // 100
+        await add_generosity_points(giver_id, pts, "transfer")
+        payout = await generosity_try_payout(giver_id)
     if payout > 0:
         await message.reply(f"🎁 Бонус щедрости: +{fmt_money(payout)}")
     await message.reply(
@@ -1305,9 +1330,9 @@ async def handle_dozhd(message: types.Message):
     p_lucky = await get_perk_lucky_chance()
     weights = []
     lucky_ids = set()  # соберём всех, у кого есть перк «везунчик»
+    perks_by_uid = await get_perks_bulk(uid for uid, _ in eligible)
     for uid, name in eligible:
-        perks_u = await get_perks(uid)
-        is_lucky = ("везунчик" in perks_u)
+        is_lucky = "везунчик" in perks_by_uid[uid]
         if is_lucky:
             lucky_ids.add(uid)
         w = 100 + (p_lucky if is_lucky else 0)
@@ -1340,11 +1365,27 @@ async def handle_dozhd(message: types.Message):
     rest = total % n
     per_user = [base + (1 if i < rest else 0) for i in range(n)]
 
-    # списываем у дарителя и начисляем пятёрке
-    await change_balance(giver_id, -total, "дождь", giver_id)
-    for (uid, _name), amt in zip(recipients, per_user):
-        if amt > 0:
-            await change_balance(uid, amt, "дождь", giver_id)
+    # «Филантроп»: шестой равновероятно из оставшихся — выбираем заранее,
+    # чтобы взять и его полосу
+    sixth = random.choice(rest_pool) if rest_pool else None
+    base_share = per_user[0] if per_user else 0
+
+    # списываем у дарителя и начисляем пятёрке — одной пачкой в полосе дарителя;
+    # там же проверка перка дарителя и выплата шестому
+    movements = [(giver_id, -total, "дождь")]
+    movements += [(uid, amt, "дождь") for (uid, _name), amt in zip(recipients, per_user) if amt > 0]
+    extra_lines = []
+    async with lane(giver_id, sixth[0] if sixth else None):
+        if not await apply_movements(movements):
+            bal = await get_balance(giver_id)
+            await message.reply(f"У Вас недостаточно нуаров. Баланс: {fmt_money(bal)}")
+            return
+
+        if sixth and base_share > 0 and await user_has_perk(giver_id, "филантроп") \
+                and chance(await get_perk_philanthrope_chance()):
+            sixth_uid, sixth_name = sixth
+            await change_balance(sixth_uid, base_share, "дождь_филантроп", giver_id)
+            extra_lines.append(f"{mention_html(sixth_uid, sixth_name)} — получил дополнительно {fmt_money(base_share)} от филантропа")
 
     # Отметим «везунчиков» среди получателей и добавим резюме
     lucky_among_recipients = sum(1 for uid, _name in recipients if uid in lucky_ids)
@@ -1353,17 +1394,6 @@ async def handle_dozhd(message: types.Message):
         tag = " 🍀" if uid in lucky_ids else ""
         return f"{mention_html(uid, name)}{tag}"
 
-    # --- «Филантроп»: шестой равновероятно из оставшихся ---
-    giver_perks = await get_perks(giver_id)
-    extra_lines = []
-    base_share = per_user[0] if per_user else 0
-
-    if "филантроп" in giver_perks and base_share > 0 and chance(await get_perk_philanthrope_chance()):
-        if rest_pool:
-            sixth_uid, sixth_name = random.choice(rest_pool)  # равномерно среди оставшихся
-            await change_balance(sixth_uid, base_share, "дождь_филантроп", giver_id)
-            extra_lines.append(f"{mention_html(sixth_uid, sixth_name)} — получил дополнительно {fmt_money(base_share)} от филантропа")
-
 
     breakdown = [
         f"{name_with_tags(uid, name)} — намок на {fmt_money(amt)}"
@@ -1401,10 +1431,6 @@ async def _precheck_and_reserve_bet(message: types.Message, amount: int, game_ta
         return False
 
     gambler_id = message.from_user.id
-    balance = await get_balance(gambler_id)
-    if amount > balance:
-        await message.reply(f"🔍У Вас недостаточно нуаров. Баланс: {fmt_money(balance)}")
-        return False
 
     # проверка сейфа на потенциальную выплату
     room = await _get_vault_room()
@@ -1417,8 +1443,12 @@ async def _precheck_and_reserve_bet(message: types.Message, amount: int, game_ta
         await message.reply("Казино закрыто на переучёт — в сейфе недостаточно средств для такой выплаты.")
         return False
 
-    # МОМЕНТАЛЬНО списываем ставку (резерв)
-    await change_balance(gambler_id, -amount, f"ставка (резерв) {game_tag}", gambler_id)
+    async with lane(gambler_id):
+        # МОМЕНТАЛЬНО списываем ставку (резерв) — только если хватает средств
+        if await debit_if_sufficient(gambler_id, amount, f"ставка (резерв) {game_tag}") is None:
+            balance = await get_balance(gambler_id)
+            await message.reply(f"🔍У Вас недостаточно нуаров. Баланс: {fmt_money(balance)}")
+            return False
     return True
 
 
@@ -1470,9 +1500,8 @@ async def handle_kubik(message: types.Message):
                 parse_mode="HTML"
             )
             # NEW: «Крупье» — 15% шанс вернуть 50% ставки при проигрыше
-            user_perks = await get_perks(user_id)
             p = await get_perk_croupier_chance()
-            if "крупье" in user_perks and chance(p):
+            if await user_has_perk(user_id, "крупье") and chance(p):
                 refund = amount // 2
                 if refund > 0:
                     await change_balance(user_id, refund, "крупье_рефанд(кубик)", user_id)
@@ -1522,9 +1551,8 @@ async def handle_darts(message: types.Message):
                 parse_mode="HTML"
             )
             # NEW: «Крупье» — 15% шанс вернуть 50% ставки при проигрыше
-            user_perks = await get_perks(user_id)
             p_croup = await get_perk_croupier_chance()
-            if "крупье" in user_perks and chance(p_croup):
+            if await user_has_perk(user_id, "крупье") and chance(p_croup):
                 refund = amount // 2
                 if refund > 0:
                     await change_balance(user_id, refund, "крупье_рефанд(дартс)", user_id)
@@ -1574,9 +1602,8 @@ async def handle_bowling(message: types.Message):
                 parse_mode="HTML"
             )
             # NEW: «Крупье» — 15% шанс вернуть 50% ставки при проигрыше
-            user_perks = await get_perks(user_id)
             p_croup = await get_perk_croupier_chance()
-            if "крупье" in user_perks and chance(p_croup):
+            if await user_has_perk(user_id, "крупье") and chance(p_croup):
                 refund = amount // 2
                 if refund > 0:
                     await change_balance(user_id, refund, "крупье_рефанд(боулинг)", user_id)
@@ -1627,9 +1654,8 @@ async def handle_slots(message: types.Message):
                 parse_mode="HTML"
             )
             # NEW: «Крупье» — 15% шанс вернуть 50% ставки при проигрыше
-            user_perks = await get_perks(user_id)
             p_croup = await get_perk_croupier_chance()
-            if "крупье" in user_perks and chance(p_croup):
+            if await user_has_perk(user_id, "крупье") and chance(p_croup):
                 refund = amount // 2
                 if refund > 0:
                     await change_balance(user_id, refund, "крупье_рефанд(автоматы)", user_id)
@@ -1642,6 +1668,7 @@ async def handle_slots(message: types.Message):
 async def handle_my_perks(message: types.Message):
     user_id = message.from_user.id
     perk_codes = await get_perks(user_id)
+    credits = (await get_perk_credits_bulk([user_id]))[user_id]
 
     # соберём ваучеры по всем известным кодам
     vouchers_active_lines = []
@@ -1656,7 +1683,7 @@ async def handle_my_perks(message: types.Message):
         for code in perk_codes:
             emoji, title = PERK_REGISTRY.get(code, ("", code))
             # кредиты
-            creds = await get_perk_credits(user_id, code)
+            creds = credits.get(code, 0)
             suffix = f" (ваучеры: {creds})" if creds > 0 else ""
             items.append((title.lower(), f"{emoji} {title}{suffix}"))
         for _, line in sorted(items):
@@ -1666,7 +1693,7 @@ async def handle_my_perks(message: types.Message):
     for code in PERK_REGISTRY.keys():
         if code in perk_codes:
             continue
-        creds = await get_perk_credits(user_id, code)
+        creds = credits.get(code, 0)
         if creds > 0:
             emoji, title = PERK_REGISTRY.get(code, ("", code))
             vouchers_inactive_lines.append(f"{emoji} {title} — {creds}")
@@ -1881,9 +1908,7 @@ async def handle_stipend_claim(message: types.Message):
 
 async def handle_theft(message: types.Message):
     thief_id = message.from_user.id
-    perks = await get_perks(thief_id)
-    p = await get_perk_shield_chance()
-    if "кража" not in perks:
+    if not await user_has_perk(thief_id, "кража"):
         await message.reply("У Вас нет такой привилегии.")
         return
     if not message.reply_to_message:
@@ -1894,34 +1919,38 @@ async def handle_theft(message: types.Message):
         await message.reply("Красть у бота бессмысленно.")
         return
 
-    # NEW: «Щит» у жертвы — 50% срыв кражи
-    victim_perks = await get_perks(victim.id)
-    p = await get_perk_shield_chance()  # 0..100
+    # проверка перков, кулдауна, перевод и отметка кражи — в полосах вора и жертвы,
+    # иначе два параллельных «украсть» проскочат один кулдаун, а снятый щит
+    # или проданная «кража» сработают уже после проверки
+    async with lane(thief_id, victim.id):
+        if not await user_has_perk(thief_id, "кража"):
+            await message.reply("У Вас нет такой привилегии.")
+            return
 
-    has_shield = any(str(x).lower() == "щит" for x in victim_perks)
-    if has_shield and randint(1, 100) <= p:
-        await record_theft(thief_id, 0, victim.id, success=False)
-        await message.reply("🛡️ Щит жертвы вспыхнул — вы охуели от таких спецэфектов. Отсидитесь 12 часов.")
-        return
+        # NEW: «Щит» у жертвы — 50% срыв кражи
+        p = await get_perk_shield_chance()  # 0..100
 
-    seconds = await get_seconds_since_last_theft(thief_id)
-    COOLDOWN = 12 * 60 * 60
-    if seconds is not None and seconds < COOLDOWN:
-        remain = COOLDOWN - seconds
-        hours = remain // 3600
-        minutes = (remain % 3600) // 60
-        await message.reply(f"Рано еще вылазить. Повторная ходка через {hours}ч {minutes}м.")
-        return
-    income = await get_income()
-    victim_balance = await get_balance(victim.id)
-    if victim_balance < income or income <= 0:
-        await record_theft(thief_id, 0, victim.id, success=False)
-        await message.reply(f"🐕 Сторожевые собаки подняли лай — пришлось бежать. Схоронитесь на 12 часов.")
-        return
+        has_shield = await user_has_perk(victim.id, "щит")
+        if has_shield and randint(1, 100) <= p:
+            await record_theft(thief_id, 0, victim.id, success=False)
+            await message.reply("🛡️ Щит жертвы вспыхнул — вы охуели от таких спецэфектов. Отсидитесь 12 часов.")
+            return
 
-    await change_balance(victim.id, -income, "кража", thief_id)
-    await change_balance(thief_id, income, "кража", thief_id)
-    await record_theft(thief_id, income, victim.id, success=True)
+        seconds = await get_seconds_since_last_theft(thief_id)
+        COOLDOWN = 12 * 60 * 60
+        if seconds is not None and seconds < COOLDOWN:
+            remain = COOLDOWN - seconds
+            hours = remain // 3600
+            minutes = (remain % 3600) // 60
+            await message.reply(f"Рано еще вылазить. Повторная ходка через {hours}ч {minutes}м.")
+            return
+        income = await get_income()
+        if income <= 0 or not await transfer(victim.id, thief_id, income, "кража"):
+            await record_theft(thief_id, 0, victim.id, success=False)
+            await message.reply(f"🐕 Сторожевые собаки подняли лай — пришлось бежать. Схоронитесь на 12 часов.")
+            return
+
+        await record_theft(thief_id, income, victim.id, success=True)
     await message.reply(
         f"🗡️ {mention_html(thief_id, message.from_user.full_name)} украл {fmt_money(income)} у "
         f"{mention_html(victim.id, victim.full_name)}.",
@@ -2091,8 +2120,7 @@ async def handle_offer_cancel(message: types.Message, offer_id: int):
         # сперва закрываем эскроу
         await perk_escrow_close(offer["seller_id"], code, offer_id, "cancel")
 
-        seller_perks = await get_perks(offer["seller_id"])
-        if code in seller_perks:
+        if await user_has_perk(offer["seller_id"], code):
             await perk_credit_add(offer["seller_id"], code)
         else:
             await grant_perk(offer["seller_id"], code)
@@ -2113,8 +2141,7 @@ async def handle_perk_sell(message: types.Message, code: str, price: int):
     code = code.strip().lower()
 
     # текущее состояние пользователя
-    perks = await get_perks(user_id)
-    has_perk = (code in perks)
+    has_perk = await user_has_perk(user_id, code)
     credits = await get_perk_credits(user_id, code)
 
     # --- Приоритет ИСТОЧНИКА: сначала ваучер, потом актив ---
@@ -2143,8 +2170,7 @@ async def handle_perk_sell(message: types.Message, code: str, price: int):
         # Если ваучеров нет, актив реально уходит в эскроу.
 
         # страховка: убедимся, что перк снят
-        after = await get_perks(user_id)
-        if code in after:
+        if await user_has_perk(user_id, code):
             await message.reply("Не удалось передать перк в эскроу. Попробуйте ещё раз или сообщите куратору.")
             return
 
@@ -2168,56 +2194,63 @@ async def _apply_burn_and_return(price: int) -> int:
     return (price * bps) // 10000
 
 async def handle_offer_buy(message: types.Message, offer_id: int):
+    async def _find_offer():
+        for o in await list_active_offers():
+            if o["offer_id"] == offer_id:
+                return o
+        return None
+
     # найти лот
     perk_note = ""
-    offers = await list_active_offers()
-    offer = None
-    for o in offers:
-        if o["offer_id"] == offer_id:
-            offer = o
-            break
+    offer = await _find_offer()
     if not offer:
         await message.reply("Такого активного лота нет.")
         return
 
     buyer_id = message.from_user.id
-    price = offer["price"]
-    bal = await get_balance(buyer_id)
-    if price > bal:
-        await message.reply(f"Недостаточно нуаров. Требуется {fmt_money(price)}, на руках {fmt_money(bal)}.")
-        return
 
-    burn = await _apply_burn_and_return(price)
-    to_seller = price - burn
-
-    # списываем у покупателя
-    await change_balance(buyer_id, -price, f"покупка лота #{offer_id}", buyer_id)
-    # начисляем продавцу
-    if to_seller > 0:
-        await change_balance(offer["seller_id"], to_seller, f"продажа лота #{offer_id}", buyer_id)
-    # сжигаем
-    if burn > 0:
-        await record_burn(burn, f"offer_id={offer_id}")
+    # в полосах покупателя и продавца: два покупателя одного лота идут по очереди
+    async with lane(buyer_id, offer["seller_id"]):
+        offer = await _find_offer()
+        if not offer:
+            await message.reply("Такого активного лота нет.")
+            return
+        price = offer["price"]
+
+        burn = await _apply_burn_and_return(price)
+        to_seller = price - burn
+
+        # списание у покупателя, начисление продавцу и сжигание — одной транзакцией
+        paid = await apply_movements(
+            [
+                (buyer_id, -price, f"покупка лота #{offer_id}"),
+                (offer["seller_id"], to_seller, f"продажа лота #{offer_id}"),
+            ],
+            burn=burn, burn_reason=f"offer_id={offer_id}",
+        )
+        if not paid:
+            bal = await get_balance(buyer_id)
+            await message.reply(f"Недостаточно нуаров. Требуется {fmt_money(price)}, на руках {fmt_money(bal)}.")
+            return
 
-    # записать продажу
-    sale_id = await insert_history(buyer_id, "offer_sold", price, f"offer_id={offer_id};seller={offer['seller_id']}")
+        # записать продажу
+        sale_id = await record_offer_sold(buyer_id, offer_id, offer["seller_id"], price)
 
-    # если перковый лот — перевыдать перк/кредит
-    if offer.get("type") == "perk":
-        code = (offer.get("perk_code") or "").strip().lower()
-        if code in PERK_REGISTRY:
-            buyer_perks = await get_perks(buyer_id)
-            granted = False
-            if code in buyer_perks:
-                await perk_credit_add(buyer_id, code)
-                perk_note = "Выдан ваучер (у вас уже есть такой перк)."
-            else:
-                await grant_perk(buyer_id, code)
-                granted = True
-                perk_note = "Выдан активный перк."
-            # закрываем эскроу
-            seller_id = offer["seller_id"]
-            await perk_escrow_close(seller_id, code, offer_id, "sold")
+        # если перковый лот — перевыдать перк/кредит
+        if offer.get("type") == "perk":
+            code = (offer.get("perk_code") or "").strip().lower()
+            if code in PERK_REGISTRY:
+                granted = False
+                if await user_has_perk(buyer_id, code):
+                    await perk_credit_add(buyer_id, code)
+                    perk_note = "Выдан ваучер (у вас уже есть такой перк)."
+                else:
+                    await grant_perk(buyer_id, code)
+                    granted = True
+                    perk_note = "Выдан активный перк."
+                # закрываем эскроу
+                seller_id = offer["seller_id"]
+                await perk_escrow_close(seller_id, code, offer_id, "sold")
 
 
     # контракт
@@ -2254,41 +2287,38 @@ async def handle_buy_perk(message: types.Message, code: str):
         await message.reply("Такого перка нет.")
         return
     buyer_id = message.from_user.id
-    perks = await get_perks(buyer_id)
-    if code in perks:
-        await message.reply("У вас уже есть этот перк. Повторно купить нельзя.")
-        return
+    # проверка «уже есть», оплата и выдача — в полосе покупателя
+    async with lane(buyer_id):
+        if await user_has_perk(buyer_id, code):
+            await message.reply("У вас уже есть этот перк. Повторно купить нельзя.")
+            return
 
-    price = await get_price_perk(code)
-    if price is None:
-        await message.reply("Этот перк сейчас не продаётся.")
-        return
+        price = await get_price_perk(code)
+        if price is None:
+            await message.reply("Этот перк сейчас не продаётся.")
+            return
 
-    
-    bal = await get_balance(buyer_id)
-    if price > bal:
-        await message.reply(f"Недостаточно нуаров. Требуется {fmt_money(price)}, на руках {fmt_money(bal)}.")
-        return
 
-    # выдаём перк
-    left = await get_perk_primary_left(code)
-    if left <= 0:
-        await safe_reply(message, "Этот перк распродан на первичном рынке (0/10). Ищите на вторичке.")
-        return
+        # выдаём перк
+        left = await get_perk_primary_left(code)
+        if left <= 0:
+            await safe_reply(message, "Этот перк распродан на первичном рынке (0/10). Ищите на вторичке.")
+            return
 
-    burn = await _apply_burn_and_return(price)
-    # списываем у покупателя
-    await change_balance(buyer_id, -price, f"покупка перка {code}", buyer_id)
-    if burn > 0:
-        await record_burn(burn, f"perk={code}")
+        burn = await _apply_burn_and_return(price)
+        # списываем у покупателя (только если хватает) и сжигаем — одной транзакцией
+        if not await apply_movements([(buyer_id, -price, f"покупка перка {code}")], burn=burn, burn_reason=f"perk={code}"):
+            bal = await get_balance(buyer_id)
+            await message.reply(f"Недостаточно нуаров. Требуется {fmt_money(price)}, на руках {fmt_money(bal)}.")
+            return
 
 
-    # ... успешная покупка:
-    await add_perk_minted(code, +1)        
-    await grant_perk(buyer_id, code)
+        # ... успешная покупка:
+        await add_perk_minted(code, +1)        
+        await grant_perk(buyer_id, code)
 
-    # чек
-    sale_id = await insert_history(buyer_id, "perk_buy", price, code)
+        # чек
+        sale_id = await insert_history(buyer_id, "perk_buy", price, code, perk_code=code)
     today = datetime.utcnow().strftime("%Y%m%d")
     contract_id = f"C-{today}-{sale_id}"
     emoji, title = PERK_REGISTRY[code]
@@ -2345,11 +2375,6 @@ async def handle_vault_stats(message: types.Message):
         await message.reply("Сейф ещё не включён.")
         return
 
-    stats = await get_economy_stats()
-    if not stats:
-        await message.reply("Сейф ещё не включён.")
-        return
-
     bank_total     = await bank_touch_all_and_total()   # сумма всех ячеек
     vault_free     = await get_vault_free_amount()      # сейф без банка (свободно)
     circulating    = stats["circulating"]
@@ -2439,6 +2464,178 @@ async def handle_kurator_karman(message: types.Message):
         parse_mode="HTML"
     )
 
+async def _statement_target(message: types.Message):
+    # чужой карман (reply) — только хранителям ключа и Куратору
+    author = message.from_user
+    reply = message.reply_to_message
+    if reply and reply.from_user and (author.id == KURATOR_ID or await has_key(author.id)):
+        return reply.from_user
+    return author
+
+async def handle_balance_at(message: types.Message):
+    m = re.match(r"^баланс на дату\s+(\d{4}-\d{2}-\d{2}|\d{2}\.\d{2}\.\d{4})$", message.text.strip().lower())
+    if not m:
+        await message.reply("Пример: «баланс на дату 2025-03-01» или «баланс на дату 01.03.2025»")
+        return
+    raw = m.group(1)
+    try:
+        day = datetime.strptime(raw, "%Y-%m-%d" if "-" in raw else "%d.%m.%Y").replace(tzinfo=timezone.utc)
+    except ValueError:
+        await message.reply("Такой даты нет в календаре.")
+        return
+    target = await _statement_target(message)
+    # на конец дня (UTC)
+    bal = await get_balance_at(target.id, int(day.timestamp()) + 86400)
+    await message.reply(
+        f"💼 На конец {day.strftime('%d.%m.%Y')} в кармане {mention_html(target.id, target.full_name)} было {fmt_money(bal)}.",
+        parse_mode="HTML",
+    )
+
+async def handle_statement(message: types.Message):
+    m = re.match(r"^выписка(?:\s+до\s+(\d+))?$", message.text.strip().lower())
+    if not m:
+        await message.reply("Пример: «выписка» или «выписка до 12345»")
+        return
+    target = await _statement_target(message)
+    before = int(m.group(1)) if m.group(1) else None
+    rows, nxt = await get_statement(target.id, before_id=before)
+    if not rows:
+        await message.reply("Движений по карману не найдено.")
+        return
+    lines = [f"🧾 <b>Выписка</b> — {mention_html(target.id, target.full_name)}\n"]
+    for rid, date, action, amount, reason, bal_after in rows:
+        if action in ("change_balance", "balance_adjust"):
+            what = f"{'+' if (amount or 0) >= 0 else '−'}{fmt_int(abs(amount or 0))}"
+        else:
+            what = "обнуление"
+        note = f" · {html.escape(str(reason))[:40]}" if reason else ""
+        lines.append(f"<code>{rid}</code> {html.escape(str(date))[:16]} {what} → {fmt_money(bal_after)}{note}")
+    if nxt is not None:
+        lines.append(f"\nДальше: «выписка до {nxt}»")
+    await safe_reply(message, "\n".join(lines), parse_mode="HTML")
+
+# --------- служебные метрики ---------
+
+def _fmt_metrics_block(title: str, data: dict) -> str:
+    lines = [f"<b>{html.escape(title)}</b>"]
+    for k, v in data.items():
+        if isinstance(v, dict):
+            inner = ", ".join(f"{ik}={iv}" for ik, iv in v.items())
+            lines.append(f"• {html.escape(str(k))}: {html.escape(inner)}")
+        else:
+            lines.append(f"• {html.escape(str(k))}: {html.escape(str(v))}")
+    return "\n".join(lines)
+
+async def handle_metrics(message: types.Message):
+    if message.from_user.id != KURATOR_ID:
+        return
+    blocks = [
+        _fmt_metrics_block("Пул соединений (ожидание)", get_pool_stats() or {"—": "пул не открыт"}),
+        _fmt_metrics_block("Очереди пользователей (lanes)", get_lane_stats()),
+        _fmt_metrics_block("Анти-дубли сообщений", get_dedupe_stats()),
+        _fmt_metrics_block("Пакетные чтения (загрузчики)", get_loader_stats()),
+        _fmt_metrics_block("Кэш балансов", get_balance_cache_stats()),
+        _fmt_metrics_block("Цепочка балансов", get_chain_stats()),
+        _fmt_metrics_block("Эпохи (сбросы)", await get_epoch_stats()),
+        _fmt_metrics_block("Архив истории", get_archive_stats()),
+        _fmt_metrics_block("Резервные копии", get_backup_stats()),
+        _fmt_metrics_block("Сжатие журнала конфигов", get_compaction_stats()),
+        _fmt_metrics_block("Проекции событий", get_bus_stats()),
+        _fmt_metrics_block("Сверка счётчиков экономики", get_economy_check_report()),
+        _fmt_metrics_block("Горячие запросы (EXPLAIN)", {
+            name: ("полный скан" if plan.startswith("SCAN ") or "; SCAN " in plan else "индекс")
+            for name, plan in get_query_plan_report().items()
+        }),
+    ]
+    await safe_reply(message, "📊 <b>МЕТРИКИ</b>\n\n" + "\n\n".join(blocks), parse_mode="HTML")
+
+async def handle_reconcile(message: types.Message, fix: bool):
+    if message.from_user.id != KURATOR_ID:
+        return
+    await message.reply("🔎 Сверяю таблицы с журналом...")
+    rep = await reconcile_projections(fix=fix)
+    titles = {
+        "balances": "Балансы", "perks": "Перки", "credits": "Ваучеры",
+        "escrow": "Эскроу", "cells": "Ячейки", "generosity": "Очки щедрости",
+    }
+    lines = [
+        f"Прочитано событий: {fmt_int(rep['rows'])} за {rep['stream_sec']} с (всего {rep['total_sec']} с)"
+    ]
+    for key, title in titles.items():
+        sec = rep[key]
+        lines.append(f"• {title}: расхождений {fmt_int(sec['diffs'])}")
+        for k, in_table, in_log in sec["sample"]:
+            lines.append(f"    {html.escape(str(k))}: в таблице {html.escape(str(in_table))}, по журналу {html.escape(str(in_log))}")
+    if rep["fixed"]:
+        lines.append("✅ Таблицы приведены к журналу.")
+    elif any(rep[k]["diffs"] for k in titles):
+        lines.append("Чтобы исправить: «сверка исправить».")
+    await safe_reply(message, "\n".join(lines), parse_mode="HTML")
+
+async def handle_backup(message: types.Message):
+    if message.from_user.id != KURATOR_ID:
+        return
+    text_l = message.text.strip().lower()
+    if text_l == "бэкапы":
+        files = list_backups()
+        if not files:
+            await message.reply("Копий пока нет. Снять сейчас: «бэкап».")
+            return
+        lines = ["💾 <b>Резервные копии</b> (новые сверху)"]
+        lines += [f"• <code>{html.escape(n)}</code> — {fmt_int(kb)} КБ" for n, kb in files]
+        lines.append("\nВосстановить: «восстановить копию ИМЯ»")
+        await safe_reply(message, "\n".join(lines), parse_mode="HTML")
+        return
+    if text_l == "бэкап":
+        await message.reply("💾 Снимаю копию базы...")
+        name = await backup_run()
+        if name is None:
+            await message.reply("Копия уже снимается, попробуйте позже.")
+            return
+        st = get_backup_stats()
+        await message.reply(
+            f"✅ Копия {name}: {fmt_int(st['last_kb'])} КБ, {st['last_sec']} с, "
+            f"{fmt_int(st['last_pages'])} страниц за {fmt_int(st['last_steps'])} шагов."
+        )
+        return
+    m = re.match(r"^восстановить\s+копию\s+(\S+)$", message.text.strip())
+    if not m:
+        await message.reply("Пример: «восстановить копию club-20250101-000000-h123.sqlite.gz» (список — «бэкапы»)")
+        return
+    await message.reply("♻️ Восстанавливаю базу из копии (текущая сохраняется отдельной копией)...")
+    try:
+        rep = await restore_backup(m.group(1))
+    except ValueError as e:
+        await message.reply(f"Не удалось: {e}")
+        return
+    await message.reply(f"✅ База восстановлена из {rep['file']} (журнал до id {rep['history_id']}).")
+
+async def handle_history_export(message: types.Message):
+    if message.from_user.id != KURATOR_ID:
+        return
+    m = re.match(r"^выгрузка\s+истории(?:\s+(-?\d+))?$", message.text.strip().lower())
+    if not m:
+        await message.reply("Пример: «выгрузка истории» или «выгрузка истории 123456»")
+        return
+    uid = int(m.group(1)) if m.group(1) else None
+    # журнал целиком: архивные месяцы + текущая база; строки по мере чтения
+    # уходят в сжатый временный файл — в памяти только текущая пачка
+    name = f"history_{uid}.csv.gz" if uid is not None else "history.csv.gz"
+    fd, path = tempfile.mkstemp(suffix=".csv.gz")
+    os.close(fd)
+    try:
+        n = 0
+        with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(HISTORY_COLS)
+            async for row in iter_history(user_id=uid):
+                w.writerow(row)
+                n += 1
+        async with tg_limiter:
+            await message.reply_document(FSInputFile(path, filename=name), caption=f"Записей: {fmt_int(n)}")
+    finally:
+        os.remove(path)
+
 # --------- динамический «список команд» ---------
 
 # commands.py
@@ -2462,6 +2659,8 @@ async def handle_commands_catalog(message: types.Message):
     ]
     members = [
         "мой карман - просмотр своего баланса",
+        "баланс на дату <ГГГГ-ММ-ДД> - сколько было в кармане на конец дня",
+        "выписка / выписка до <id> - движения по карману с остатком",
         "моя роль - просмотр своей роли",
         "роль(reply) - просмотр роли другого участника Клуба",
         "рейтинг клуба - список богатейших членов Клуба",
@@ -2550,7 +2749,13 @@ async def handle_commands_curator(message: types.Message):
             "подмести клуб - обнуляет покинувших чат",
             "черная метка(reply) - чс бота",
             "белая метка(reply) - убирает из чс бота",
-            "черный список - люди с черной меткой"
+            "черный список - люди с черной меткой",
+            "метрики - служебная статистика бота и базы",
+            "выгрузка истории [user_id] - CSV журнала в .gz (архив + текущая база)",
+            "сжать журнал конфигов - оставить последние значения каждого ключа",
+            "сверка / сверка исправить - пересобрать балансы, перки, ячейки из журнала",
+            "бэкап / бэкапы - снять копию базы / список копий",
+            "восстановить копию <имя> - вернуть базу из копии (текущая сохраняется)",
         ]),
         ("🎁 Щедрость", [
             "щедрость множитель <p>% / щедрость награда <N>",
@@ -2764,13 +2969,12 @@ async def _pin_paid(message: types.Message, loud: bool):
     price = await get_price_pin_loud() if loud else await get_price_pin()
     purchase = 10*price
     user_id = message.from_user.id
-    bal = await get_balance(user_id)
-    if purchase > bal:
-        await message.reply(f"Не хватает нуаров. Цена: {fmt_money(purchase)}. На руках: {fmt_money(bal)}.")
-        return
-
-    # списываем (идёт в сейф; никому не начисляем)
-    await change_balance(user_id, -purchase, "util_pin" + ("_loud" if loud else ""), user_id)
+    async with lane(user_id):
+        # списываем (идёт в сейф; никому не начисляем)
+        if await debit_if_sufficient(user_id, purchase, "util_pin" + ("_loud" if loud else "")) is None:
+            bal = await get_balance(user_id)
+            await message.reply(f"Не хватает нуаров. Цена: {fmt_money(purchase)}. На руках: {fmt_money(bal)}.")
+            return
 
     # пин
     try:
@@ -2794,13 +2998,14 @@ async def handle_cell_deposit_cmd(message: types.Message, amount: int):
     if amount <= 0:
         await message.reply("Сумма должна быть положительной.")
         return
-    bal = await get_balance(message.from_user.id)
-    if amount > bal:
+    async with lane(message.from_user.id):
+        # списание с кармана и зачисление в ячейку — одной транзакцией
+        done = await cell_deposit_from_pocket(message.from_user.id, amount)
+    if done is None:
+        bal = await get_balance(message.from_user.id)
         await message.reply(f"Недостаточно нуаров. На руках: {fmt_money(bal)}.")
         return
-    # списываем с кармана
-    await change_balance(message.from_user.id, -amount, "cell_deposit", message.from_user.id)
-    gross, fee, new_cell = await cell_deposit(message.from_user.id, amount)
+    gross, fee, new_cell = done
     await safe_reply(message,
         "✅ Депозит выполнен\n"
         f"Внесено: {fmt_money(gross)}\n"
@@ -2813,12 +3018,12 @@ async def handle_cell_withdraw_cmd(message: types.Message, amount: int):
     if amount <= 0:
         await message.reply("Сумма должна быть положительной.")
         return
-    taken, new_cell = await cell_withdraw(message.from_user.id, amount)
+    async with lane(message.from_user.id):
+        # вывод и возврат на карман — одной транзакцией
+        taken, new_cell = await cell_withdraw_to_pocket(message.from_user.id, amount, "cell_withdraw_payout")
     if taken <= 0:
         await message.reply("В ячейке недостаточно средств.")
         return
-    # возвращаем на карман
-    await change_balance(message.from_user.id, taken, "cell_withdraw_payout", message.from_user.id)
     await message.reply(
         "✅ Вывод выполнен\n"
         f"Выведено: {fmt_money(taken)}\n"
@@ -2826,14 +3031,13 @@ async def handle_cell_withdraw_cmd(message: types.Message, amount: int):
     )
 
 async def handle_cell_withdraw_all_cmd(message: types.Message):
-    # узнаём текущий баланс ячейки и выводим всё
-    bal = await cell_get_balance(message.from_user.id)
-    if bal <= 0:
-        await message.reply("В ячейке пусто.")
-        return
-    taken, new_cell = await cell_withdraw(message.from_user.id, bal)
-    if taken > 0:
-        await change_balance(message.from_user.id, taken, "cell_withdraw_all_payout", message.from_user.id)
+    async with lane(message.from_user.id):
+        # узнаём текущий баланс ячейки и выводим всё
+        bal = await cell_get_balance(message.from_user.id)
+        if bal <= 0:
+            await message.reply("В ячейке пусто.")
+            return
+        taken, new_cell = await cell_withdraw_to_pocket(message.from_user.id, bal, "cell_withdraw_all_payout")
     await safe_reply(message,
         "✅ Вывод всего баланса\n"
         f"Выведено: {fmt_money(taken)}\n"
@@ -2859,31 +3063,26 @@ async def handle_bank_summary_cmd(message: types.Message):
 
 async def handle_bank_rob_cmd(message: types.Message):
     user_id = message.from_user.id
-    perks = await get_perks(user_id)
-    if "грабитель" not in perks:
-        await message.reply("У Вас нет такой привилегии.")
-        return
-
-    # КД из конфига (в днях)
-    seconds = await get_seconds_since_last_bank_rob(user_id)
     cd_days = await get_bank_rob_cooldown_days()
     COOLDOWN = cd_days * 24 * 60 * 60
-    if seconds is not None and seconds < COOLDOWN:
-        remain = COOLDOWN - seconds
+    roll = random.randint(1, 100)
+    outcome = "success" if roll <= 50 else "fail" if roll <= 95 else "busted"
+    # проверка перка и КД, вынос ячеек и выплата — под дорожкой и одной транзакцией
+    async with lane(user_id):
+        has_perk = await user_has_perk(user_id, "грабитель")
+        if has_perk:
+            remain, loot = await bank_rob(user_id, outcome, COOLDOWN)
+    if not has_perk:
+        await message.reply("У Вас нет такой привилегии.")
+        return
+    if remain is not None:
         days  = remain // (24*3600)
         hours = (remain % (24*3600)) // 3600
         minutes = (remain % 3600) // 60
         await safe_reply(message,f"Подготовка нового налёта возьмет еще {days}д {hours}ч {minutes}м.")
         return
 
-    roll = random.randint(1, 100)
-    if roll <= 50:
-        # успех
-        _ = await bank_touch_all_and_total()
-        loot = await bank_zero_all_and_sum()
-        await record_bank_rob(user_id, "success", loot)
-        if loot > 0:
-            await change_balance(user_id, loot, "bank_rob_success", user_id)
+    if outcome == "success":
         await message.reply(
             f"🎭 В твоей команде явно был сам Джокер! Вы вынесли всё подчистую. "
             f"Я насчитал {fmt_money(loot)} нуаров!"
@@ -2897,9 +3096,7 @@ async def handle_bank_rob_cmd(message: types.Message):
             pass
         return
 
-    if roll <= 95:
-        # промах
-        await record_bank_rob(user_id, "fail", 0)
+    if outcome == "fail":
         await message.reply("🚓 Кажется они вызвали копов! Валим!")
         try:
             await message.bot.send_message(message.chat.id, "🛡️ Охрана банка отбила нападение грабителей.")
@@ -2907,9 +3104,7 @@ async def handle_bank_rob_cmd(message: types.Message):
             pass
         return
 
-    # провал с потерей перка
-    await record_bank_rob(user_id, "busted", 0)
-    await revoke_perk(user_id, "грабитель")
+    # провал с потерей перка (изъят в bank_rob)
     await message.reply("🧿 Полиция уже была на месте. Вас ждали. Вы арестованы. Оружие изъято.")
     try:
         await message.bot.send_message(
@@ -2924,15 +3119,12 @@ async def handle_burn_cmd(message: types.Message, amount: int):
         await message.reply("Сумма должна быть положительной.")
         return
     user_id = message.from_user.id
-    bal = await get_balance(user_id)
-    if amount > bal:
-        await message.reply(f"Недостаточно нуаров для сжигания. На руках: {fmt_money(bal)}.")
-        return
-
-    # списываем с кармана
-    await change_balance(user_id, -amount, "burn_self", user_id)
-    # фиксируем сжигание (учтётся в экономике)
-    await record_burn(amount, f"user_burn:{user_id}")
+    async with lane(user_id):
+        # списываем с кармана и фиксируем сжигание (учтётся в экономике) — одной транзакцией
+        if not await apply_movements([(user_id, -amount, "burn_self")], burn=amount, burn_reason=f"user_burn:{user_id}"):
+            bal = await get_balance(user_id)
+            await message.reply(f"Недостаточно нуаров для сжигания. На руках: {fmt_money(bal)}.")
+            return
 
     await message.reply(f"🔥 Ты сжег {fmt_money(amount)}. Было тепло, но теперь они утеряны навсегда.")
 
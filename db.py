@@ -1,11 +1,21 @@
 import aiosqlite
+import asyncio
+import gzip
+import heapq
+import logging
+import os
 import re
-from typing import Optional, Dict, Any, List, Tuple
+import shutil
+import time
+from collections import OrderedDict, deque
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Optional, Dict, Any, List, Tuple, NamedTuple, Callable
 import json
 from datetime import datetime, timezone, timedelta
 
 DB_PATH = "/data/bot_data.sqlite"
-SCHEMA_VERSION = 1  # схему не меняем
+SCHEMA_VERSION = 14 # поднимается вместе с новой миграцией (см. @_migration)
 
 CREATE_USERS = """
 CREATE TABLE IF NOT EXISTS users (
@@ -36,9 +46,184 @@ CREATE TABLE IF NOT EXISTS history (
 );
 """
 
-EXPECTED_USERS_COLS  = ["user_id", "username", "balance", "key"]
+EXPECTED_USERS_COLS  = ["user_id", "username", "balance", "key", "epoch"]
 EXPECTED_ROLES_COLS  = ["user_id", "role_name", "role_desc", "role_image"]
-EXPECTED_HIST_COLS   = ["id", "user_id", "action", "amount", "reason", "date"]
+CREATE_CONFIG = """
+CREATE TABLE IF NOT EXISTS config (
+    key        TEXT PRIMARY KEY,
+    int_value  INTEGER,
+    str_value  TEXT,
+    updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+CREATE_MSG_DEDUPE = """
+CREATE TABLE IF NOT EXISTS msg_dedupe (
+    chat_id    INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    ts         INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+) WITHOUT ROWID;
+"""
+
+# служебные значения бота (ключ → целое): update_id HWM и т.п.
+CREATE_BOT_STATE = """
+CREATE TABLE IF NOT EXISTS bot_state (
+    key   TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+# проекции перков: пишутся в той же транзакции, что и событие в history
+CREATE_USER_PERKS = """
+CREATE TABLE IF NOT EXISTS user_perks (
+    user_id    INTEGER NOT NULL,
+    perk_code  TEXT NOT NULL,
+    granted_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, perk_code)
+) WITHOUT ROWID;
+"""
+
+CREATE_PERK_CREDITS = """
+CREATE TABLE IF NOT EXISTS perk_credits (
+    user_id   INTEGER NOT NULL,
+    perk_code TEXT NOT NULL,
+    credits   INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, perk_code)
+) WITHOUT ROWID;
+"""
+
+CREATE_PERK_ESCROW = """
+CREATE TABLE IF NOT EXISTS perk_escrow (
+    offer_id  INTEGER PRIMARY KEY,
+    user_id   INTEGER NOT NULL,
+    perk_code TEXT NOT NULL,
+    opened_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# банковские ячейки: текущий остаток и метка последнего начисления хранения
+CREATE_CELLS = """
+CREATE TABLE IF NOT EXISTS cells (
+    user_id INTEGER PRIMARY KEY,
+    balance INTEGER NOT NULL DEFAULT 0,
+    last_ts INTEGER
+);
+"""
+
+# счётчики экономики одной строкой: обновляются в транзакциях change_balance,
+# record_burn, операций с ячейками и vault_init; сверяются фоновой проверкой
+CREATE_ECONOMY_STATE = """
+CREATE TABLE IF NOT EXISTS economy_state (
+    id          INTEGER PRIMARY KEY CHECK (id = 1),
+    cap         INTEGER,
+    burned      INTEGER NOT NULL DEFAULT 0,
+    circulating INTEGER NOT NULL DEFAULT 0,
+    bank_total  INTEGER NOT NULL DEFAULT 0,
+    epoch_id    INTEGER
+);
+"""
+
+# Счётчики и кулдауны пользователя: обновляются в той же транзакции, что и
+# событие в history (см. _user_state_apply), геттеры читают по ключу.
+CREATE_USER_STATE = """
+CREATE TABLE IF NOT EXISTS user_state (
+    user_id           INTEGER PRIMARY KEY,
+    last_salary_ts    INTEGER,
+    last_theft_ts     INTEGER,
+    last_bank_rob_ts  INTEGER,
+    generosity_points INTEGER NOT NULL DEFAULT 0
+);
+"""
+SALARY_STATE_CODE = "жалование"  # кулдаун, который ведётся в user_state
+
+EXPECTED_HIST_COLS   = ["id", "user_id", "action", "amount", "reason", "date",
+                        "chat_id", "ref_id", "perk_code", "payload", "ts", "balance_after", "cell_after"]
+
+# Журнал с v12 лежит в history_log с целым action_id (справочник actions);
+# history — представление с текстовым action для чтения и ручного SQL.
+CREATE_ACTIONS = """
+CREATE TABLE IF NOT EXISTS actions (
+    id   INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+"""
+
+# Эпохи клуба (v14): сброс балансов и обнуление клуба — новая строка здесь.
+# Баланс пользователя действителен, только если users.epoch не старше
+# текущей эпохи (см. SQL_BALANCE); устаревшие строки обнуляются лениво при
+# следующей записи (ensure_user). История прошлых эпох остаётся в журнале.
+CREATE_EPOCHS = """
+CREATE TABLE IF NOT EXISTS epochs (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind       TEXT NOT NULL,      -- 'balances' | 'club'
+    history_id INTEGER,            -- строка reset_all_balances / club_reset
+    ts         INTEGER
+);
+"""
+
+CREATE_HISTORY_LOG = """
+CREATE TABLE IF NOT EXISTS history_log (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id   INTEGER,
+    action_id INTEGER REFERENCES actions(id),
+    amount    INTEGER,
+    reason    TEXT,
+    date      TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    chat_id   INTEGER,
+    ref_id    INTEGER,
+    perk_code TEXT,
+    payload   TEXT,
+    ts        INTEGER,
+    balance_after INTEGER,  -- v13: баланс кармана после строки (цепочка балансов)
+    cell_after    INTEGER   -- v13: баланс ячейки после строки
+);
+"""
+
+CREATE_HISTORY_VIEW = """
+CREATE VIEW IF NOT EXISTS history AS
+SELECT h.id, h.user_id, a.name AS action, h.amount, h.reason, h.date,
+       h.chat_id, h.ref_id, h.perk_code, h.payload, h.ts, h.balance_after, h.cell_after
+FROM history_log h LEFT JOIN actions a ON a.id = h.action_id;
+"""
+
+# ручной INSERT в представление (sqlite3-консоль, разовые скрипты)
+CREATE_HISTORY_VIEW_INSERT = """
+CREATE TRIGGER IF NOT EXISTS history_view_insert INSTEAD OF INSERT ON history
+BEGIN
+    INSERT OR IGNORE INTO actions (name) SELECT NEW.action WHERE NEW.action IS NOT NULL;
+    INSERT INTO history_log (user_id, action_id, amount, reason, date, chat_id, ref_id, perk_code, payload, ts)
+    VALUES (NEW.user_id, (SELECT id FROM actions WHERE name = NEW.action), NEW.amount, NEW.reason,
+            COALESCE(NEW.date, CURRENT_TIMESTAMP), NEW.chat_id, NEW.ref_id, NEW.perk_code, NEW.payload,
+            COALESCE(NEW.ts, CAST(strftime('%s','now') AS INTEGER)));
+END;
+"""
+
+HISTORY_LOG_INDEXES = (
+    ("idx_history_action", "action_id"),
+    ("idx_history_user_action", "user_id, action_id"),
+    ("idx_history_action_reason", "action_id, reason"),
+    ("idx_history_action_chat", "action_id, chat_id"),
+    ("idx_history_action_ref", "action_id, ref_id"),
+    ("idx_history_action_perk", "action_id, perk_code"),
+    ("idx_history_action_ts", "action_id, ts"),
+)
+
+# частичные индексы цепочек: «баланс на дату» и страницы выписки —
+# один спуск по (user_id, ts) среди строк, менявших баланс
+CHAIN_INDEXES = (
+    ("idx_history_balance_chain", "user_id, ts", "balance_after IS NOT NULL"),
+    ("idx_history_cell_chain", "user_id, ts", "cell_after IS NOT NULL"),
+)
+
+# unix-время записи: history.ts заполняется этим выражением в каждом INSERT,
+# в том же операторе, что и DEFAULT CURRENT_TIMESTAMP для date
+SQL_NOW_TS = "CAST(strftime('%s','now') AS INTEGER)"
+
+# баланс с учётом эпохи: строка из прошлой эпохи читается как 0
+CLUB_RESET_ACTION = "club_reset"
+SQL_CUR_EPOCH = "(SELECT COALESCE(MAX(id), 0) FROM epochs)"
+SQL_BALANCE = f"(CASE WHEN users.epoch >= {SQL_CUR_EPOCH} THEN users.balance ELSE 0 END)"
 
 CFG_BRAVO_WINDOW_SEC   = "bravo_window_sec"   # дефолт 600
 CFG_BRAVO_MAX_VIEWERS  = "bravo_max_viewers"  # дефолт 10
@@ -47,6 +232,405 @@ CFG_PIN_Q_MULT         = "pin_q_mult"         # дефолт 9 (тихий = bon
 CFG_PERK_VOUCHERS = "perk_vouchers_json"  # {"кража": 3, "щит": 1, ...}
 
 
+# ------- пул соединений -------
+# Один постоянный писатель + несколько читателей.
+# У каждого соединения свой кэш подготовленных выражений (cached_statements).
+# Писателем владеет отдельная задача (group commit): блоки _writer() встают в
+# очередь, задача по очереди отдаёт им соединение внутри общей транзакции
+# (каждому — свой SAVEPOINT) и делает один COMMIT на пачку. Вызывающий выходит
+# из _writer() только после COMMIT своей пачки — гарантии долговечности прежние.
+# Вложенные _writer()/_reader() в той же задаче переиспользуют её соединение
+# (видят свои незакоммиченные данные).
+#
+# Пока блок открыт, все остальные записи в процессе ждут его, поэтому внутри
+# блока — только работа с БД: никаких запросов к Telegram, sleep и ожидания
+# других задач. Дочерняя задача, запущенная из открытого блока, писать не
+# может (её заявка встала бы за родителем) — _writer() в ней бросает ошибку.
+# Блок дольше GROUP_COMMIT_BLOCK_TIMEOUT_SEC откатывается один (пачка
+# остальных блоков коммитится), его задача получает TimeoutError.
+
+POOL_READERS = 3
+POOL_STMT_CACHE = 256
+POOL_SLOW_BORROW_SEC = 0.5
+GROUP_COMMIT_MAX_BLOCKS = 64     # не больше блоков в одной транзакции
+GROUP_COMMIT_WINDOW_SEC = 0.002  # сколько ждать следующий блок, если очередь пуста
+GROUP_COMMIT_MAX_SEC = 0.05      # максимальная длина пачки по времени
+POOL_CLOSE_WAIT_SEC = 30.0       # сколько ждать возврата выданных читателей при закрытии
+GROUP_COMMIT_BLOCK_TIMEOUT_SEC = 10.0  # предел одного блока _writer(); миграции и сверка — без предела
+
+class _WaitStats:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, waited: float):
+        self.count += 1
+        self.total += waited
+        if waited > self.max:
+            self.max = waited
+
+    def as_dict(self) -> dict:
+        avg = (self.total / self.count) if self.count else 0.0
+        return {"borrows": self.count, "avg_ms": round(avg * 1000, 3), "max_ms": round(self.max * 1000, 3)}
+
+
+class _WriteSlot:
+    """Заявка на блок записи: соединение выдано → блок завершён → пачка закоммичена."""
+    __slots__ = ("granted", "released", "committed", "hooks", "owner", "timeout", "expired")
+
+    def __init__(self, timeout: Optional[float] = None):
+        loop = asyncio.get_running_loop()
+        self.owner = asyncio.current_task()
+        self.timeout = timeout
+        self.expired = False
+        self.granted = loop.create_future()    # -> соединение писателя
+        self.released = loop.create_future()   # -> True (успех) / False (откатить блок)
+        self.committed = loop.create_future()  # -> None после COMMIT пачки
+        self.hooks: list = []
+
+
+class _CommitStats:
+    __slots__ = ("batches", "blocks", "max_blocks", "failed", "timeouts")
+
+    def __init__(self):
+        self.batches = 0
+        self.blocks = 0
+        self.max_blocks = 0
+        self.failed = 0
+        self.timeouts = 0
+
+    def as_dict(self) -> dict:
+        avg = (self.blocks / self.batches) if self.batches else 0.0
+        return {"batches": self.batches, "blocks": self.blocks, "avg_blocks": round(avg, 2),
+                "max_blocks": self.max_blocks, "failed": self.failed, "timeouts": self.timeouts}
+
+
+def _resolve(fut: asyncio.Future, result=None, exc: Optional[BaseException] = None):
+    if not fut.done():
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(result)
+
+
+class _Pool:
+    def __init__(self, path: str, readers: int):
+        self.path = path
+        self.readers_n = readers
+        self.writer = None
+        self.readers: asyncio.Queue = asyncio.Queue()
+        self.all_readers: list = []
+        self.write_lock = asyncio.Lock()
+        self.write_queue: asyncio.Queue = asyncio.Queue()
+        self.writer_task: Optional[asyncio.Task] = None
+        self.closing = False  # после close() новые заявки не принимаются
+        self.wait = {"writer": _WaitStats(), "reader": _WaitStats()}
+        self.commits = _CommitStats()
+
+    async def _connect(self, readonly: bool):
+        # isolation_level=None: транзакциями управляем сами (BEGIN IMMEDIATE/COMMIT)
+        db = await aiosqlite.connect(self.path, isolation_level=None, cached_statements=POOL_STMT_CACHE)
+        pragmas = ["PRAGMA busy_timeout=5000", "PRAGMA synchronous=NORMAL", "PRAGMA foreign_keys=ON"]
+        if readonly:
+            pragmas.append("PRAGMA query_only=1")
+        else:
+            pragmas.insert(0, "PRAGMA journal_mode=WAL")
+        for pragma in pragmas:
+            # курсор закрываем сразу: незавершённый PRAGMA держит блокировку
+            async with db.execute(pragma):
+                pass
+        return db
+
+    async def open(self):
+        self.writer = await self._connect(readonly=False)
+        for _ in range(self.readers_n):
+            db = await self._connect(readonly=True)
+            self.all_readers.append(db)
+            self.readers.put_nowait(db)
+        self.writer_task = asyncio.create_task(self._write_loop(), name="db-writer")
+
+    async def _run_block(self, slot: _WriteSlot) -> bool:
+        db = self.writer
+        await db.execute("SAVEPOINT blk")
+        _resolve(slot.granted, db)
+        ok = False
+        try:
+            try:
+                ok = await asyncio.wait_for(asyncio.shield(slot.released), slot.timeout)
+            except asyncio.TimeoutError:
+                # блок завис не на БД: откатываем только его, задачу-владельца отменяем,
+                # чтобы она не продолжила писать в чужую транзакцию
+                self.commits.timeouts += 1
+                slot.expired = True
+                logging.error("db writer: block of %s exceeded %ss, rolled back",
+                              slot.owner.get_name() if slot.owner else "?", slot.timeout)
+                if slot.owner is not None:
+                    slot.owner.cancel()
+                try:
+                    await asyncio.wait_for(asyncio.shield(slot.released), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if ok:
+                await db.execute("RELEASE blk")
+            else:
+                await db.execute("ROLLBACK TO blk")
+                await db.execute("RELEASE blk")
+        return ok
+
+    async def _write_loop(self):
+        while True:
+            slot = await self.write_queue.get()
+            if slot is None:
+                return
+            if not await self._write_batch(slot):
+                return
+
+    async def _write_batch(self, slot: _WriteSlot) -> bool:
+        """Одна транзакция на несколько блоков. False — пришёл сигнал остановки."""
+        loop = asyncio.get_running_loop()
+        db = self.writer
+        batch: list[_WriteSlot] = []
+        running = True
+        started = loop.time()
+        try:
+            await db.execute("BEGIN IMMEDIATE")
+            while True:
+                if not slot.granted.cancelled() and await self._run_block(slot):
+                    batch.append(slot)
+                slot = None
+                if len(batch) >= GROUP_COMMIT_MAX_BLOCKS or loop.time() - started >= GROUP_COMMIT_MAX_SEC:
+                    break
+                try:
+                    nxt = self.write_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    try:
+                        nxt = await asyncio.wait_for(self.write_queue.get(), GROUP_COMMIT_WINDOW_SEC)
+                    except asyncio.TimeoutError:
+                        break
+                if nxt is None:
+                    running = False
+                    break
+                slot = nxt
+            await db.execute("COMMIT")
+        except BaseException as e:
+            err = e if isinstance(e, Exception) else RuntimeError("db writer stopped")
+            try:
+                await db.rollback()
+            except Exception:
+                logging.exception("db writer: rollback failed")
+            self.commits.failed += 1
+            logging.error("db writer: batch of %s blocks rolled back: %r", len(batch), e)
+            for s in batch + ([slot] if slot is not None else []):
+                _resolve(s.granted, exc=err)
+                _resolve(s.committed, exc=err)
+            if not isinstance(e, Exception):
+                raise
+            return running
+        if batch:
+            _loaders_invalidate()
+        self.commits.batches += 1
+        self.commits.blocks += len(batch)
+        self.commits.max_blocks = max(self.commits.max_blocks, len(batch))
+        for s in batch:
+            # кэши обновляем только после успешного COMMIT (при откате колбэки выбрасываются)
+            for fn in s.hooks:
+                try:
+                    fn()
+                except Exception:
+                    logging.exception("db: post-commit hook failed")
+            _resolve(s.committed)
+        return running
+
+    def _reject_queued(self):
+        # заявки за сигналом остановки не будут выполнены — отказываем, а не бросаем
+        while True:
+            try:
+                slot = self.write_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if slot is not None:
+                _resolve(slot.granted, exc=RuntimeError("db closed"))
+                slot.committed.cancel()  # до него заявка уже не дойдёт
+
+    async def close(self):
+        self.closing = True
+        async with self.write_lock:
+            if self.writer_task is not None:
+                self.write_queue.put_nowait(None)
+                try:
+                    await self.writer_task
+                finally:
+                    self.writer_task = None
+                    self._reject_queued()
+            # читатели, выданные до закрытия, дорабатывают свои запросы
+            try:
+                for _ in range(len(self.all_readers)):
+                    await asyncio.wait_for(self.readers.get(), POOL_CLOSE_WAIT_SEC)
+            except asyncio.TimeoutError:
+                logging.warning("db pool: readers still borrowed after %ss, closing anyway", POOL_CLOSE_WAIT_SEC)
+            for db in self.all_readers:
+                await db.close()
+            self.all_readers.clear()
+            if self.writer is not None:
+                await self.writer.close()
+                self.writer = None
+
+
+_POOL: Optional[_Pool] = None
+_POOL_OPEN_LOCK = asyncio.Lock()
+# (задача-владелец, соединение, колбэки после COMMIT) текущей транзакции записи
+_TX: ContextVar[Optional[tuple]] = ContextVar("db_tx", default=None)
+
+
+async def _open_pool():
+    # вызывать под _POOL_OPEN_LOCK
+    global _POOL
+    pool = _Pool(DB_PATH, POOL_READERS)
+    await pool.open()
+    _POOL = pool
+
+async def _get_pool() -> _Pool:
+    if _POOL is None:
+        async with _POOL_OPEN_LOCK:
+            if _POOL is None:
+                await _open_pool()
+    return _POOL
+
+@asynccontextmanager
+async def _savepoint(db, name: str = "sp"):
+    """Вложенная атомарная часть транзакции: при исключении откатывается только она."""
+    tx = _TX.get()
+    hooks = tx[2] if tx is not None and tx[1] is db else None
+    n_hooks = len(hooks) if hooks is not None else 0
+    await db.execute(f"SAVEPOINT {name}")
+    try:
+        yield db
+    except BaseException:
+        await db.execute(f"ROLLBACK TO {name}")
+        await db.execute(f"RELEASE {name}")
+        if hooks is not None:
+            # колбэки откатанной части не должны сработать после COMMIT
+            del hooks[n_hooks:]
+        raise
+    else:
+        await db.execute(f"RELEASE {name}")
+
+def _current_tx():
+    tx = _TX.get()
+    if tx is not None and tx[0] is asyncio.current_task():
+        return tx[1]
+    return None
+
+def _note_wait(pool: _Pool, kind: str, t0: float):
+    waited = time.perf_counter() - t0
+    pool.wait[kind].add(waited)
+    if waited > POOL_SLOW_BORROW_SEC:
+        logging.warning("db pool: %s borrow waited %.3fs", kind, waited)
+
+@asynccontextmanager
+async def _writer(timeout: Optional[float] = GROUP_COMMIT_BLOCK_TIMEOUT_SEC):
+    """
+    Блок записи в общей транзакции писателя. Внутри — только запросы к БД
+    (см. комментарий к пулу); timeout=None — для миграций и сверки.
+    """
+    db = _current_tx()
+    if db is not None:
+        yield db
+        return
+    tx = _TX.get()
+    if tx is not None and not tx[3].released.done():
+        # контекст унаследован от задачи с открытым блоком: ждали бы сами себя
+        raise RuntimeError("db: _writer() in a child task of an open write block would deadlock")
+    pool = await _get_pool()
+    if pool.closing:
+        raise RuntimeError("db closed")
+    t0 = time.perf_counter()
+    slot = _WriteSlot(timeout)
+    pool.write_queue.put_nowait(slot)
+    try:
+        db = await slot.granted
+    except asyncio.CancelledError:
+        # отказались ждать: если соединение уже выдано — вернуть его писателю
+        if not slot.granted.cancel():
+            _resolve(slot.released, False)
+        raise
+    _note_wait(pool, "writer", t0)
+    token = _TX.set((asyncio.current_task(), db, slot.hooks, slot))
+    try:
+        yield db
+    except BaseException as e:
+        _resolve(slot.released, False)
+        if slot.expired and isinstance(e, asyncio.CancelledError):
+            # отмену вызвал писатель по таймауту, а не вызывающий код
+            asyncio.current_task().uncancel()
+            raise asyncio.TimeoutError(f"db write block exceeded {slot.timeout}s") from None
+        raise
+    else:
+        _resolve(slot.released, True)
+    finally:
+        _TX.reset(token)
+    # выходим только после COMMIT пачки, в которую попал блок
+    await slot.committed
+
+def _after_commit(fn):
+    """Выполнить fn после COMMIT текущей транзакции записи (или сразу, если её нет)."""
+    tx = _TX.get()
+    if tx is not None and tx[0] is asyncio.current_task():
+        tx[2].append(fn)
+    else:
+        fn()
+
+@asynccontextmanager
+async def _reader():
+    db = _current_tx()
+    if db is not None:
+        yield db
+        return
+    pool = await _get_pool()
+    if pool.closing:
+        raise RuntimeError("db closed")
+    t0 = time.perf_counter()
+    db = await pool.readers.get()
+    _note_wait(pool, "reader", t0)
+    try:
+        yield db
+    finally:
+        pool.readers.put_nowait(db)
+
+def get_pool_stats() -> dict:
+    """Время ожидания соединений пула и пачки group commit (для метрик)."""
+    if _POOL is None:
+        return {}
+    out = {kind: st.as_dict() for kind, st in _POOL.wait.items()}
+    out["group_commit"] = _POOL.commits.as_dict()
+    return out
+
+def _caches_reset():
+    # все кэши процесса поверх файла базы
+    _cfg_cache_reset()
+    _bal_cache_reset()
+    _loaders_invalidate()
+    _ACTION_IDS.clear()
+    _bus_reset()
+
+async def close_db():
+    global _POOL
+    if _POOL is not None:
+        try:
+            await flush_update_hwm()
+        except Exception:
+            logging.exception("db: failed to save update_id HWM")
+        pool, _POOL = _POOL, None
+        await pool.close()
+    # сбрасываем после закрытия: до него незавершённые запросы успели бы
+    # снова заполнить кэши значениями из закрываемой базы
+    _caches_reset()
+
+
 # ------- базовая инициализация/проверка -------
 
 async def _table_columns(db, table: str):
@@ -55,84 +639,1007 @@ async def _table_columns(db, table: str):
     return [r[1] for r in rows]
 
 async def _schema_ok(db) -> bool:
+    # миграции только добавляют колонки, поэтому проверяем «ожидаемые ⊆ фактические»
     for table, expected in (
         ("users", EXPECTED_USERS_COLS),
         ("roles", EXPECTED_ROLES_COLS),
         ("history", EXPECTED_HIST_COLS),
     ):
-        async with db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,)) as cur:
+        async with db.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name=?", (table,)) as cur:
             row = await cur.fetchone()
         if not row:
             return False
         cols = await _table_columns(db, table)
-        if cols != expected:
+        if not set(expected) <= set(cols):
             return False
     return True
 
-async def _recreate_all(db):
-    await db.execute("DROP TABLE IF EXISTS history")
-    await db.execute("DROP TABLE IF EXISTS roles")
-    await db.execute("DROP TABLE IF EXISTS users")
-    await db.execute(CREATE_USERS)
-    await db.execute(CREATE_ROLES)
-    await db.execute(CREATE_HISTORY)
-    await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
-    await db.commit()
+# ------- миграции схемы -------
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция — отдельная
+# транзакция: при сбое база остаётся на предыдущей версии, данные не трогаем.
+
+_MIGRATIONS: Dict[int, Any] = {}
+
+def _migration(version: int):
+    def deco(fn):
+        _MIGRATIONS[version] = fn
+        return fn
+    return deco
+
+async def _user_version(db) -> int:
+    async with db.execute("PRAGMA user_version") as cur:
+        row = await cur.fetchone()
+    return int(row[0]) if row else 0
+
+async def _migrate():
+    async with _writer(timeout=None) as db:
+        current_ver = await _user_version(db)
+        if current_ver == 0:
+            # свежая база: базовая схема = версия 1
+            await db.execute(CREATE_USERS)
+            await db.execute(CREATE_ROLES)
+            await db.execute(CREATE_HISTORY)
+            await db.execute("PRAGMA user_version = 1")
+            current_ver = 1
+
+    if current_ver > SCHEMA_VERSION:
+        logging.warning("db: schema v%s is newer than code v%s, migrations skipped", current_ver, SCHEMA_VERSION)
+        return
+
+    for ver in range(current_ver + 1, SCHEMA_VERSION + 1):
+        step = _MIGRATIONS[ver]
+        t0 = time.perf_counter()
+        async with _writer(timeout=None) as db:
+            await step(db)
+            await db.execute(f"PRAGMA user_version = {ver}")
+        logging.info("db: migrated to v%s (%s) in %.2fs", ver, step.__name__, time.perf_counter() - t0)
+
+@_migration(2)
+async def _m2_history_indexes(db):
+    # выборки по action / (user_id, action) / (action, reason) с ORDER BY id:
+    # rowid в SQLite входит в каждый индекс, так что сортировка по id не нужна
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_history_action ON history(action)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_history_user_action ON history(user_id, action)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_history_action_reason ON history(action, reason)")
+
+# Структурные поля history вместо разбора "k=v;k=v" из reason:
+#   chat_id   — чат (герой, код-слово, браво)
+#   ref_id    — ссылка на объект: offer_id, msg_id, жертва кражи
+#   perk_code — нормализованный код перка
+#   payload   — JSON с прочими полями (until, word/active, link, ts, ...)
+# reason продолжаем писать как раньше — для чтения глазами и аудита.
+HISTORY_FIELD_COLS = (("chat_id", "INTEGER"), ("ref_id", "INTEGER"), ("perk_code", "TEXT"), ("payload", "TEXT"))
+BACKFILL_BATCH = 1000
+
+async def _add_column(db, table: str, col: str, decl: str):
+    if col not in await _table_columns(db, table):
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {col} {decl}")
+
+def _reason_fields(action: str, amount: Optional[int], reason: Optional[str]) -> dict:
+    """Разбор старого reason в структурные поля (для бэкфилла миграции v3)."""
+    r = reason or ""
+    get = lambda k: _reason_get(reason, k)
+    def as_int(v):
+        try:
+            return int(v)
+        except (TypeError, ValueError):
+            return None
+    f: dict = {}
+    if action in ("perk_grant", "perk_revoke", "perk_buy"):
+        f["perk_code"] = _normalize_perk_code(r) or None
+    elif action in ("perk_credit_add", "perk_credit_use"):
+        f["perk_code"] = _normalize_perk_code(get("code")) or None
+    elif action in ("perk_escrow_open", "perk_escrow_close"):
+        f["perk_code"] = _normalize_perk_code(get("code")) or None
+        f["ref_id"] = as_int(get("offer_id"))
+        if get("type"):
+            f["payload"] = {"type": get("type")}
+    elif action == "offer_create":
+        if get("perk_code"):
+            f["perk_code"] = _normalize_perk_code(get("perk_code"))
+        elif r.startswith("link="):
+            # ссылка может содержать ';' — берём всё после "link="
+            f["payload"] = {"link": r[len("link="):]}
+    elif action == "offer_cancel":
+        f["ref_id"] = amount
+    elif action == "offer_sold":
+        f["ref_id"] = as_int(get("offer_id"))
+        f["payload"] = {"seller": as_int(get("seller"))}
+    elif action in ("hero_set", "hero_claim", "hero_claim_msg", "bravo_claim",
+                    "codeword_set", "codeword_cancel", "codeword_win"):
+        f["chat_id"] = as_int(get("chat_id"))
+        if action == "hero_set":
+            f["payload"] = {"until": get("until")}
+        elif action in ("hero_claim_msg", "bravo_claim"):
+            f["ref_id"] = as_int(get("msg_id"))
+            if action == "hero_claim_msg":
+                f["payload"] = {"ts": as_int(get("ts")) or 0}
+        elif action.startswith("codeword_"):
+            f["payload"] = {"word": get("word")}
+            if get("active") is not None:
+                f["payload"]["active"] = as_int(get("active"))
+    elif action == "theft":
+        f["ref_id"] = as_int(get("victim"))
+        f["payload"] = {"success": get("success") == "1"}
+    elif action == "vault_init":
+        f["payload"] = {"cap": as_int(get("cap"))}
+    return f
+
+@_migration(3)
+async def _m3_history_fields(db):
+    for col, decl in HISTORY_FIELD_COLS:
+        await _add_column(db, "history", col, decl)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_history_action_chat ON history(action, chat_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_history_action_ref ON history(action, ref_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_history_action_perk ON history(action, perk_code)")
+
+    # бэкфилл пачками по id: память ограничена BACKFILL_BATCH строками
+    actions = ("perk_grant", "perk_revoke", "perk_buy", "perk_credit_add", "perk_credit_use",
+               "perk_escrow_open", "perk_escrow_close", "offer_create", "offer_cancel", "offer_sold",
+               "hero_set", "hero_claim", "hero_claim_msg", "bravo_claim",
+               "codeword_set", "codeword_cancel", "codeword_win", "theft", "vault_init")
+    marks = ",".join("?" * len(actions))
+    last_id = 0
+    while True:
+        async with db.execute(f"""
+            SELECT id, action, amount, reason FROM history
+            WHERE id > ? AND action IN ({marks})
+            ORDER BY id LIMIT ?
+        """, (last_id, *actions, BACKFILL_BATCH)) as cur:
+            rows = await cur.fetchall()
+        if not rows:
+            break
+        updates = []
+        for rid, action, amount, reason in rows:
+            f = _reason_fields(action, amount, reason)
+            payload = f.get("payload")
+            updates.append((
+                f.get("chat_id"), f.get("ref_id"), f.get("perk_code"),
+                json.dumps(payload, ensure_ascii=False) if payload is not None else None,
+                rid,
+            ))
+        await db.executemany(
+            "UPDATE history SET chat_id=?, ref_id=?, perk_code=?, payload=? WHERE id=?", updates
+        )
+        last_id = rows[-1][0]
+
+def _config_str_value(raw: Optional[str]) -> Optional[str]:
+    # строковые конфиги в history лежат как {"value": "..."}; старые — как есть
+    if raw is None:
+        return None
+    try:
+        payload = json.loads(raw)
+        if isinstance(payload, dict) and "value" in payload:
+            return str(payload["value"])
+    except Exception:
+        pass
+    return str(raw)
+
+@_migration(4)
+async def _m4_config_table(db):
+    await db.execute(CREATE_CONFIG)
+    # последние значения из history; сами записи history остаются журналом изменений
+    async with db.execute("""
+        SELECT reason, amount FROM history
+        WHERE id IN (SELECT MAX(id) FROM history WHERE action='config' AND reason IS NOT NULL GROUP BY reason)
+    """) as cur:
+        ints = await cur.fetchall()
+    await db.executemany("""
+        INSERT INTO config (key, int_value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET int_value=excluded.int_value
+    """, ints)
+    async with db.execute("""
+        SELECT substr(action, 12), reason FROM history
+        WHERE id IN (SELECT MAX(id) FROM history WHERE substr(action, 1, 11)='config_str:' GROUP BY action)
+    """) as cur:
+        strs = [(k, _config_str_value(v)) for k, v in await cur.fetchall()]
+    await db.executemany("""
+        INSERT INTO config (key, str_value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET str_value=excluded.str_value
+    """, strs)
+
+@_migration(5)
+async def _m5_msg_dedupe(db):
+    await db.execute(CREATE_MSG_DEDUPE)
+    await db.execute(CREATE_BOT_STATE)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_msg_dedupe_ts ON msg_dedupe(ts)")
+    # свежие ключи переносим (защита от повторов сразу после обновления), остальное — удаляем из history
+    min_ts = int(time.time()) - DEDUPE_TTL_SEC
+    async with db.execute("""
+        SELECT reason, CAST(strftime('%s', date) AS INTEGER) FROM history
+        WHERE action='msg_processed' AND CAST(strftime('%s', date) AS INTEGER) >= ?
+    """, (min_ts,)) as cur:
+        rows = await cur.fetchall()
+    keys = []
+    for reason, ts in rows:
+        chat, _, msg = (reason or "").rpartition(":")
+        try:
+            keys.append((int(chat), int(msg), int(ts)))
+        except ValueError:
+            continue
+    await db.executemany("INSERT OR IGNORE INTO msg_dedupe (chat_id, message_id, ts) VALUES (?, ?, ?)", keys)
+    await db.execute("DELETE FROM history WHERE action='msg_processed'")
+
+@_migration(6)
+async def _m6_perk_projections(db):
+    await db.execute(CREATE_USER_PERKS)
+    await db.execute(CREATE_PERK_CREDITS)
+    await db.execute(CREATE_PERK_ESCROW)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_user_perks_code ON user_perks(perk_code)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_perk_credits_code ON perk_credits(perk_code)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_perk_escrow_code ON perk_escrow(perk_code)")
+    # перк есть, если последнее событие по (user_id, perk_code) — выдача
+    await db.execute("""
+        INSERT OR IGNORE INTO user_perks (user_id, perk_code, granted_at)
+        SELECT h.user_id, h.perk_code, h.date FROM history h
+        WHERE h.action='perk_grant' AND h.user_id IS NOT NULL AND h.perk_code IS NOT NULL
+          AND h.id = (
+              SELECT MAX(x.id) FROM history x
+              WHERE x.user_id=h.user_id AND x.perk_code=h.perk_code
+                AND x.action IN ('perk_grant','perk_revoke')
+          )
+    """)
+    await db.execute("""
+        INSERT OR IGNORE INTO perk_credits (user_id, perk_code, credits)
+        SELECT user_id, perk_code,
+               SUM(CASE action WHEN 'perk_credit_add' THEN COALESCE(amount,0) ELSE -COALESCE(amount,0) END) AS n
+        FROM history
+        WHERE action IN ('perk_credit_add','perk_credit_use') AND user_id IS NOT NULL AND perk_code IS NOT NULL
+        GROUP BY user_id, perk_code
+        HAVING n > 0
+    """)
+    await db.execute("""
+        INSERT OR REPLACE INTO perk_escrow (offer_id, user_id, perk_code, opened_at)
+        SELECT o.ref_id, o.user_id, o.perk_code, o.date FROM history o
+        WHERE o.action='perk_escrow_open' AND o.ref_id IS NOT NULL
+          AND o.user_id IS NOT NULL AND o.perk_code IS NOT NULL
+          AND NOT EXISTS (
+              SELECT 1 FROM history c
+              WHERE c.action='perk_escrow_close' AND c.ref_id=o.ref_id
+          )
+        ORDER BY o.id
+    """)
+
+@_migration(7)
+async def _m7_cells(db):
+    await db.execute(CREATE_CELLS)
+    await db.execute("""
+        INSERT OR IGNORE INTO cells (user_id, balance, last_ts)
+        SELECT u.user_id,
+               MAX(0, COALESCE((
+                   SELECT SUM(CASE action WHEN 'cell_dep' THEN COALESCE(amount,0) ELSE -COALESCE(amount,0) END)
+                   FROM history
+                   WHERE user_id=u.user_id AND action IN ('cell_dep','cell_wd','cell_fee')
+               ), 0)),
+               (SELECT amount FROM history
+                WHERE user_id=u.user_id AND action='cell_ts'
+                ORDER BY id DESC LIMIT 1)
+        FROM (
+            SELECT DISTINCT user_id FROM history
+            WHERE action IN ('cell_dep','cell_wd','cell_fee','cell_ts') AND user_id IS NOT NULL
+        ) u
+    """)
+
+@_migration(8)
+async def _m8_cells_due_index(db):
+    # «есть ли кому начислять хранение» — MIN(last_ts) по индексу
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_cells_last_ts ON cells(last_ts)")
+
+@_migration(9)
+async def _m9_economy_state(db):
+    await db.execute(CREATE_ECONOMY_STATE)
+    await db.execute("INSERT OR IGNORE INTO economy_state (id) VALUES (1)")
+    # колонки users.epoch ещё нет (v14)
+    await _econ_store(db, await _econ_recompute(db, balance_sql="balance"))
+
+@_migration(10)
+async def _m10_user_state(db):
+    await db.execute(CREATE_USER_STATE)
+    await db.execute("""
+        INSERT OR REPLACE INTO user_state
+            (user_id, last_salary_ts, last_theft_ts, last_bank_rob_ts, generosity_points)
+        SELECT user_id,
+               MAX(CASE WHEN action='salary_claim' AND reason=? THEN CAST(strftime('%s', date) AS INTEGER) END),
+               MAX(CASE WHEN action='theft' THEN CAST(strftime('%s', date) AS INTEGER) END),
+               MAX(CASE WHEN action='bank_rob' THEN CAST(strftime('%s', date) AS INTEGER) END),
+               SUM(CASE action WHEN 'generosity_add' THEN COALESCE(amount,0)
+                               WHEN 'generosity_pay_points' THEN -COALESCE(amount,0)
+                               ELSE 0 END)
+        FROM history
+        WHERE user_id IS NOT NULL
+          AND action IN ('salary_claim','theft','bank_rob','generosity_add','generosity_pay_points')
+        GROUP BY user_id
+    """, (SALARY_STATE_CODE,))
+
+@_migration(11)
+async def _m11_history_ts(db):
+    await _add_column(db, "history", "ts", "INTEGER")
+    # бэкфилл пачками по id, чтобы не держать одну огромную запись
+    last_id = 0
+    while True:
+        async with db.execute(
+            "SELECT MAX(id) FROM (SELECT id FROM history WHERE id > ? ORDER BY id LIMIT ?)",
+            (last_id, BACKFILL_BATCH),
+        ) as cur:
+            hi = (await cur.fetchone())[0]
+        if hi is None:
+            break
+        await db.execute(
+            "UPDATE history SET ts = CAST(strftime('%s', date) AS INTEGER) WHERE id > ? AND id <= ? AND ts IS NULL",
+            (last_id, hi),
+        )
+        last_id = hi
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_history_action_ts ON history(action, ts)")
+
+@_migration(12)
+async def _m12_action_codes(db):
+    await db.execute(CREATE_ACTIONS)
+    await db.execute(CREATE_HISTORY_LOG)
+    # config_str:<key> — по действию на ключ; сводим к одному 'config_str'
+    # (ключ в reason, значение в payload), как у целочисленного 'config'
+    await db.execute("""
+        UPDATE history SET payload = COALESCE(payload, reason), reason = substr(action, 12), action = 'config_str'
+        WHERE substr(action, 1, 11) = 'config_str:'
+    """)
+    await db.execute("""
+        INSERT OR IGNORE INTO actions (name)
+        SELECT DISTINCT action FROM history WHERE action IS NOT NULL ORDER BY action
+    """)
+    await db.execute("""
+        INSERT INTO history_log (id, user_id, action_id, amount, reason, date, chat_id, ref_id, perk_code, payload, ts)
+        SELECT h.id, h.user_id, a.id, h.amount, h.reason, h.date, h.chat_id, h.ref_id, h.perk_code, h.payload, h.ts
+        FROM history h LEFT JOIN actions a ON a.name = h.action
+        ORDER BY h.id
+    """)
+    # счётчик AUTOINCREMENT переносим как есть: id удалённых строк не переиспользуем.
+    # У sqlite_sequence нет ключа по name — INSERT OR REPLACE добавил бы вторую строку
+    async with db.execute(
+        "SELECT MAX(seq) FROM sqlite_sequence WHERE name IN ('history', 'history_log')"
+    ) as cur:
+        seq = (await cur.fetchone())[0]
+    if seq is not None:
+        cur = await db.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'history_log'", (seq,))
+        if cur.rowcount == 0:
+            await db.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('history_log', ?)", (seq,))
+    await db.execute("DROP TABLE history")
+    await db.execute(CREATE_HISTORY_VIEW)
+    await db.execute(CREATE_HISTORY_VIEW_INSERT)
+    for name, cols in HISTORY_LOG_INDEXES:
+        await db.execute(f"CREATE INDEX IF NOT EXISTS {name} ON history_log({cols})")
+
+@_migration(13)
+async def _m13_running_balances(db):
+    await _add_column(db, "history_log", "balance_after", "INTEGER")
+    await _add_column(db, "history_log", "cell_after", "INTEGER")
+    # триггер INSTEAD OF удаляется вместе с представлением
+    await db.execute("DROP VIEW IF EXISTS history")
+    await db.execute(CREATE_HISTORY_VIEW)
+    await db.execute(CREATE_HISTORY_VIEW_INSERT)
+    for name, cols, where in CHAIN_INDEXES:
+        await db.execute(f"CREATE INDEX IF NOT EXISTS {name} ON history_log({cols}) WHERE {where}")
+    await _chain_backfill(db)
+
+@_migration(14)
+async def _m14_epochs(db):
+    await db.execute(CREATE_EPOCHS)
+    await _add_column(db, "users", "epoch", "INTEGER NOT NULL DEFAULT 0")
+
+# ------- коды действий history -------
+# name -> id; новые коды попадают в словарь только после COMMIT
+_ACTION_IDS: Dict[str, int] = {}
+
+async def _load_action_ids():
+    async with _reader() as db:
+        async with db.execute("SELECT name, id FROM actions") as cur:
+            rows = await cur.fetchall()
+    _ACTION_IDS.clear()
+    _ACTION_IDS.update((name, int(aid)) for name, aid in rows)
+
+# ------- эпохи -------
+# Граница последнего обнуления клуба: запросы состояния по history смотрят
+# только строки после неё (id > since_id).
+_CLUB: Dict[str, int] = {"epoch": 0, "since_id": 0}
+
+async def _load_club_epoch():
+    async with _reader() as db:
+        async with db.execute(
+            "SELECT id, COALESCE(history_id, 0) FROM epochs WHERE kind = 'club' ORDER BY id DESC LIMIT 1"
+        ) as cur:
+            row = await cur.fetchone()
+    _CLUB.update(epoch=int(row[0]) if row else 0, since_id=int(row[1]) if row else 0)
+
+def _club_since() -> int:
+    return _CLUB["since_id"]
+
+async def _epoch_open(db, kind: str, history_id: Optional[int]) -> int:
+    async with db.execute(
+        f"INSERT INTO epochs (kind, history_id, ts) VALUES (?, ?, {SQL_NOW_TS}) RETURNING id",
+        (kind, history_id),
+    ) as cur:
+        return int((await cur.fetchone())[0])
+
+async def get_epoch_stats() -> Dict[str, Any]:
+    """Текущие эпохи и сколько строк users ещё не переведено в текущую."""
+    async with _reader() as db:
+        async with db.execute(f"""
+            SELECT {SQL_CUR_EPOCH},
+                   (SELECT COUNT(*) FROM epochs WHERE kind = 'balances'),
+                   (SELECT COUNT(*) FROM epochs WHERE kind = 'club'),
+                   (SELECT COUNT(*) FROM users WHERE epoch < {SQL_CUR_EPOCH})
+        """) as cur:
+            cur_id, n_bal, n_club, stale = await cur.fetchone()
+    return {"epoch": int(cur_id), "balance_resets": int(n_bal), "club_resets": int(n_club),
+            "club_since_id": _club_since(), "stale_users": int(stale)}
+
+async def _action_id(db, name: str) -> int:
+    aid = _ACTION_IDS.get(name)
+    if aid is not None:
+        return aid
+    async with db.execute("""
+        INSERT INTO actions (name) VALUES (?)
+        ON CONFLICT(name) DO UPDATE SET name = excluded.name
+        RETURNING id
+    """, (name,)) as cur:
+        aid = int((await cur.fetchone())[0])
+    _after_commit(lambda: _ACTION_IDS.__setitem__(name, aid))
+    return aid
 
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA journal_mode=WAL;")
-        await db.execute("PRAGMA synchronous=NORMAL;")
-        await db.execute("PRAGMA foreign_keys = ON")
-        async with db.execute("PRAGMA user_version") as cur:
+    await _get_pool()
+    await _migrate()
+    await _load_action_ids()
+    await _load_club_epoch()
+    await _cfg_cache()
+    await bus_catch_up()
+    await _load_update_hwm()
+    async with _reader() as db:
+        if not await _schema_ok(db):
+            logging.error("db: unexpected schema in %s (check PRAGMA table_info)", DB_PATH)
+    slow = await check_query_plans()
+    if slow:
+        logging.warning("db: hot queries without index: %s", ", ".join(slow))
+
+# ------- проверка планов горячих запросов -------
+# (имя, запрос, параметры): всё, что бот дёргает на каждое сообщение/ставку.
+HOT_QUERIES: List[Tuple[str, str, tuple]] = [
+    ("config", "SELECT int_value, str_value FROM config WHERE key=?", ("k",)),
+    ("perks", "SELECT perk_code FROM user_perks WHERE user_id=?", (0,)),
+    ("has_perk", "SELECT 1 FROM user_perks WHERE user_id=? AND perk_code=?", (0, "щит")),
+    ("msg_dedupe", "SELECT 1 FROM msg_dedupe WHERE chat_id=? AND message_id=?", (0, 0)),
+    ("user_state", "SELECT last_theft_ts FROM user_state WHERE user_id=?", (0,)),
+    ("salary_cd", "SELECT ts FROM history WHERE user_id=? AND action='salary_claim' AND reason=? ORDER BY id DESC LIMIT 1", (0, "зп")),
+    ("cell", "SELECT balance, last_ts FROM cells WHERE user_id=?", (0,)),
+    ("cells_due", "SELECT MIN(last_ts) FROM cells", ()),
+    ("turnover", "SELECT SUM(amount) FROM history_log WHERE action_id IN "
+                 "(SELECT id FROM actions WHERE name IN ('perk_buy','emerald_buy','offer_sold')) AND ts >= ?", (0,)),
+    ("offers_closed", "SELECT 1 FROM history_log WHERE action_id IN "
+                      "(SELECT id FROM actions WHERE name IN ('offer_cancel','offer_sold')) AND ref_id=?", (0,)),
+    ("vault_init", "SELECT id, reason FROM history WHERE action='vault_init' ORDER BY id DESC LIMIT 1", ()),
+    ("economy", "SELECT cap, burned, circulating, bank_total, epoch_id FROM economy_state WHERE id=1", ()),
+    ("bravo", "SELECT COUNT(1) FROM history WHERE action='bravo_claim' AND chat_id=? AND ref_id=?", (0, 0)),
+    ("hero", "SELECT user_id, payload FROM history WHERE action='hero_set' AND chat_id=? ORDER BY id DESC LIMIT 20", (0,)),
+    ("codeword", "SELECT id, payload FROM history WHERE action='codeword_set' AND chat_id=? ORDER BY id DESC LIMIT 20", (0,)),
+    ("escrow_owner", "SELECT user_id, perk_code FROM perk_escrow WHERE offer_id=?", (0,)),
+    ("escrow_total", "SELECT COUNT(*) FROM perk_escrow WHERE perk_code=?", ("щит",)),
+    ("perk_credits", "SELECT credits FROM perk_credits WHERE user_id=? AND perk_code=?", (0, "щит")),
+    ("perk_holders", "SELECT user_id FROM user_perks WHERE perk_code=?", ("щит",)),
+    ("balance_at", "SELECT ts, id, balance_after FROM history_log WHERE user_id=? AND balance_after IS NOT NULL "
+                   "AND (ts < ? OR (ts = ? AND id < ?)) ORDER BY ts DESC, id DESC LIMIT 1", (0, 0, 0, 0)),
+    ("cell_at", "SELECT ts, id, cell_after FROM history_log WHERE user_id=? AND cell_after IS NOT NULL "
+                "AND (ts < ? OR (ts = ? AND id < ?)) ORDER BY ts DESC, id DESC LIMIT 1", (0, 0, 0, 0)),
+]
+
+_PLAN_REPORT: Dict[str, str] = {}
+
+async def check_query_plans() -> List[str]:
+    """
+    EXPLAIN QUERY PLAN по HOT_QUERIES. Возвращает имена запросов,
+    которые читают таблицу полным сканом (без поиска по индексу).
+    """
+    slow = []
+    async with _reader() as db:
+        # EXPLAIN не читает базу и не замечает смену схемы — обновим её явно
+        async with db.execute("SELECT COUNT(*) FROM sqlite_master"):
+            pass
+        for name, sql, params in HOT_QUERIES:
+            async with db.execute("EXPLAIN QUERY PLAN " + sql, params) as cur:
+                rows = await cur.fetchall()
+            details = [str(r[-1]) for r in rows]
+            _PLAN_REPORT[name] = "; ".join(details)
+            if any(d.startswith("SCAN ") for d in details):
+                slow.append(name)
+    return slow
+
+def get_query_plan_report() -> Dict[str, str]:
+    return dict(_PLAN_REPORT)
+
+# ------- утилиты -------
+
+def _json_or_none(payload) -> Optional[str]:
+    if payload is None:
+        return None
+    if isinstance(payload, str):
+        return payload
+    return json.dumps(payload, ensure_ascii=False)
+
+async def _history_add(db, user_id: Optional[int], action: str, amount: Optional[int], reason: Optional[str],
+                       chat_id: Optional[int] = None, ref_id: Optional[int] = None,
+                       perk_code: Optional[str] = None, payload=None,
+                       balance_after: Optional[int] = None, cell_after: Optional[int] = None) -> int:
+    payload = _json_or_none(payload)
+    async with db.execute(
+        f"""INSERT INTO history_log (user_id, action_id, amount, reason, chat_id, ref_id, perk_code, payload, ts,
+                                     balance_after, cell_after)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, {SQL_NOW_TS}, ?, ?)
+           RETURNING id, date, ts""",
+        (user_id, await _action_id(db, action), amount, reason, chat_id, ref_id, perk_code, payload,
+         balance_after, cell_after),
+    ) as cur:
+        hid, date, ts = await cur.fetchone()
+    if user_id is not None and action in _USER_STATE_ACTIONS:
+        await _user_state_apply(db, user_id, action, amount, reason)
+    if action in _SUBSCRIBERS:
+        ev = HistoryEvent(int(hid), user_id, action, amount, reason, date, chat_id, ref_id, perk_code, payload, ts)
+        _after_commit(lambda: _publish(ev))
+    return int(hid)
+
+# ------- шина событий: history -> проекции в памяти -------
+# Каждое закоммиченное событие из _history_add уходит подписанным проекциям
+# (после COMMIT, в порядке id). На старте и после сбоя обработчика проекция
+# догоняется из history с последнего применённого id (bus_catch_up), а пока
+# она не готова, читатели идут в базу как раньше. Массовые INSERT ... SELECT
+# (cell_fee, cell_wd при ограблении) мимо шины — на них никто не подписан.
+
+class HistoryEvent(NamedTuple):
+    id: int
+    user_id: Optional[int]
+    action: str
+    amount: Optional[int]
+    reason: Optional[str]
+    date: Optional[str]
+    chat_id: Optional[int]
+    ref_id: Optional[int]
+    perk_code: Optional[str]
+    payload: Optional[str]
+    ts: Optional[int]
+
+class _Projection:
+    __slots__ = ("name", "actions", "apply", "reset", "last_id", "ready", "pending", "applied", "errors")
+
+    def __init__(self, name: str, actions: Tuple[str, ...], apply: Callable, reset: Callable):
+        self.name = name
+        self.actions = actions + (CLUB_RESET_ACTION,)  # обнуление клуба сбрасывает любую проекцию
+        self.apply = apply
+        self.reset = reset
+        self.last_id = 0
+        self.ready = False
+        self.pending: List[HistoryEvent] = []  # события, пришедшие во время догонки
+        self.applied = 0
+        self.errors = 0
+
+    def feed(self, ev: HistoryEvent):
+        if ev.id <= self.last_id:
+            return
+        try:
+            if ev.action == CLUB_RESET_ACTION:
+                self.reset()
+            else:
+                self.apply(ev)
+        except Exception:
+            # состояние могло разойтись — пересоберём с нуля при следующей догонке
+            self.errors += 1
+            self.ready = False
+            self.last_id = 0
+            self.pending.clear()
+            logging.exception("projection %s failed on event #%s", self.name, ev.id)
+            return
+        self.last_id = ev.id
+        self.applied += 1
+
+BUS_CATCH_UP_SEC = 60  # как часто обслуживание пересобирает упавшие проекции
+
+_PROJECTIONS: Dict[str, _Projection] = {}
+_SUBSCRIBERS: Dict[str, List[_Projection]] = {}
+
+def _projection(name: str, actions: Tuple[str, ...], reset: Callable):
+    """Регистрирует обработчик apply(ev) проекции name для событий actions."""
+    def deco(fn):
+        proj = _Projection(name, actions, fn, reset)
+        _PROJECTIONS[name] = proj
+        for a in proj.actions:
+            _SUBSCRIBERS.setdefault(a, []).append(proj)
+        return fn
+    return deco
+
+def _publish(ev: HistoryEvent):
+    for proj in _SUBSCRIBERS.get(ev.action, ()):
+        if proj.ready:
+            proj.feed(ev)
+        else:
+            proj.pending.append(ev)
+
+def _proj_ready(name: str) -> bool:
+    return _PROJECTIONS[name].ready
+
+async def bus_catch_up() -> Dict[str, int]:
+    """Догнать неготовые проекции из history. Вернёт {имя: применено событий}."""
+    done = {}
+    for proj in _PROJECTIONS.values():
+        if proj.ready:
+            continue
+        if proj.last_id == 0:
+            proj.reset()
+        n0 = proj.applied
+        marks = ",".join("?" * len(proj.actions))
+        while True:
+            async with _reader() as db:
+                async with db.execute(f"""
+                    SELECT h.id, h.user_id, a.name, h.amount, h.reason, h.date, h.chat_id,
+                           h.ref_id, h.perk_code, h.payload, h.ts
+                    FROM history_log h JOIN actions a ON a.id = h.action_id
+                    WHERE h.action_id IN (SELECT id FROM actions WHERE name IN ({marks})) AND h.id > ?
+                    ORDER BY h.id LIMIT ?
+                """, (*proj.actions, proj.last_id, BACKFILL_BATCH)) as cur:
+                    rows = await cur.fetchall()
+            for r in rows:
+                proj.feed(HistoryEvent(*r))
+            if len(rows) < BACKFILL_BATCH:
+                break
+        # всё, что закоммитилось, пока читали, — по порядку, без повторов
+        pending, proj.pending = sorted(proj.pending), []
+        for ev in pending:
+            proj.feed(ev)
+        proj.ready = True
+        done[proj.name] = proj.applied - n0
+    return done
+
+def _bus_reset():
+    for proj in _PROJECTIONS.values():
+        proj.ready = False
+        proj.last_id = 0
+        proj.pending.clear()
+        proj.reset()
+
+def get_bus_stats() -> Dict[str, Any]:
+    return {
+        p.name: f"{'ok' if p.ready else 'догоняет'}, id≤{p.last_id}, событий {p.applied}, ошибок {p.errors}"
+        for p in _PROJECTIONS.values()
+    }
+
+# событие history -> (колонка user_state, накопительная ли)
+_USER_STATE_ACTIONS: Dict[str, Tuple[str, bool]] = {
+    "salary_claim":          ("last_salary_ts", False),
+    "theft":                 ("last_theft_ts", False),
+    "bank_rob":              ("last_bank_rob_ts", False),
+    "generosity_add":        ("generosity_points", True),
+    "generosity_pay_points": ("generosity_points", True),
+}
+
+async def _user_state_apply(db, user_id: int, action: str, amount: Optional[int], reason: Optional[str]):
+    col, additive = _USER_STATE_ACTIONS[action]
+    if additive:
+        delta = int(amount or 0) * (-1 if action == "generosity_pay_points" else 1)
+        await db.execute(f"""
+            INSERT INTO user_state (user_id, {col}) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET {col} = {col} + excluded.{col}
+        """, (user_id, delta))
+        return
+    if action == "salary_claim" and reason != SALARY_STATE_CODE:
+        return
+    await db.execute(f"""
+        INSERT INTO user_state (user_id, {col}) VALUES (?, {SQL_NOW_TS})
+        ON CONFLICT(user_id) DO UPDATE SET {col} = excluded.{col}
+    """, (user_id,))
+
+async def _user_state_since(user_id: int, col: str) -> int | None:
+    async with _reader() as db:
+        async with db.execute(
+            f"SELECT {SQL_NOW_TS} - {col} FROM user_state WHERE user_id=?",
+            (user_id,),
+        ) as cur:
             row = await cur.fetchone()
-        current_ver = row[0] if row else 0
+    return None if row is None or row[0] is None else int(row[0])
+
+async def insert_history(user_id: Optional[int], action: str, amount: Optional[int], reason: Optional[str],
+                         *, chat_id: Optional[int] = None, ref_id: Optional[int] = None,
+                         perk_code: Optional[str] = None, payload=None) -> int:
+    async with _writer() as db:
+        return await _history_add(db, user_id, action, amount, reason, chat_id, ref_id, perk_code, payload)
+
+def _payload(raw: Optional[str]) -> dict:
+    if not raw:
+        return {}
+    try:
+        data = json.loads(raw)
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
 
-        await db.execute(CREATE_USERS)
-        await db.execute(CREATE_ROLES)
-        await db.execute(CREATE_HISTORY)
-        await db.commit()
+# ------- пакетные загрузчики (DataLoader) -------
+# Точечные чтения (баланс, ключ, перки, роль), запрошенные в одном такте цикла
+# событий, склеиваются в один запрос WHERE user_id IN (...) на таблицу.
+# Внутри request_scope() (один апдейт) результаты запоминаются; любой COMMIT
+# сбрасывает запомненное. Внутри _writer() загрузчик не используется — там
+# читаем своё незакоммиченное напрямую.
 
-        if current_ver != SCHEMA_VERSION or not await _schema_ok(db):
-            await _recreate_all(db)
+LOADER_MAX_KEYS = 500  # не больше ключей в одном IN (...)
 
-# ------- утилиты -------
+_LOAD_GEN = 0  # растёт после каждого COMMIT
+_LOAD_SCOPE: ContextVar[Optional[dict]] = ContextVar("db_load_scope", default=None)
 
-async def insert_history(user_id: Optional[int], action: str, amount: Optional[int], reason: Optional[str]) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO history (user_id, action, amount, reason) VALUES (?, ?, ?, ?)",
-            (user_id, action, amount, reason),
+def _loaders_invalidate():
+    global _LOAD_GEN
+    _LOAD_GEN += 1
+
+@contextmanager
+def request_scope():
+    """Область запоминания точечных чтений — на время обработки одного апдейта."""
+    token = _LOAD_SCOPE.set({"gen": _LOAD_GEN})
+    try:
+        yield
+    finally:
+        _LOAD_SCOPE.reset(token)
+
+async def _fetch_in(db, sql: str, collect, keys: list) -> dict:
+    """sql с {marks} по частям не длиннее LOADER_MAX_KEYS; collect: rows -> dict."""
+    out = {}
+    for i in range(0, len(keys), LOADER_MAX_KEYS):
+        part = keys[i:i + LOADER_MAX_KEYS]
+        async with db.execute(sql.format(marks=",".join("?" * len(part))), part) as cur:
+            out.update(collect(await cur.fetchall()))
+    return out
+
+class _Loader:
+    def __init__(self, name: str, sql: str, collect):
+        self.name = name
+        self.sql = sql          # с {marks} вместо списка ключей
+        self.collect = collect  # rows -> {user_id: value}
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.stats = {"requests": 0, "memo_hits": 0, "coalesced": 0, "queries": 0, "keys": 0}
+
+    async def _fetch(self, db, keys: list) -> dict:
+        self.stats["queries"] += (len(keys) + LOADER_MAX_KEYS - 1) // LOADER_MAX_KEYS
+        return await _fetch_in(db, self.sql, self.collect, keys)
+
+    async def load(self, user_id: int):
+        user_id = int(user_id)
+        self.stats["requests"] += 1
+        db = _current_tx()
+        if db is not None:
+            return (await self._fetch(db, [user_id])).get(user_id)
+        scope = _LOAD_SCOPE.get()
+        if scope is not None:
+            if scope["gen"] != _LOAD_GEN:
+                scope.clear()
+                scope["gen"] = _LOAD_GEN
+            key = (self.name, user_id)
+            if key in scope:
+                self.stats["memo_hits"] += 1
+                return scope[key]
+        fut = self.pending.get(user_id)
+        if fut is None:
+            if not self.pending:
+                asyncio.get_running_loop().call_soon(self._dispatch)
+            fut = self.pending[user_id] = asyncio.get_running_loop().create_future()
+        else:
+            self.stats["coalesced"] += 1
+        # shield: отмена одного ожидающего не должна отменять общий результат
+        value = await asyncio.shield(fut)
+        if scope is not None:
+            scope[(self.name, user_id)] = value
+        return value
+
+    def _dispatch(self):
+        batch, self.pending = self.pending, {}
+        if batch:
+            asyncio.get_running_loop().create_task(self._run(batch), name=f"db-loader-{self.name}")
+
+    async def _run(self, batch: Dict[int, asyncio.Future]):
+        try:
+            async with _reader() as db:
+                found = await self._fetch(db, list(batch))
+        except BaseException as e:
+            for fut in batch.values():
+                if not fut.done():
+                    fut.set_exception(e if isinstance(e, Exception) else RuntimeError("db loader cancelled"))
+            if not isinstance(e, Exception):
+                raise
+            return
+        self.stats["keys"] += len(batch)
+        for uid, fut in batch.items():
+            if not fut.done():
+                fut.set_result(found.get(uid))
+
+def _perk_rows(rows) -> dict:
+    out: Dict[int, frozenset] = {}
+    for uid, code in rows:
+        out[uid] = out.get(uid, frozenset()) | {code}
+    return out
+
+_USERS_LOADER = _Loader(
+    "users", f"SELECT user_id, {SQL_BALANCE}, key FROM users WHERE user_id IN ({{marks}})",
+    lambda rows: {uid: (bal, key) for uid, bal, key in rows},
+)
+_PERKS_LOADER = _Loader(
+    "perks", "SELECT user_id, perk_code FROM user_perks WHERE user_id IN ({marks})", _perk_rows,
+)
+_ROLES_LOADER = _Loader(
+    "roles", "SELECT user_id, role_name, role_desc, role_image FROM roles WHERE user_id IN ({marks})",
+    lambda rows: {r[0]: tuple(r[1:]) for r in rows},
+)
+_LOADERS = (_USERS_LOADER, _PERKS_LOADER, _ROLES_LOADER)
+
+def get_loader_stats() -> Dict[str, Any]:
+    """Сколько точечных запросов сэкономили загрузчики (для команды «метрики»)."""
+    out: Dict[str, Any] = {}
+    for ld in _LOADERS:
+        st = ld.stats
+        out[ld.name] = (
+            f"{st['requests']} чтений → {st['queries']} запросов "
+            f"(из памяти {st['memo_hits']}, склеено {st['coalesced']})"
         )
-        await db.commit()
-        async with db.execute("SELECT last_insert_rowid()") as cur:
-            rid = await cur.fetchone()
-            return int(rid[0])
+    total = sum(ld.stats["requests"] for ld in _LOADERS)
+    out["saved_queries"] = total - sum(ld.stats["queries"] for ld in _LOADERS)
+    return out
 
-# ------- баланс -------
+# ------- пакетные чтения по списку пользователей -------
+# Один запрос на таблицу вместо цикла по точечным хелперам. Ключи — все
+# переданные user_id (у кого нет строки — значение по умолчанию).
+
+def _uid_list(user_ids) -> list:
+    return sorted({int(u) for u in user_ids if u is not None})
+
+async def get_balances(user_ids) -> Dict[int, int]:
+    ids = _uid_list(user_ids)
+    async with _reader() as db:
+        found = await _fetch_in(db, _USERS_LOADER.sql, _USERS_LOADER.collect, ids)
+    return {u: int(found[u][0]) if u in found else 0 for u in ids}
+
+async def get_perks_bulk(user_ids) -> Dict[int, set]:
+    ids = _uid_list(user_ids)
+    async with _reader() as db:
+        found = await _fetch_in(db, _PERKS_LOADER.sql, _PERKS_LOADER.collect, ids)
+    return {u: set(found.get(u, ())) for u in ids}
+
+async def get_roles_bulk(user_ids) -> Dict[int, Optional[tuple]]:
+    """{user_id: (role_name, role_desc, role_image) или None}."""
+    ids = _uid_list(user_ids)
+    async with _reader() as db:
+        found = await _fetch_in(db, _ROLES_LOADER.sql, _ROLES_LOADER.collect, ids)
+    return {u: found.get(u) for u in ids}
+
+def _credit_rows(rows) -> dict:
+    out: Dict[int, Dict[str, int]] = {}
+    for uid, code, credits in rows:
+        out.setdefault(uid, {})[code] = int(credits)
+    return out
+
+async def get_perk_credits_bulk(user_ids) -> Dict[int, Dict[str, int]]:
+    """{user_id: {perk_code: ваучеры}} — только положительные остатки."""
+    ids = _uid_list(user_ids)
+    async with _reader() as db:
+        found = await _fetch_in(
+            db, "SELECT user_id, perk_code, credits FROM perk_credits WHERE credits > 0 AND user_id IN ({marks})",
+            _credit_rows, ids,
+        )
+    return {u: found.get(u, {}) for u in ids}
+
+# ------- кэш балансов -------
+# Балансы читаются чаще всего остального, поэтому держим их в памяти процесса:
+# LRU на BALANCE_CACHE_MAX пользователей, заполняется лениво при чтении.
+# Запись — write-through: каждое изменение users.balance ставит колбэк
+# _after_commit с новым значением, кэш меняется только после COMMIT.
+# _BAL_GEN защищает ленивую загрузку от гонки с записью (как _CFG_GEN).
+# Внутри _writer() кэш не используется — там читаем своё незакоммиченное.
+
+BALANCE_CACHE_MAX = 20000
+BALANCE_CHECK_SEC = 900  # период фоновой самопроверки кэша
+
+_BAL: "OrderedDict[int, int]" = OrderedDict()
+_BAL_GEN = 0
+_BAL_STATS = {
+    "hits": 0, "misses": 0, "evictions": 0, "writes": 0,
+    "check_runs": 0, "check_mismatches": 0, "check_last_ts": 0,
+}
+
+def _bal_cache_reset():
+    global _BAL_GEN
+    _BAL.clear()
+    _BAL_GEN += 1
+
+def _bal_store(user_id: int, balance: int):
+    _BAL[user_id] = balance
+    _BAL.move_to_end(user_id)
+    while len(_BAL) > BALANCE_CACHE_MAX:
+        _BAL.popitem(last=False)
+        _BAL_STATS["evictions"] += 1
+
+def _bal_put(user_id: int, balance: int):
+    global _BAL_GEN
+    _BAL_GEN += 1
+    _BAL_STATS["writes"] += 1
+    _bal_store(int(user_id), int(balance))
+
+def _bal_zero_all():
+    global _BAL_GEN
+    _BAL_GEN += 1
+    for uid in _BAL:
+        _BAL[uid] = 0
 
 async def get_balance(user_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)) as cur:
+    user_id = int(user_id)
+    db = _current_tx()
+    if db is not None:
+        async with db.execute(f"SELECT {SQL_BALANCE} FROM users WHERE user_id = ?", (user_id,)) as cur:
             row = await cur.fetchone()
-            return row[0] if row else 0
+        return row[0] if row else 0
+    bal = _BAL.get(user_id)
+    if bal is not None:
+        _BAL.move_to_end(user_id)
+        _BAL_STATS["hits"] += 1
+        return bal
+    _BAL_STATS["misses"] += 1
+    gen = _BAL_GEN
+    row = await _USERS_LOADER.load(user_id)
+    bal = int(row[0]) if row else 0
+    if gen == _BAL_GEN:
+        _bal_store(user_id, bal)
+    return bal
+
+async def balance_cache_check(fix: bool = True) -> Dict[str, Any]:
+    """
+    Сверить кэш с таблицей users. Расхождения пишем в лог и (fix) выбрасываем
+    из кэша. Если во время чтения прошла запись баланса — повторяем.
+    """
+    for _ in range(3):
+        gen = _BAL_GEN
+        snapshot = dict(_BAL)
+        async with _reader() as db:
+            found = await _fetch_in(db, _USERS_LOADER.sql, _USERS_LOADER.collect, list(snapshot))
+        if gen == _BAL_GEN:
+            break
+    else:
+        return {"skipped": "балансы меняются слишком часто"}
+    bad = {
+        uid: (cached, int(found[uid][0]) if uid in found else 0)
+        for uid, cached in snapshot.items()
+        if cached != (int(found[uid][0]) if uid in found else 0)
+    }
+    _BAL_STATS["check_runs"] += 1
+    _BAL_STATS["check_last_ts"] = int(time.time())
+    _BAL_STATS["check_mismatches"] += len(bad)
+    if bad:
+        logging.warning("balance cache: %s mismatches, e.g. %s", len(bad), list(bad.items())[:5])
+        if fix:
+            for uid in bad:
+                _BAL.pop(uid, None)
+    return bad
+
+def get_balance_cache_stats() -> Dict[str, Any]:
+    n = _BAL_STATS["hits"] + _BAL_STATS["misses"]
+    return {
+        "size": f"{len(_BAL)}/{BALANCE_CACHE_MAX}",
+        **_BAL_STATS,
+        "hit_rate": f"{100 * _BAL_STATS['hits'] / n:.1f}%" if n else "—",
+    }
+
+# ------- баланс -------
 
 async def ensure_user(db, user_id: int):
-    async with db.execute("SELECT 1 FROM users WHERE user_id=?", (user_id,)) as cur:
-        if await cur.fetchone() is None:
-            await db.execute("INSERT INTO users (user_id, username, balance, key) VALUES (?, NULL, 0, 0)", (user_id,))
+    # заодно переводим строку в текущую эпоху: баланс прошлой эпохи — 0
+    await db.execute(f"""
+        INSERT INTO users (user_id, username, balance, key, epoch) VALUES (?, NULL, 0, 0, {SQL_CUR_EPOCH})
+        ON CONFLICT(user_id) DO UPDATE SET balance = 0, epoch = excluded.epoch
+        WHERE users.epoch < excluded.epoch
+    """, (user_id,))
 
 async def change_balance(user_id: int, amount: int, reason: str, author_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _writer() as db:
         await ensure_user(db, user_id)
 
         bl = await get_blacklist()
         if amount > 0 and int(user_id) in bl:
-            await db.execute(
-                "INSERT INTO history (user_id, action, amount, reason) VALUES (?, 'blocked_blacklist', ?, ?)",
-                (user_id, amount, reason)
-            )
-            await db.commit()
+            await _history_add(db, user_id, "blocked_blacklist", amount, reason)
             return False
 
         async with db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)) as cur:
@@ -142,26 +1649,144 @@ async def change_balance(user_id: int, amount: int, reason: str, author_id: int)
         if new_balance < 0:
             new_balance = 0
         await db.execute("UPDATE users SET balance = ? WHERE user_id = ?", (new_balance, user_id))
-        await db.execute(
-            "INSERT INTO history (user_id, action, amount, reason) VALUES (?, 'change_balance', ?, ?)",
-            (user_id, amount, reason),
-        )
-        await db.commit()
+        await _econ_add(db, circulating=new_balance - current_balance)
+        await _history_add(db, user_id, "change_balance", amount, reason, balance_after=new_balance)
+        _after_commit(lambda: _bal_put(user_id, new_balance))
         return True
 
 
 async def reset_user_balance(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET balance = 0 WHERE user_id = ?", (user_id,))
-        await db.execute("INSERT INTO history (user_id, action, amount, reason) VALUES (?, 'reset_balance', 0, NULL)", (user_id,))
-        await db.commit()
+    async with _writer() as db:
+        async with db.execute(f"SELECT {SQL_BALANCE} FROM users WHERE user_id = ?", (user_id,)) as cur:
+            row = await cur.fetchone()
+        await db.execute(f"UPDATE users SET balance = 0, epoch = {SQL_CUR_EPOCH} WHERE user_id = ?", (user_id,))
+        await _econ_add(db, circulating=-int(row[0] if row else 0))
+        await _history_add(db, user_id, "reset_balance", 0, None, balance_after=0)
+        _after_commit(lambda: _bal_put(user_id, 0))
 
 async def reset_all_balances():
-    # Сбрасываем всем, пишем сводную запись в history (user_id=NULL)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET balance = 0")
-        await db.execute("INSERT INTO history (user_id, action, amount, reason) VALUES (NULL, 'reset_all_balances', NULL, NULL)")
-        await db.commit()
+    # Новая эпоха балансов вместо UPDATE по всем users: старые балансы читаются
+    # как 0 (SQL_BALANCE). Сводная запись в history (user_id=NULL) — граница эпохи.
+    async with _writer() as db:
+        hid = await _history_add(db, None, "reset_all_balances", None, None)
+        await _epoch_open(db, "balances", hid)
+        await db.execute("UPDATE economy_state SET circulating = 0 WHERE id = 1")
+        _after_commit(_bal_zero_all)
+
+# таблицы состояния, которые обнуление клуба очищает целиком (они невелики)
+CLUB_RESET_TABLES = ("roles", "user_perks", "perk_credits", "perk_escrow", "cells", "user_state", "config")
+
+async def club_reset(author_id: Optional[int]) -> int:
+    """
+    Обнулить клуб одной транзакцией вместо удаления файла базы и перезапуска:
+    новая эпоха балансов, очищенные таблицы состояния и граница club_reset,
+    после которой запросы по history не видят прошлого. Журнал, дедуп
+    сообщений и служебные значения сохраняются. Вернёт id строки club_reset.
+    """
+    async with _writer() as db:
+        hid = await _history_add(db, None, CLUB_RESET_ACTION, None, None, payload={"by": author_id})
+        epoch = await _epoch_open(db, "club", hid)
+        for table in CLUB_RESET_TABLES:
+            await db.execute(f"DELETE FROM {table}")
+        await db.execute("UPDATE users SET key = 0 WHERE key <> 0")
+        await db.execute("""
+            UPDATE economy_state SET cap = NULL, burned = 0, circulating = 0, bank_total = 0, epoch_id = NULL
+            WHERE id = 1
+        """)
+        _after_commit(_cfg_cache_reset)
+        _after_commit(_bal_zero_all)
+        _after_commit(lambda: _CLUB.update(epoch=epoch, since_id=hid))
+    logging.warning("club reset by %s: epoch=%s history_id=%s", author_id, epoch, hid)
+    return hid
+
+# ------- атомарные движения денег -------
+# Проверка остатка и списание — одним UPDATE ... WHERE balance >= ?, история и
+# счётчики экономики — в том же COMMIT. Вместо get_balance + change_balance.
+
+class _Abort(Exception):
+    """Откат SAVEPOINT операции без ошибки для вызывающего."""
+
+async def _debit_tx(db, user_id: int, amount: int, reason: str) -> Optional[int]:
+    await ensure_user(db, user_id)
+    async with db.execute(
+        "UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ? RETURNING balance",
+        (amount, user_id, amount),
+    ) as cur:
+        row = await cur.fetchone()
+    if row is None:
+        return None
+    new_balance = int(row[0])
+    await _econ_add(db, circulating=-amount)
+    await _history_add(db, user_id, "change_balance", -amount, reason, balance_after=new_balance)
+    _after_commit(lambda: _bal_put(user_id, new_balance))
+    return new_balance
+
+async def _credit_tx(db, user_id: int, amount: int, reason: str, blacklist: set) -> Optional[int]:
+    await ensure_user(db, user_id)
+    if int(user_id) in blacklist:
+        await _history_add(db, user_id, "blocked_blacklist", amount, reason)
+        return None
+    async with db.execute(
+        "UPDATE users SET balance = balance + ? WHERE user_id = ? RETURNING balance", (amount, user_id)
+    ) as cur:
+        row = await cur.fetchone()
+    new_balance = int(row[0])
+    await _econ_add(db, circulating=amount)
+    await _history_add(db, user_id, "change_balance", amount, reason, balance_after=new_balance)
+    _after_commit(lambda: _bal_put(user_id, new_balance))
+    return new_balance
+
+async def debit_if_sufficient(user_id: int, amount: int, reason: str) -> Optional[int]:
+    """Списать amount, только если хватает. Вернёт новый баланс или None."""
+    if amount < 0:
+        raise ValueError("amount must be >= 0")
+    async with _writer() as db:
+        return await _debit_tx(db, user_id, amount, reason)
+
+async def transfer(from_id: int, to_id: int, amount: int, reason: str, reason_to: Optional[str] = None) -> bool:
+    """
+    Перевод from_id → to_id одной транзакцией. False — не хватило средств
+    или получатель в ЧС (тогда ничего не списано).
+    """
+    if amount <= 0:
+        return False
+    bl = await get_blacklist()
+    try:
+        async with _writer() as db:
+            async with _savepoint(db, "transfer"):
+                if await _debit_tx(db, from_id, amount, reason) is None:
+                    raise _Abort()
+                if int(to_id) in bl:
+                    raise _Abort()
+                await _credit_tx(db, to_id, amount, reason_to or reason, bl)
+    except _Abort:
+        return False
+    return True
+
+async def apply_movements(movements: List[Tuple[int, int, str]],
+                          burn: int = 0, burn_reason: Optional[str] = None) -> bool:
+    """
+    Пачка движений [(user_id, delta, reason), ...] (+ сжигание) — всё или ничего.
+    Списания условные: если кому-то не хватает, откатываются все движения и
+    возвращается False. Начисления игрокам из ЧС пропускаются (blocked_blacklist),
+    как в change_balance.
+    """
+    bl = await get_blacklist()
+    try:
+        async with _writer() as db:
+            async with _savepoint(db, "movements"):
+                # сначала списания: при нехватке откат до записи начислений
+                for uid, delta, reason in sorted(movements, key=lambda m: m[1] >= 0):
+                    if delta < 0:
+                        if await _debit_tx(db, uid, -delta, reason) is None:
+                            raise _Abort()
+                    elif delta > 0:
+                        await _credit_tx(db, uid, delta, reason, bl)
+                if burn > 0:
+                    await _burn_tx(db, burn, burn_reason or "")
+    except _Abort:
+        return False
+    return True
 
 # ------- роли -------
 
@@ -170,62 +1795,51 @@ async def set_role(user_id: int, role_name: str | None, role_desc: str | None):
     if int(user_id) in bl:
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _writer() as db:
         await db.execute("""
             INSERT INTO roles (user_id, role_name, role_desc, role_image)
             VALUES (?, ?, ?, COALESCE((SELECT role_image FROM roles WHERE user_id=?), NULL))
             ON CONFLICT(user_id) DO UPDATE SET role_name=excluded.role_name, role_desc=excluded.role_desc
         """, (user_id, role_name, role_desc, user_id))
-        await db.commit()
 
 async def get_role(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT role_name, role_desc FROM roles WHERE user_id = ?", (user_id,)) as cur:
-            row = await cur.fetchone()
-            if row:
-                return {"role": row[0], "description": row[1]}
-            return None
+    row = await _ROLES_LOADER.load(user_id)
+    if row:
+        return {"role": row[0], "description": row[1]}
+    return None
 
 async def set_role_image(user_id: int, image_file_id: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _writer() as db:
         await db.execute("""
             INSERT INTO roles (user_id, role_name, role_desc, role_image)
             VALUES (?, NULL, NULL, ?)
             ON CONFLICT(user_id) DO UPDATE SET role_image = excluded.role_image
         """, (user_id, image_file_id))
-        await db.commit()
 
 async def get_role_with_image(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT role_name, role_desc, role_image FROM roles WHERE user_id = ?", (user_id,)) as cur:
-            row = await cur.fetchone()
-            return row
+    return await _ROLES_LOADER.load(user_id)
 
 # ------- ключи -------
 
 async def grant_key(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _writer() as db:
         await ensure_user(db, user_id)
         await db.execute("UPDATE users SET key = 1 WHERE user_id = ?", (user_id,))
-        await db.execute("INSERT INTO history (user_id, action, amount, reason) VALUES (?, 'grant_key', NULL, NULL)", (user_id,))
-        await db.commit()
+        await _history_add(db, user_id, "grant_key", None, None)
 
 async def revoke_key(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _writer() as db:
         await db.execute("UPDATE users SET key = 0 WHERE user_id = ?", (user_id,))
-        await db.execute("INSERT INTO history (user_id, action, amount, reason) VALUES (?, 'revoke_key', NULL, NULL)", (user_id,))
-        await db.commit()
+        await _history_add(db, user_id, "revoke_key", None, None)
 
 async def has_key(user_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT key FROM users WHERE user_id = ?", (user_id,)) as cur:
-            row = await cur.fetchone()
-            return bool(row and row[0] == 1)
+    row = await _USERS_LOADER.load(user_id)
+    return bool(row and row[1] == 1)
 
 # ------- реестры/списки -------
 
 async def get_last_history(limit: int = 5):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _reader() as db:
         async with db.execute("""
             SELECT user_id, action, amount, reason, date
             FROM history ORDER BY id DESC LIMIT ?
@@ -233,17 +1847,17 @@ async def get_last_history(limit: int = 5):
             return await cur.fetchall()
 
 async def get_top_users(limit: int = 10):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
+    async with _reader() as db:
+        async with db.execute(f"""
             SELECT user_id, balance FROM users
-            WHERE balance > 0
+            WHERE balance > 0 AND epoch >= {SQL_CUR_EPOCH}
             ORDER BY balance DESC
             LIMIT ?
         """, (limit,)) as cur:
             return await cur.fetchall()
 
 async def get_all_roles():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _reader() as db:
         async with db.execute("""
             SELECT user_id, role_name FROM roles
             WHERE role_name IS NOT NULL AND TRIM(role_name) != ''
@@ -251,7 +1865,7 @@ async def get_all_roles():
             return await cur.fetchall()
 
 async def get_key_holders():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _reader() as db:
         async with db.execute("""
             SELECT user_id FROM users
             WHERE key = 1 ORDER BY user_id ASC
@@ -260,7 +1874,7 @@ async def get_key_holders():
             return [r[0] for r in rows]
 
 async def get_known_users() -> list[int]:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _reader() as db:
         async with db.execute("SELECT user_id FROM users") as cur:
             rows = await cur.fetchall()
             return [r[0] for r in rows]
@@ -286,7 +1900,7 @@ async def set_cleaned_users(uids: set[int]) -> None:
 
 
 
-# ------- перки через history -------
+# ------- перки: события в history + проекции user_perks / perk_credits / perk_escrow -------
 
 # ==== LEGACY ALIASES FOR PERK CODES ====
 PERK_ALIASES = {
@@ -304,77 +1918,45 @@ async def grant_perk(user_id: int, perk_code: str):
     bl = await get_blacklist()
     if int(user_id) in bl:
         return None
-    return await insert_history(user_id, "perk_grant", None, perk_code)
+    async with _writer() as db:
+        hid = await _history_add(db, user_id, "perk_grant", None, perk_code, perk_code=perk_code)
+        await db.execute(
+            "INSERT OR IGNORE INTO user_perks (user_id, perk_code) VALUES (?, ?)", (user_id, perk_code)
+        )
+        return hid
 
 
 async def revoke_perk(user_id: int, perk_code: str):
     perk_code = _normalize_perk_code(perk_code)
-    return await insert_history(user_id, "perk_revoke", None, perk_code)
+    async with _writer() as db:
+        hid = await _history_add(db, user_id, "perk_revoke", None, perk_code, perk_code=perk_code)
+        await db.execute("DELETE FROM user_perks WHERE user_id=? AND perk_code=?", (user_id, perk_code))
+        return hid
 
 async def get_perks(user_id: int) -> set[str]:
-    perks = set()
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT action, reason FROM history
-            WHERE user_id = ? AND action IN ('perk_grant','perk_revoke')
-            ORDER BY id ASC
-        """, (user_id,)) as cur:
-            rows = await cur.fetchall()
-    for action, code in rows:
-        if not code:
-            continue
-        code = _normalize_perk_code(code)
-        if action == "perk_grant":
-            perks.add(code)
-        else:
-            perks.discard(code)
-    return perks
+    return set(await _PERKS_LOADER.load(user_id) or ())
+
+async def user_has_perk(user_id: int, perk_code: str) -> bool:
+    return _normalize_perk_code(perk_code) in (await _PERKS_LOADER.load(user_id) or ())
 
 async def get_perk_holders(perk_code: str) -> List[int]:
-    target = _normalize_perk_code(perk_code)
-    state = {}
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT user_id, action, reason FROM history
-            WHERE action IN ('perk_grant','perk_revoke')
-            ORDER BY id ASC
-        """) as cur:
+    async with _reader() as db:
+        async with db.execute(
+            "SELECT user_id FROM user_perks WHERE perk_code=? ORDER BY granted_at, user_id",
+            (_normalize_perk_code(perk_code),),
+        ) as cur:
             rows = await cur.fetchall()
-    for uid, action, reason in rows:
-        if uid is None:
-            continue
-        code = _normalize_perk_code(reason)
-        if code != target:
-            continue
-        state[uid] = (action == "perk_grant")
-    return [uid for uid, has in state.items() if has]
+    return [int(uid) for (uid,) in rows]
 
 
 async def get_perks_summary() -> List[Tuple[str, int]]:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _reader() as db:
         async with db.execute("""
-            SELECT user_id, action, reason FROM history
-            WHERE action IN ('perk_grant','perk_revoke') AND reason IS NOT NULL
-            ORDER BY id ASC
+            SELECT perk_code, COUNT(*) FROM user_perks
+            GROUP BY perk_code ORDER BY perk_code
         """) as cur:
             rows = await cur.fetchall()
-
-    state: dict[tuple[str,int], bool] = {}
-    for uid, action, reason in rows:
-        code = _normalize_perk_code(reason)
-        if not code:
-            continue
-        state[(code, uid)] = (action == "perk_grant")
-
-    counts: dict[str, int] = {}
-    for (code, uid), has in state.items():
-        if has:
-            counts[code] = counts.get(code, 0) + 1
-
-    out = []
-    for code in sorted(counts.keys()):
-        out.append((code, counts[code]))
-    return out
+    return [(code, int(n)) for code, n in rows]
 
 def _reason_get(reason: str | None, key: str) -> str | None:
     if not reason:
@@ -389,159 +1971,127 @@ async def perk_credit_add(user_id: int, code: str):
     bl = await get_blacklist()
     if int(user_id) in bl:
         # лог по желанию:
-        await insert_history(user_id, "blocked_blacklist", 0, f"perk_credit_add;code={_normalize_perk_code(code)}")
+        code = _normalize_perk_code(code)
+        await insert_history(user_id, "blocked_blacklist", 0, f"perk_credit_add;code={code}", perk_code=code)
         return
     code = _normalize_perk_code(code)
-    await insert_history(user_id, "perk_credit_add", 1, f"code={code}")
+    async with _writer() as db:
+        await _history_add(db, user_id, "perk_credit_add", 1, f"code={code}", perk_code=code)
+        await db.execute("""
+            INSERT INTO perk_credits (user_id, perk_code, credits) VALUES (?, ?, 1)
+            ON CONFLICT(user_id, perk_code) DO UPDATE SET credits=credits+1
+        """, (user_id, code))
 
 
 async def perk_credit_use(user_id: int, code: str) -> bool:
     code = _normalize_perk_code(code)
-    # проверим, что кредит есть
-    if (await get_perk_credits(user_id, code)) <= 0:
-        return False
-    await insert_history(user_id, "perk_credit_use", 1, f"code={code}")
+    # списание и проверка остатка — одним UPDATE в транзакции события
+    async with _writer() as db:
+        cur = await db.execute("""
+            UPDATE perk_credits SET credits=credits-1
+            WHERE user_id=? AND perk_code=? AND credits > 0
+        """, (user_id, code))
+        if cur.rowcount <= 0:
+            return False
+        await db.execute("DELETE FROM perk_credits WHERE user_id=? AND perk_code=? AND credits <= 0", (user_id, code))
+        await _history_add(db, user_id, "perk_credit_use", 1, f"code={code}", perk_code=code)
     return True
 
 async def get_perk_credits(user_id: int, code: str) -> int:
-    code = _normalize_perk_code(code)
-    add = use = 0
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT action, COALESCE(amount,0), reason
-            FROM history
-            WHERE user_id=? AND action IN ('perk_credit_add','perk_credit_use')
-        """, (user_id,)) as cur:
-            rows = await cur.fetchall()
-    for action, amt, reason in rows:
-        if _reason_get(reason, "code") != code:
-            continue
-        if action == "perk_credit_add": add += int(amt or 0)
-        else:                            use += int(amt or 0)
-    return max(0, add - use)
+    async with _reader() as db:
+        async with db.execute(
+            "SELECT credits FROM perk_credits WHERE user_id=? AND perk_code=?",
+            (user_id, _normalize_perk_code(code)),
+        ) as cur:
+            row = await cur.fetchone()
+    return max(0, int(row[0])) if row else 0
 
-# db.py — ДОБАВИТЬ
 async def list_all_vouchers_counts() -> list[tuple[str, int]]:
     """
     Вернёт список пар (perk_code, total_credits) по всем пользователям.
-    Учитываются события perk_credit_add ( +1 ) и perk_credit_use ( -1 ).
     """
-    agg: dict[str, int] = {}
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _reader() as db:
         async with db.execute("""
-            SELECT action, COALESCE(amount,0), reason
-            FROM history
-            WHERE action IN ('perk_credit_add','perk_credit_use')
+            SELECT perk_code, SUM(credits) FROM perk_credits
+            WHERE credits > 0
+            GROUP BY perk_code
         """) as cur:
             rows = await cur.fetchall()
-    for action, amt, reason in rows:
-        code = _normalize_perk_code(_reason_get(reason, "code"))
-        if not code:
-            continue
-        v = int(amt or 0)
-        if action == "perk_credit_add":
-            agg[code] = agg.get(code, 0) + v
-        else:
-            agg[code] = agg.get(code, 0) - v
-    # только положительные остатки
-    return [(code, cnt) for code, cnt in agg.items() if cnt > 0]
+    return [(code, int(cnt)) for code, cnt in rows]
 
 
 # по коду — быстрый помощник
 async def get_vouchers_total_for_code(code: str) -> int:
-    code = _normalize_perk_code(code)
-    total = 0
-    for c, cnt in await list_all_vouchers_counts():
-        if c == code:
-            total += int(cnt)
-    return max(0, total)
+    async with _reader() as db:
+        async with db.execute(
+            "SELECT COALESCE(SUM(credits),0) FROM perk_credits WHERE perk_code=? AND credits > 0",
+            (_normalize_perk_code(code),),
+        ) as cur:
+            row = await cur.fetchone()
+    return max(0, int(row[0] or 0))
 
 
 async def perk_escrow_open(user_id: int, code: str, offer_id: int):
     code = _normalize_perk_code(code)
-    await insert_history(user_id, "perk_escrow_open", None, f"code={code};offer_id={offer_id}")
+    async with _writer() as db:
+        await _history_add(db, user_id, "perk_escrow_open", None, f"code={code};offer_id={offer_id}",
+                           ref_id=offer_id, perk_code=code)
+        await db.execute(
+            "INSERT OR REPLACE INTO perk_escrow (offer_id, user_id, perk_code) VALUES (?, ?, ?)",
+            (offer_id, user_id, code),
+        )
 
 async def perk_escrow_close(user_id: int, code: str, offer_id: int, typ: str):
     # typ: 'sold' | 'cancel'
     code = _normalize_perk_code(code)
-    await insert_history(user_id, "perk_escrow_close", None, f"code={code};offer_id={offer_id};type={typ}")
+    async with _writer() as db:
+        await _history_add(db, user_id, "perk_escrow_close", None, f"code={code};offer_id={offer_id};type={typ}",
+                           ref_id=offer_id, perk_code=code, payload={"type": typ})
+        await db.execute("DELETE FROM perk_escrow WHERE offer_id=?", (offer_id,))
 
 async def get_perk_escrow_owner(offer_id: int) -> tuple[int | None, str | None]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT user_id, reason FROM history
-            WHERE action='perk_escrow_open' AND reason LIKE ?
-            ORDER BY id DESC LIMIT 1
-        """, (f"%offer_id={offer_id}%",)) as cur:
+    async with _reader() as db:
+        async with db.execute(
+            "SELECT user_id, perk_code FROM perk_escrow WHERE offer_id=?", (offer_id,)
+        ) as cur:
             row = await cur.fetchone()
+        if not row:
+            # эскроу уже закрыт — владелец из последнего открытия
+            async with db.execute("""
+                SELECT user_id, perk_code FROM history
+                WHERE action='perk_escrow_open' AND ref_id=?
+                ORDER BY id DESC LIMIT 1
+            """, (offer_id,)) as cur:
+                row = await cur.fetchone()
     if not row: 
         return (None, None)
-    uid, reason = row
-    return (int(uid), _reason_get(reason, "code"))
+    uid, code = row
+    return (int(uid), code)
 
 # Сколько лотов по этому перку сейчас в эскроу (открыты и не закрыты)
 async def get_perk_escrowed_total_for_code(code: str) -> int:
-    code = _normalize_perk_code(code)
-    # 1) соберём все открытия эскроу по этому коду
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT id, reason
-            FROM history
-            WHERE action='perk_escrow_open'
-              AND reason LIKE ?
-        """, (f"%code={code}%",)) as cur:
-            opens = await cur.fetchall()
-
-        if not opens:
-            return 0
-
-        # 2) заранее заберём все закрытия (sold/cancel) по этому коду
-        async with db.execute("""
-            SELECT id, reason
-            FROM history
-            WHERE action='perk_escrow_close'
-              AND reason LIKE ?
-        """, (f"%code={code}%",)) as cur:
-            closes = await cur.fetchall()
-
-    # превратим закрытия в множество offer_id
-    closed_offer_ids: set[int] = set()
-    for cid, r in closes:
-        off = _reason_get(r, "offer_id")
-        if off is not None:
-            try:
-                closed_offer_ids.add(int(off))
-            except Exception:
-                pass
-
-    # считаем активные — те офферы, по которым НЕ было закрытия
-    active = 0
-    for oid, r in opens:
-        off = _reason_get(r, "offer_id")
-        if off is None:
-            continue
-        try:
-            off_i = int(off)
-        except Exception:
-            continue
-        if off_i not in closed_offer_ids:
-            active += 1
-
-    return active
+    async with _reader() as db:
+        async with db.execute(
+            "SELECT COUNT(*) FROM perk_escrow WHERE perk_code=?", (_normalize_perk_code(code),)
+        ) as cur:
+            row = await cur.fetchone()
+    return int(row[0] or 0)
 
 
 # ------- ЗП/кража кулдауны -------
 
 async def get_seconds_since_last_salary_claim(user_id: int, perk_code: str = "зп") -> int | None:
-    async with aiosqlite.connect(DB_PATH) as db:
+    if perk_code == SALARY_STATE_CODE:
+        return await _user_state_since(user_id, "last_salary_ts")
+    async with _reader() as db:
         async with db.execute(
-            """
-            SELECT CAST(strftime('%s','now') AS INTEGER) - CAST(strftime('%s', date) AS INTEGER)
+            f"""
+            SELECT {SQL_NOW_TS} - ts
             FROM history
-            WHERE user_id = ? AND action = 'salary_claim' AND reason = ?
+            WHERE user_id = ? AND action = 'salary_claim' AND reason = ? AND id > ?
             ORDER BY id DESC LIMIT 1
             """,
-            (user_id, perk_code),
+            (user_id, perk_code, _club_since()),
         ) as cur:
             row = await cur.fetchone()
             if row is None:
@@ -552,53 +2102,250 @@ async def record_salary_claim(user_id: int, amount: int, perk_code: str = "зп"
     await insert_history(user_id, "salary_claim", amount, perk_code)
 
 async def get_seconds_since_last_theft(user_id: int) -> int | None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            """
-            SELECT CAST(strftime('%s','now') AS INTEGER) - CAST(strftime('%s', date) AS INTEGER)
-            FROM history
-            WHERE user_id = ? AND action = 'theft'
-            ORDER BY id DESC LIMIT 1
-            """,
-            (user_id,),
-        ) as cur:
-            row = await cur.fetchone()
-            if row is None:
-                return None
-            return row[0]
+    return await _user_state_since(user_id, "last_theft_ts")
 
 async def record_theft(user_id: int, amount: int, victim_id: int, success: bool):
     reason = f"victim={victim_id};success={'1' if success else '0'}"
-    await insert_history(user_id, "theft", amount if success else 0, reason)
-
-# ------- анти-дубль -------
+    await insert_history(user_id, "theft", amount if success else 0, reason,
+                         ref_id=victim_id, payload={"success": bool(success)})
+
+# ------- анти-дубли сообщений -------
+# Три уровня, ни один не растёт вместе с history:
+#   1) кольцо последних ключей (chat_id, message_id) в памяти — O(1);
+#   2) msg_dedupe с TTL — переживает рестарт, чистится по ts;
+#   3) HWM update_id — повторно присланные после рестарта апдейты отсекаются без запроса в БД.
+DEDUPE_MEMORY = 4096           # ключей в кольце
+DEDUPE_TTL_SEC = 2 * 24 * 3600  # сколько помним сообщение в БД
+DEDUPE_PRUNE_EVERY = 500       # чистка msg_dedupe раз в N новых ключей
+UPDATE_HWM_FLUSH_SEC = 5.0     # как часто сохраняем HWM update_id
+
+_DEDUPE_RING: "OrderedDict[tuple[int, int], None]" = OrderedDict()
+_DEDUPE_STATS = {"new": 0, "dup_memory": 0, "dup_db": 0, "dup_update": 0, "pruned": 0}
+_dedupe_since_prune = 0
+_UPDATE_HWM = {"loaded": 0, "seen": 0, "saved": 0, "saved_at": 0.0}
+
+def _dedupe_remember(key: tuple[int, int]):
+    _DEDUPE_RING[key] = None
+    if len(_DEDUPE_RING) > DEDUPE_MEMORY:
+        _DEDUPE_RING.popitem(last=False)
+
+async def claim_msg(chat_id: int, message_id: int) -> bool:
+    """
+    Атомарно «застолбить» сообщение: True — видим впервые, False — дубль.
+    """
+    global _dedupe_since_prune
+    key = (int(chat_id), int(message_id))
+    if key in _DEDUPE_RING:
+        _DEDUPE_STATS["dup_memory"] += 1
+        return False
+    now = int(time.time())
+    async with _writer() as db:
+        cur = await db.execute(
+            "INSERT OR IGNORE INTO msg_dedupe (chat_id, message_id, ts) VALUES (?, ?, ?)",
+            (key[0], key[1], now),
+        )
+        fresh = cur.rowcount > 0
+        if fresh:
+            _dedupe_since_prune += 1
+            if _dedupe_since_prune >= DEDUPE_PRUNE_EVERY:
+                _dedupe_since_prune = 0
+                cur = await db.execute("DELETE FROM msg_dedupe WHERE ts < ?", (now - DEDUPE_TTL_SEC,))
+                _DEDUPE_STATS["pruned"] += max(0, cur.rowcount)
+    _dedupe_remember(key)
+    _DEDUPE_STATS["new" if fresh else "dup_db"] += 1
+    return fresh
 
 async def is_msg_processed(chat_id: int, message_id: int) -> bool:
-    key = f"{chat_id}:{message_id}"
-    async with aiosqlite.connect(DB_PATH) as db:
+    key = (int(chat_id), int(message_id))
+    if key in _DEDUPE_RING:
+        return True
+    async with _reader() as db:
         async with db.execute(
-            "SELECT 1 FROM history WHERE action='msg_processed' AND reason=? LIMIT 1",
-            (key,),
+            "SELECT 1 FROM msg_dedupe WHERE chat_id=? AND message_id=?", key
         ) as cur:
             return await cur.fetchone() is not None
 
 async def mark_msg_processed(chat_id: int, message_id: int):
-    key = f"{chat_id}:{message_id}"
-    await insert_history(None, "msg_processed", None, key)
+    await claim_msg(chat_id, message_id)
+
+async def _state_get(db, key: str) -> Optional[int]:
+    async with db.execute("SELECT value FROM bot_state WHERE key=?", (key,)) as cur:
+        row = await cur.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+async def _state_set(db, key: str, value: Optional[int]):
+    await db.execute("""
+        INSERT INTO bot_state (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value=excluded.value
+    """, (key, value))
+
+async def _load_update_hwm():
+    async with _reader() as db:
+        hwm = await _state_get(db, "update_id_hwm") or 0
+    _UPDATE_HWM.update(loaded=hwm, seen=max(_UPDATE_HWM["seen"], hwm), saved=hwm)
+
+async def flush_update_hwm():
+    seen = _UPDATE_HWM["seen"]
+    if seen <= _UPDATE_HWM["saved"]:
+        return
+    async with _writer() as db:
+        await _state_set(db, "update_id_hwm", seen)
+    _UPDATE_HWM["saved"] = seen
+    _UPDATE_HWM["saved_at"] = time.monotonic()
+
+async def claim_update_id(update_id: int) -> bool:
+    """
+    False — апдейт уже обрабатывался до рестарта (update_id ≤ сохранённого HWM).
+    HWM сохраняем не чаще раза в UPDATE_HWM_FLUSH_SEC; что не успели сохранить —
+    поймает msg_dedupe.
+    """
+    update_id = int(update_id)
+    if update_id <= _UPDATE_HWM["loaded"]:
+        _DEDUPE_STATS["dup_update"] += 1
+        return False
+    if update_id > _UPDATE_HWM["seen"]:
+        _UPDATE_HWM["seen"] = update_id
+        if time.monotonic() - _UPDATE_HWM["saved_at"] >= UPDATE_HWM_FLUSH_SEC:
+            await flush_update_hwm()
+    return True
 
-# ------- конфиги (через history: action='config', reason=key, amount=int_value) -------
+def get_dedupe_stats() -> dict:
+    return {**_DEDUPE_STATS, "ring": len(_DEDUPE_RING), "update_hwm": _UPDATE_HWM["seen"]}
+
+# ------- конфиги (таблица config + кэш; в history — журнал: action='config', reason=key, amount=int_value) -------
+
+# Значения живут в таблице config и целиком кэшируются в памяти процесса
+# (ключей — десятки). Запись — write-through: history (журнал) + config в одной
+# транзакции, кэш обновляется после COMMIT.
+_CFG: Optional[Dict[str, Tuple[Optional[int], Optional[str]]]] = None
+_CFG_GEN = 0  # растёт при каждой записи; защищает загрузку кэша от гонки с записью
+_CFG_LOAD_LOCK = asyncio.Lock()
+
+def _cfg_cache_reset():
+    global _CFG, _CFG_GEN
+    _CFG = None
+    _CFG_GEN += 1
+
+async def _cfg_cache() -> Dict[str, Tuple[Optional[int], Optional[str]]]:
+    global _CFG
+    while _CFG is None:
+        async with _CFG_LOAD_LOCK:
+            if _CFG is not None:
+                break
+            gen = _CFG_GEN
+            async with _reader() as db:
+                async with db.execute("SELECT key, int_value, str_value FROM config") as cur:
+                    rows = await cur.fetchall()
+            if gen == _CFG_GEN:
+                _CFG = {k: (iv, sv) for k, iv, sv in rows}
+    return _CFG
+
+def _cfg_put(key: str, int_value=..., str_value=...):
+    global _CFG_GEN
+    _CFG_GEN += 1
+    if _CFG is None:
+        return
+    old_i, old_s = _CFG.get(key, (None, None))
+    _CFG[key] = (old_i if int_value is ... else int_value, old_s if str_value is ... else str_value)
 
 async def set_config_int(key: str, value: int):
-    await insert_history(None, "config", value, key)
+    async with _writer() as db:
+        await _history_add(db, None, "config", value, key)
+        await db.execute("""
+            INSERT INTO config (key, int_value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(key) DO UPDATE SET int_value=excluded.int_value, updated_at=CURRENT_TIMESTAMP
+        """, (key, value))
+        _after_commit(lambda: _cfg_put(key, int_value=value))
 
 async def get_config_int(key: str, default: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT amount FROM history WHERE action='config' AND reason=? ORDER BY id DESC LIMIT 1",
-            (key,),
-        ) as cur:
-            row = await cur.fetchone()
-            return row[0] if row and row[0] is not None else default
+    val = (await _cfg_cache()).get(key, (None, None))[0]
+    return val if val is not None else default
+
+async def get_configs(keys) -> Dict[str, Optional[int]]:
+    """
+    Пачка целочисленных конфигов за один заход в кэш.
+    keys — список ключей (нет значения → None) или dict {ключ: дефолт}.
+    """
+    cfg = await _cfg_cache()
+    defaults = keys if isinstance(keys, dict) else dict.fromkeys(keys)
+    out = {}
+    for k, d in defaults.items():
+        val = cfg.get(k, (None, None))[0]
+        out[k] = val if val is not None else d
+    return out
+
+# ------- сжатие журнала конфигов -------
+# Каждая запись конфига (и JSON-блобы: чёрный список, perk_minted_json, ...)
+# добавляет строку в history. Текущее значение живёт в config, поэтому в журнале
+# оставляем последние CONFIG_LOG_TAIL записей на ключ, остальное удаляем
+# короткими транзакциями по CONFIG_COMPACT_BATCH строк.
+CFG_CONFIG_LOG_TAIL = "config_log_tail"
+CONFIG_LOG_TAIL = 20            # дефолт «хвоста» для аудита
+CONFIG_COMPACT_BATCH = 500
+CONFIG_COMPACT_EVERY_SEC = 3600
+
+_COMPACT_STATS: Dict[str, Any] = {"runs": 0, "rows_total": 0, "bytes_total": 0, "last": None}
+
+async def compact_config_log() -> Dict[str, int]:
+    """Оставить в журнале последние N значений каждого ключа. Вернёт отчёт."""
+    tail = max(1, await get_config_int(CFG_CONFIG_LOG_TAIL, CONFIG_LOG_TAIL))
+    async with _reader() as db:
+        async with db.execute("SELECT id FROM actions WHERE name IN ('config', 'config_str')") as cur:
+            ids = [int(r[0]) for r in await cur.fetchall()]
+    report = {"rows": 0, "bytes": 0, "keys": 0, "tail": tail}
+    if not ids:
+        return report
+    marks = ",".join("?" * len(ids))
+    # id строк за пределами хвоста; окно идёт по индексу (action_id, reason)
+    find_sql = f"""
+        SELECT id, reason FROM (
+            SELECT id, reason,
+                   ROW_NUMBER() OVER (PARTITION BY action_id, reason ORDER BY id DESC) AS rn
+            FROM history_log WHERE action_id IN ({marks})
+        ) WHERE rn > ?
+        LIMIT ?
+    """
+    keys = set()
+    while True:
+        async with _reader() as db:
+            async with db.execute(find_sql, (*ids, tail, CONFIG_COMPACT_BATCH)) as cur:
+                rows = await cur.fetchall()
+        if not rows:
+            break
+        batch = json.dumps([r[0] for r in rows])
+        async with _writer() as db:
+            async with db.execute("""
+                SELECT COUNT(*), COALESCE(SUM(COALESCE(length(reason),0) + COALESCE(length(payload),0)
+                                              + COALESCE(length(date),0) + 8 * 6), 0)
+                FROM history_log WHERE id IN (SELECT value FROM json_each(?))
+            """, (batch,)) as cur:
+                n, size = await cur.fetchone()
+            await db.execute("DELETE FROM history_log WHERE id IN (SELECT value FROM json_each(?))", (batch,))
+        report["rows"] += int(n or 0)
+        report["bytes"] += int(size or 0)
+        keys.update(r[1] for r in rows)
+        if len(rows) < CONFIG_COMPACT_BATCH:
+            break
+        await asyncio.sleep(0)  # пропускаем вперёд команды бота между пачками
+    report["keys"] = len(keys)
+    _COMPACT_STATS["runs"] += 1
+    _COMPACT_STATS["rows_total"] += report["rows"]
+    _COMPACT_STATS["bytes_total"] += report["bytes"]
+    _COMPACT_STATS["last"] = dict(report, ts=int(time.time()))
+    if report["rows"]:
+        logging.info("db: config log compacted: %s", report)
+    return report
+
+def get_compaction_stats() -> Dict[str, Any]:
+    last = _COMPACT_STATS["last"] or {}
+    return {
+        "runs": _COMPACT_STATS["runs"],
+        "rows_total": _COMPACT_STATS["rows_total"],
+        "kb_total": _COMPACT_STATS["bytes_total"] // 1024,
+        "last_rows": last.get("rows", 0),
+        "last_keys": last.get("keys", 0),
+        "tail": last.get("tail", CONFIG_LOG_TAIL),
+    }
 
 # воспринимаемые ключи конфигов
 CFG_BURN_BPS      = "burn_bps"        # 100 = 1%
@@ -628,8 +2375,7 @@ async def get_cell_stor_fee_pct() -> int:
 async def set_cell_stor_fee_pct(v: int):
     await set_config_int(CFG_CELL_STOR_FEE_PCT, max(0, v))
 
-# ===== ЯЧЕЙКИ (БАНК) НА HISTORY =====
-import math
+# ===== ЯЧЕЙКИ (БАНК): остаток в cells, движения — в history =====
 FOUR_HOURS = 12 * 60 * 60  # в секундах
 
 async def _now_ts(db=None) -> int:
@@ -637,87 +2383,98 @@ async def _now_ts(db=None) -> int:
         async with db.execute("SELECT CAST(strftime('%s','now') AS INTEGER)") as cur:
             row = await cur.fetchone()
         return int(row[0])
-    async with aiosqlite.connect(DB_PATH) as xdb:
+    async with _reader() as xdb:
         async with xdb.execute("SELECT CAST(strftime('%s','now') AS INTEGER)") as cur:
             row = await cur.fetchone()
         return int(row[0])
 
-async def _cell_get_last_ts(user_id: int) -> int | None:
-    # последняя метка времени начисления хранения
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT amount FROM history
-            WHERE user_id=? AND action='cell_ts'
-            ORDER BY id DESC LIMIT 1
-        """, (user_id,)) as cur:
-            row = await cur.fetchone()
-    return None if row is None else int(row[0])
-
-async def _cell_set_last_ts(user_id: int, ts: int):
-    await insert_history(user_id, "cell_ts", ts, None)
-
-async def _cell_calc_balance(user_id: int) -> int:
-    """
-    Баланс ячейки = сумма депо - сумма выводов - сумма комиссий хранения.
-    Депозит пишем NET (после входной комиссии).
-    """
-    dep = wd = fee = 0
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT action, COALESCE(amount,0) FROM history
-            WHERE user_id=? AND action IN ('cell_dep','cell_wd','cell_fee')
-        """, (user_id,)) as cur:
-            rows = await cur.fetchall()
-    for action, amt in rows:
-        a = int(amt or 0)
-        if action == "cell_dep":
-            dep += a
-        elif action == "cell_wd":
-            wd += a
-        elif action == "cell_fee":
-            fee += a
-    bal = dep - wd - fee
-    return max(0, bal)
+# Начисление хранения одним проходом по всем (или одной) ячейкам.
+# Каждый период — (bal*pct+99)//100, ровно как при поштучных списаниях:
+# bal - ceil(bal*pct/100) == floor(bal*(100-pct)/100), а вложенные floor не
+# сворачиваются в одну степень — поэтому периоды разворачивает рекурсивный CTE
+# (глубина ограничена числом периодов и обнулением баланса), а результат
+# раскладывается по ячейкам и history set-based запросами.
+_CELL_ACCRUE_SQL = """
+    WITH RECURSIVE due(user_id, bal0, k, last_ts) AS (
+        SELECT user_id, balance, (:now - last_ts) / :period, last_ts FROM cells
+        WHERE last_ts IS NOT NULL AND last_ts <= :now - :period
+          AND (:uid IS NULL OR user_id = :uid)
+    ),
+    acc(user_id, bal, left, fee, steps) AS (
+        SELECT user_id, bal0, k, 0, 0 FROM due
+        UNION ALL
+        SELECT user_id, MAX(0, bal - (bal * :pct + 99) / 100), left - 1,
+               fee + (bal * :pct + 99) / 100, steps + 1
+        FROM acc
+        WHERE left > 0 AND bal > 0 AND (bal * :pct + 99) / 100 > 0
+    )
+    INSERT INTO temp.cell_accrual (user_id, bal0, bal, fee, steps, new_last)
+    SELECT a.user_id, d.bal0, MIN(a.bal), MAX(a.fee), MAX(a.steps), d.last_ts + d.k * :period
+    FROM acc a JOIN due d USING (user_id)
+    GROUP BY a.user_id
+"""
+
+async def _cell_accrue_tx(db, now: int, user_id: Optional[int] = None) -> int:
+    """Списать хранение по всем «просроченным» ячейкам (или одной). Вернёт число затронутых ячеек."""
+    await db.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS cell_accrual (
+            user_id INTEGER PRIMARY KEY, bal0 INTEGER, bal INTEGER, fee INTEGER, steps INTEGER, new_last INTEGER
+        )
+    """)
+    await db.execute("DELETE FROM temp.cell_accrual")
+    pct = await get_cell_stor_fee_pct()
+    await db.execute(_CELL_ACCRUE_SQL, {"now": now, "period": FOUR_HOURS, "pct": pct, "uid": user_id})
+    # rowcount у запроса, начинающегося с WITH, sqlite3 не заполняет
+    async with db.execute("SELECT COUNT(*) FROM temp.cell_accrual") as cur:
+        touched = int((await cur.fetchone())[0])
+    if touched == 0:
+        return 0
+    await db.execute("""
+        UPDATE economy_state
+        SET bank_total = bank_total - (SELECT COALESCE(SUM(bal0 - bal), 0) FROM temp.cell_accrual)
+        WHERE id = 1
+    """)
+    # одно сводное событие на ячейку вместо строки на каждый период
+    await db.execute(f"""
+        INSERT INTO history_log (user_id, action_id, amount, reason, payload, ts, cell_after)
+        SELECT user_id, ?, fee, 'periods=' || steps || ';pct=' || ?,
+               json_object('periods', steps, 'pct', ?, 'from', bal0, 'to', bal), {SQL_NOW_TS}, bal
+        FROM temp.cell_accrual WHERE fee > 0
+        ORDER BY user_id
+    """, (await _action_id(db, "cell_fee"), pct, pct))
+    await db.execute("""
+        UPDATE cells SET
+            balance = (SELECT a.bal FROM temp.cell_accrual a WHERE a.user_id = cells.user_id),
+            last_ts = (SELECT a.new_last FROM temp.cell_accrual a WHERE a.user_id = cells.user_id)
+        WHERE user_id IN (SELECT user_id FROM temp.cell_accrual)
+    """)
+    return touched
+
+async def _cell_touch_tx(db, user_id: int) -> tuple[int, int]:
+    """cell_touch внутри уже открытой транзакции записи."""
+    now = await _now_ts(db)
+    async with db.execute("SELECT balance, last_ts FROM cells WHERE user_id=?", (user_id,)) as cur:
+        row = await cur.fetchone()
+    if row is None or row[1] is None:
+        # первая инициализация метки без списаний
+        await db.execute("""
+            INSERT INTO cells (user_id, balance, last_ts) VALUES (?, 0, ?)
+            ON CONFLICT(user_id) DO UPDATE SET last_ts=excluded.last_ts
+        """, (user_id, now))
+        return 0, int(row[0]) if row else 0
+    if not await _cell_accrue_tx(db, now, user_id):
+        return 0, int(row[0])
+    async with db.execute("SELECT fee, bal FROM temp.cell_accrual WHERE user_id=?", (user_id,)) as cur:
+        fee, bal = await cur.fetchone()
+    return int(fee), int(bal)
 
 async def cell_touch(user_id: int) -> tuple[int,int]:
     """
-    Применяем накопленные 4-часовые комиссии хранения «лениво».
+    Применяем накопленные 12-часовые комиссии хранения «лениво».
     Возвращает (списано_сейчас, новый_баланс).
     """
-    total_fee = 0
-    async with aiosqlite.connect(DB_PATH) as db:
-        now = await _now_ts(db)
-    last = await _cell_get_last_ts(user_id)
-    if last is None:
-        # первая инициализация метки без списаний
-        await _cell_set_last_ts(user_id, now)
-        return 0, await _cell_calc_balance(user_id)
-
-    intervals = max(0, (now - last) // FOUR_HOURS)
-    if intervals == 0:
-        return 0, await _cell_calc_balance(user_id)
-
-    bal = await _cell_calc_balance(user_id)
-    if bal <= 0:
-        # просто двигаем метку времени
-        await _cell_set_last_ts(user_id, last + intervals*FOUR_HOURS)
-        return 0, 0
-
-    pct = await get_cell_stor_fee_pct()
-    for _ in range(intervals):
-        fee = (bal * pct + 99) // 100
-        if fee <= 0:
-            break
-        # записываем списание и уменьшаем локальный баланс
-        await insert_history(user_id, "cell_fee", fee, None)
-        total_fee += fee
-        bal -= fee
-        if bal <= 0:
-            bal = 0
-            break
-
-    await _cell_set_last_ts(user_id, last + intervals*FOUR_HOURS)
-    return total_fee, bal
+    async with _writer() as db:
+        return await _cell_touch_tx(db, user_id)
 
 # ==== BANK: КД грабителя (в днях) ====
 CFG_BANK_ROB_CD_DAYS = "bank_rob_cd_days"
@@ -730,75 +2487,128 @@ async def set_bank_rob_cooldown_days(v: int):
 
 
 async def cell_get_balance(user_id: int) -> int:
-    await cell_touch(user_id)
-    return await _cell_calc_balance(user_id)
+    _, bal = await cell_touch(user_id)
+    return bal
+
+async def cell_get_balances(user_ids) -> Dict[int, int]:
+    """Балансы ячеек списка пользователей: одно списание хранения по всем + одно чтение."""
+    ids = _uid_list(user_ids)
+    async with _reader() as db:
+        due = await _bank_due(db, await _now_ts(db))
+    if due:
+        async with _writer() as db:
+            await _cell_accrue_tx(db, await _now_ts(db))
+    async with _reader() as db:
+        found = await _fetch_in(
+            db, "SELECT user_id, balance FROM cells WHERE user_id IN ({marks})",
+            lambda rows: {uid: int(bal) for uid, bal in rows}, ids,
+        )
+    return {u: found.get(u, 0) for u in ids}
 
 async def cell_deposit(user_id: int, gross_amount: int) -> tuple[int,int,int]:
     """
     Депозит в ячейку. Возврат: (внесено_брутто, комиссия_входа, новый_баланс_ячейки).
     Комиссия входа уходит «в сейф» логически (мы логируем её как отдельное событие).
     """
-    await cell_touch(user_id)
     dep_pct = await get_cell_dep_fee_pct()
+    async with _writer() as db:
+        return await _cell_deposit_tx(db, user_id, gross_amount, dep_pct)
+
+async def _cell_deposit_tx(db, user_id: int, gross_amount: int, dep_pct: int) -> tuple[int,int,int]:
     fee = (gross_amount * dep_pct + 99) // 100
     net = max(0, gross_amount - fee)
+    _, bal = await _cell_touch_tx(db, user_id)
+    new_bal = bal + net
     # логируем net как приход в ячейку
-    await insert_history(user_id, "cell_dep", net, f"gross={gross_amount};fee={fee}")
+    await _history_add(db, user_id, "cell_dep", net, f"gross={gross_amount};fee={fee}", cell_after=new_bal)
     if fee > 0:
-        await insert_history(None, "cell_deposit_fee", fee, f"user_id={user_id}")
-    new_bal = await _cell_calc_balance(user_id)
+        await _history_add(db, None, "cell_deposit_fee", fee, f"user_id={user_id}", ref_id=user_id)
+    await db.execute("UPDATE cells SET balance=? WHERE user_id=?", (new_bal, user_id))
+    await _econ_add(db, bank_total=net)
     return gross_amount, fee, new_bal
 
-async def cell_withdraw(user_id: int, amount: int) -> tuple[int,int]:
+async def cell_deposit_from_pocket(user_id: int, gross_amount: int) -> Optional[tuple[int,int,int]]:
+    """
+    Списание с кармана и депозит в ячейку одной транзакцией.
+    None — на кармане не хватает (ничего не списано), иначе как у cell_deposit.
+    """
+    if gross_amount <= 0:
+        raise ValueError("amount must be > 0")
+    dep_pct = await get_cell_dep_fee_pct()
+    async with _writer() as db:
+        if await _debit_tx(db, user_id, gross_amount, "cell_deposit") is None:
+            return None
+        return await _cell_deposit_tx(db, user_id, gross_amount, dep_pct)
 
-    await cell_touch(user_id)
-    bal = await _cell_calc_balance(user_id)
+async def _cell_take_tx(db, user_id: int, amount: int, reason: Optional[str]) -> tuple[int, int]:
+    _, bal = await _cell_touch_tx(db, user_id)
     take = min(max(0, amount), bal)
     if take > 0:
-        await insert_history(user_id, "cell_wd", take, None)
-    new_bal = await _cell_calc_balance(user_id)
-    return take, new_bal
+        await _history_add(db, user_id, "cell_wd", take, reason, cell_after=bal - take)
+        await db.execute("UPDATE cells SET balance=balance-? WHERE user_id=?", (take, user_id))
+        await _econ_add(db, bank_total=-take)
+    return take, bal - take
 
-async def _cell_users() -> list[int]:
-    # все, кто когда-либо взаимодействовал с ячейками
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT DISTINCT user_id FROM history
-            WHERE action IN ('cell_dep','cell_wd','cell_fee','cell_ts')
-              AND user_id IS NOT NULL
-        """) as cur:
-            rows = await cur.fetchall()
-    return [int(r[0]) for r in rows]
+async def cell_withdraw(user_id: int, amount: int) -> tuple[int,int]:
+    async with _writer() as db:
+        return await _cell_take_tx(db, user_id, amount, None)
+
+async def cell_withdraw_to_pocket(user_id: int, amount: int, reason: str) -> tuple[int,int]:
+    """Вывод из ячейки на карман одной транзакцией: (выведено, новый_баланс_ячейки)."""
+    bl = await get_blacklist()
+    async with _writer() as db:
+        take, left = await _cell_take_tx(db, user_id, amount, None)
+        if take > 0:
+            await _credit_tx(db, user_id, take, reason, bl)
+    return take, left
+
+async def _bank_due(db, now: int) -> bool:
+    async with db.execute("SELECT MIN(last_ts) FROM cells") as cur:
+        row = await cur.fetchone()
+    return row[0] is not None and int(row[0]) <= now - FOUR_HOURS
+
+async def _bank_total(db) -> int:
+    return (await _econ_row(db))["bank_total"]
 
 async def bank_touch_all_and_total() -> int:
-    total = 0
-    for uid in await _cell_users():
-        await cell_touch(uid)
-        total += await _cell_calc_balance(uid)
-    return total
+    # быстрый путь: никому не пора списывать хранение — транзакция записи не нужна
+    async with _reader() as db:
+        if not await _bank_due(db, await _now_ts(db)):
+            return await _bank_total(db)
+    async with _writer() as db:
+        await _cell_accrue_tx(db, await _now_ts(db))
+        return await _bank_total(db)
 
-# db.py — ДОБАВИТЬ
 async def bank_zero_user(user_id: int) -> int:
     """
     Полностью обнулить банковскую ячейку конкретного пользователя.
     Возвращает, сколько было списано из ячейки.
     """
-    await cell_touch(user_id)
-    bal = await _cell_calc_balance(user_id)
-    if bal > 0:
-        await insert_history(user_id, "cell_wd", bal, "bank_user_zero")
-    return bal
-
+    async with _writer() as db:
+        take, _ = await _cell_take_tx(db, user_id, 1 << 62, "bank_user_zero")
+    return take
+
+
+async def _bank_sweep_tx(db) -> int:
+    # начислить хранение, записать изъятие каждой ячейки и обнулить их
+    await _cell_accrue_tx(db, await _now_ts(db))
+    # добычу считаем по самим ячейкам, а не по счётчику
+    async with db.execute("SELECT COALESCE(SUM(balance),0) FROM cells WHERE balance > 0") as cur:
+        total = int((await cur.fetchone())[0] or 0)
+    if total > 0:
+        await db.execute(f"""
+            INSERT INTO history_log (user_id, action_id, amount, reason, ts, cell_after)
+            SELECT user_id, ?, balance, 'bank_rob', {SQL_NOW_TS}, 0 FROM cells
+            WHERE balance > 0
+            ORDER BY user_id
+        """, (await _action_id(db, "cell_wd"),))
+        await db.execute("UPDATE cells SET balance=0 WHERE balance > 0")
+        await db.execute("UPDATE economy_state SET bank_total = 0 WHERE id = 1")
+    return total
 
 async def bank_zero_all_and_sum() -> int:
-    total = 0
-    for uid in await _cell_users():
-        await cell_touch(uid)
-        bal = await _cell_calc_balance(uid)
-        if bal > 0:
-            total += bal
-            await insert_history(uid, "cell_wd", bal, "bank_rob")
-    return total
+    async with _writer() as db:
+        return await _bank_sweep_tx(db)
 
 
 async def get_burn_bps() -> int:
@@ -816,11 +2626,12 @@ async def set_income(v: int):
     await set_config_int(CFG_INCOME, max(0, v))
 
 async def get_multipliers() -> Dict[str, int]:
+    cfg = await get_configs({CFG_MULT_DICE: 3, CFG_MULT_DARTS: 3, CFG_MULT_BOWLING: 3, CFG_MULT_SLOTS: 20})
     return {
-        "dice": await get_config_int(CFG_MULT_DICE, 3),
-        "darts": await get_config_int(CFG_MULT_DARTS, 3),
-        "bowling": await get_config_int(CFG_MULT_BOWLING, 3),
-        "slots": await get_config_int(CFG_MULT_SLOTS, 20),
+        "dice": cfg[CFG_MULT_DICE],
+        "darts": cfg[CFG_MULT_DARTS],
+        "bowling": cfg[CFG_MULT_BOWLING],
+        "slots": cfg[CFG_MULT_SLOTS],
     }
 
 async def set_multiplier(game: str, x: int):
@@ -875,65 +2686,125 @@ async def set_price_perk(code: str, v: int):
 
 # ------- сейф/экономика -------
 
+_ECON_FIELDS = ("cap", "burned", "circulating", "bank_total", "epoch_id")
+ECONOMY_CHECK_SEC = 600  # период фоновой сверки счётчиков с первоисточниками
+_ECON_CHECK: Dict[str, Any] = {"runs": 0, "mismatches": 0, "last_ts": None, "last_diff": {}}
+
+async def _econ_row(db) -> Dict[str, Any]:
+    async with db.execute(
+        "SELECT cap, burned, circulating, bank_total, epoch_id FROM economy_state WHERE id=1"
+    ) as cur:
+        row = await cur.fetchone()
+    if row is None:
+        return {"cap": None, "burned": 0, "circulating": 0, "bank_total": 0, "epoch_id": None}
+    out = dict(zip(_ECON_FIELDS, row))
+    for k in ("burned", "circulating", "bank_total"):
+        out[k] = int(out[k] or 0)
+    return out
+
+async def _econ_add(db, circulating: int = 0, burned: int = 0, bank_total: int = 0):
+    if circulating or burned or bank_total:
+        await db.execute("""
+            UPDATE economy_state
+            SET circulating = circulating + ?, burned = burned + ?, bank_total = bank_total + ?
+            WHERE id = 1
+        """, (circulating, burned, bank_total))
+
+async def _econ_store(db, st: Dict[str, Any]):
+    await db.execute("""
+        UPDATE economy_state SET cap=?, burned=?, circulating=?, bank_total=?, epoch_id=?
+        WHERE id = 1
+    """, tuple(st[k] for k in _ECON_FIELDS))
+
+async def _econ_recompute(db, balance_sql: str = SQL_BALANCE) -> Dict[str, Any]:
+    """Счётчики экономики с нуля — из users, cells и history (для миграции и сверки)."""
+    async with db.execute("""
+        SELECT id, payload FROM history
+        WHERE action='vault_init' AND id > ?
+        ORDER BY id DESC LIMIT 1
+    """, (_club_since(),)) as cur:
+        row = await cur.fetchone()
+    epoch_id = int(row[0]) if row else None
+    cap = _payload(row[1]).get("cap") if row else None
+    burned = 0
+    if epoch_id is not None:
+        async with db.execute(
+            "SELECT COALESCE(SUM(amount),0) FROM history WHERE id > ? AND action='burn'", (epoch_id,)
+        ) as cur:
+            burned = int((await cur.fetchone())[0] or 0)
+    async with db.execute(f"SELECT COALESCE(SUM({balance_sql}),0) FROM users") as cur:
+        circulating = int((await cur.fetchone())[0] or 0)
+    async with db.execute("SELECT COALESCE(SUM(balance),0) FROM cells") as cur:
+        bank_total = int((await cur.fetchone())[0] or 0)
+    return {
+        "cap": int(cap) if cap is not None else None,
+        "burned": burned,
+        "circulating": circulating,
+        "bank_total": bank_total,
+        "epoch_id": epoch_id,
+    }
+
+async def economy_cross_check(fix: bool = True) -> Dict[str, tuple]:
+    """
+    Сверка economy_state с первоисточниками. Вернёт {поле: (в_строке, пересчитано)}
+    для расхождений; при fix=True строка исправляется в той же транзакции.
+    """
+    async with _writer() as db:
+        row = await _econ_row(db)
+        real = await _econ_recompute(db)
+        diff = {k: (row[k], real[k]) for k in _ECON_FIELDS if row[k] != real[k]}
+        if diff and fix:
+            await _econ_store(db, real)
+    _ECON_CHECK["runs"] += 1
+    _ECON_CHECK["last_ts"] = int(time.time())
+    if diff:
+        _ECON_CHECK["mismatches"] += 1
+        _ECON_CHECK["last_diff"] = diff
+        logging.warning("economy_state drift (row, actual): %s", diff)
+    return diff
+
+def get_economy_check_report() -> Dict[str, Any]:
+    return dict(_ECON_CHECK)
+
 async def vault_init(cap: int, circulating_now: int):
     init_vault = cap - circulating_now
     if init_vault < 0:
         return None  # сигнализируем вызывающему — кап меньше оборота
-    return await insert_history(None, "vault_init", init_vault, f"cap={cap}")
+    async with _writer() as db:
+        hid = await _history_add(db, None, "vault_init", init_vault, f"cap={cap}", payload={"cap": cap})
+        # новая эпоха сейфа: сожжённое считаем заново
+        await db.execute(
+            "UPDATE economy_state SET cap=?, burned=0, epoch_id=? WHERE id = 1", (cap, hid)
+        )
+        return hid
 
 async def get_last_vault_cap() -> Optional[int]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT reason FROM history
-            WHERE action='vault_init'
-            ORDER BY id DESC LIMIT 1
-        """) as cur:
-            row = await cur.fetchone()
-    if not row or not row[0]:
-        return None
-    # reason: "cap=<N>"
-    try:
-        if "cap=" in row[0]:
-            return int(row[0].split("cap=")[1])
-    except:
-        return None
-    return None
+    async with _reader() as db:
+        cap = (await _econ_row(db))["cap"]
+    return int(cap) if cap is not None else None
 
 async def get_epoch_start_id() -> Optional[int]:
     # id последнего vault_init
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT id FROM history
-            WHERE action='vault_init'
-            ORDER BY id DESC LIMIT 1
-        """) as cur:
-            row = await cur.fetchone()
-            return int(row[0]) if row else None
+    async with _reader() as db:
+        epoch_id = (await _econ_row(db))["epoch_id"]
+    return int(epoch_id) if epoch_id is not None else None
 
 async def get_burned_since_epoch() -> int:
-    start_id = await get_epoch_start_id()
-    if start_id is None:
-        return 0
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT COALESCE(SUM(amount),0) FROM history
-            WHERE id > ? AND action='burn'
-        """, (start_id,)) as cur:
-            row = await cur.fetchone()
-            return int(row[0] or 0)
+    async with _reader() as db:
+        return (await _econ_row(db))["burned"]
 
 async def get_circulating() -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT COALESCE(SUM(balance),0) FROM users") as cur:
-            row = await cur.fetchone()
-            return int(row[0] or 0)
+    async with _reader() as db:
+        return (await _econ_row(db))["circulating"]
 
 async def get_economy_stats() -> Optional[Dict[str, Any]]:
-    cap = await get_last_vault_cap()
+    async with _reader() as db:
+        st = await _econ_row(db)
+    cap = st["cap"]
     if cap is None:
         return None
-    burned = await get_burned_since_epoch()
-    circulating = await get_circulating()
+    burned = st["burned"]
+    circulating = st["circulating"]
     vault = cap - burned - circulating
     if vault < 0:
         vault = 0
@@ -942,21 +2813,29 @@ async def get_economy_stats() -> Optional[Dict[str, Any]]:
     if supply < 0:
         supply = 0
 
-    bps = await get_burn_bps()
-    income = await get_income()
+    cfg = await get_configs({CFG_BURN_BPS: 100, CFG_INCOME: 5})
     return {
         "cap": cap,
         "burned": burned,
         "circulating": circulating,
         "vault": vault,
         "supply": supply,
-        "burn_bps": bps,
-        "income": income,
+        "burn_bps": cfg[CFG_BURN_BPS],
+        "income": cfg[CFG_INCOME],
+        "bank_total": st["bank_total"],
     }
 
 # операции "сжигания" и записи «входа/выхода» для аудита (расчёт vault делаем по формуле выше)
+async def _burn_tx(db, amount: int, reason: str):
+    await _history_add(db, None, "burn", amount, reason)
+    # до первого vault_init сожжённое в эпоху не входит (как и раньше)
+    await db.execute(
+        "UPDATE economy_state SET burned = burned + ? WHERE id = 1 AND epoch_id IS NOT NULL", (amount,)
+    )
+
 async def record_burn(amount: int, reason: str):
-    await insert_history(None, "burn", amount, reason)
+    async with _writer() as db:
+        await _burn_tx(db, amount, reason)
 
 # ------- рынок (офферы через history) -------
 
@@ -965,62 +2844,58 @@ async def record_burn(amount: int, reason: str):
 # offer_sold:   user_id=buyer, amount=price, reason=f"offer_id=<id>;seller=<seller_id>"
 
 async def create_offer(seller_id: int, link: str, price: int) -> int:
-    return await insert_history(seller_id, "offer_create", price, f"link={link}")
+    return await insert_history(seller_id, "offer_create", price, f"link={link}", payload={"link": link})
 
 async def cancel_offer(offer_id: int, by_user: Optional[int]):
-    await insert_history(by_user, "offer_cancel", offer_id, "cancel")
+    await insert_history(by_user, "offer_cancel", offer_id, "cancel", ref_id=offer_id)
+
+async def record_offer_sold(buyer_id: int, offer_id: int, seller_id: int, price: int) -> int:
+    return await insert_history(buyer_id, "offer_sold", price, f"offer_id={offer_id};seller={seller_id}",
+                                ref_id=offer_id, payload={"seller": seller_id})
+
+def _offer_dict(cid, seller, price, perk_code, payload, date) -> Dict[str, Any]:
+    return {
+        "offer_id": cid,
+        "seller_id": seller,
+        "price": int(price or 0),
+        "link": _payload(payload).get("link") or "",
+        "perk_code": perk_code,
+        "type": "perk" if perk_code else "regular",
+        "date": date
+    }
+
+# проекция: активные лоты {offer_id: лот}
+_OFFERS: Dict[int, Dict[str, Any]] = {}
+
+@_projection("offers", ("offer_create", "offer_cancel", "offer_sold"), _OFFERS.clear)
+def _offers_apply(ev: HistoryEvent):
+    if ev.action == "offer_create":
+        _OFFERS[ev.id] = _offer_dict(ev.id, ev.user_id, ev.amount, ev.perk_code, ev.payload, ev.date)
+    elif ev.ref_id is not None:
+        _OFFERS.pop(int(ev.ref_id), None)
 
 async def list_active_offers() -> List[Dict[str, Any]]:
-    # восстанавливаем активные: offer_create без cancel/sold
-    async with aiosqlite.connect(DB_PATH) as db:
+    # активные: offer_create без cancel/sold (связь по ref_id = id лота)
+    if _proj_ready("offers"):
+        return [dict(_OFFERS[k]) for k in sorted(_OFFERS, reverse=True)]
+    async with _reader() as db:
         async with db.execute("""
-            SELECT id, user_id, amount, reason, date FROM history
-            WHERE action='offer_create'
-            ORDER BY id DESC
-        """) as cur:
+            SELECT o.id, o.user_id, o.amount, o.perk_code, o.payload, o.date FROM history o
+            WHERE o.action='offer_create' AND o.id > ?
+              AND NOT EXISTS (
+                  SELECT 1 FROM history_log x
+                  WHERE x.action_id IN (SELECT id FROM actions WHERE name IN ('offer_cancel','offer_sold'))
+                    AND x.ref_id=o.id
+              )
+            ORDER BY o.id DESC
+        """, (_club_since(),)) as cur:
             creates = await cur.fetchall()
 
-        # составим множества отмен/продаж
-        async with db.execute("SELECT amount FROM history WHERE action='offer_cancel'") as cur:
-            cancels = {r[0] for r in await cur.fetchall()}
-        async with db.execute("""
-            SELECT reason FROM history WHERE action='offer_sold'
-        """) as cur:
-            sold_rows = await cur.fetchall()
-        sold_ids = set()
-        for (reason,) in sold_rows:
-            if not reason:
-                continue
-            for part in reason.split(";"):
-                part = part.strip()
-                if part.startswith("offer_id="):
-                    try:
-                        sold_ids.add(int(part.split("=")[1]))
-                    except:
-                        pass
-
-    out = []
-    for cid, seller, price, reason, date in creates:
-        if cid in cancels or cid in sold_ids:
-            continue
-        link = _reason_get(reason, "link") or ""
-        perk_code = _reason_get(reason, "perk_code")
-        offer_type = "perk" if perk_code else "regular"
-
-        out.append({
-            "offer_id": cid,
-            "seller_id": seller,
-            "price": int(price or 0),
-            "link": link,
-            "perk_code": perk_code,
-            "type": offer_type,
-            "date": date
-        })
-    return out
+    return [_offer_dict(*row) for row in creates]
 
 async def create_perk_offer(seller_id: int, code: str, price: int) -> int:
     code = _normalize_perk_code(code)
-    return await insert_history(seller_id, "offer_create", price, f"perk_code={code}")
+    return await insert_history(seller_id, "offer_create", price, f"perk_code={code}", perk_code=code)
 
 
 # ------- герой дня (через history) -------
@@ -1042,31 +2917,45 @@ async def hero_set_for_today(chat_id: int, user_id: int, hours: int = 24) -> int
     """
     until = _utc_now() + timedelta(hours=hours)
     reason = f"chat_id={chat_id};until={_iso_utc(until)}"
-    return await insert_history(user_id, "hero_set", None, reason)
+    return await insert_history(user_id, "hero_set", None, reason, chat_id=chat_id, payload={"until": _iso_utc(until)})
+
+def _hero_until(payload) -> datetime | None:
+    raw = _payload(payload).get("until")
+    if raw:
+        try:
+            return datetime.fromisoformat(raw)
+        except Exception:
+            return None
+    return None
+
+# проекция: {chat_id: deque[(user_id, until)]} — последние 20 назначений, свежие первыми
+_HEROES: Dict[int, deque] = {}
+
+@_projection("heroes", ("hero_set",), _HEROES.clear)
+def _heroes_apply(ev: HistoryEvent):
+    if ev.chat_id is not None:
+        _HEROES.setdefault(int(ev.chat_id), deque(maxlen=20)).appendleft((ev.user_id, _hero_until(ev.payload)))
+
+async def _hero_rows(chat_id: int) -> list[tuple[int, datetime | None]]:
+    # последние назначения героя в чате: [(user_id, until)], свежие первыми
+    if _proj_ready("heroes"):
+        return list(_HEROES.get(int(chat_id), ()))
+    async with _reader() as db:
+        async with db.execute("""
+            SELECT user_id, payload FROM history
+            WHERE action='hero_set' AND chat_id=? AND id > ?
+            ORDER BY id DESC LIMIT 20
+        """, (chat_id, _club_since())) as cur:
+            rows = await cur.fetchall()
+    return [(uid, _hero_until(payload)) for uid, payload in rows]
 
 async def hero_get_current(chat_id: int) -> int | None:
     """
     Вернёт user_id героя, если ещё актуален в данном чате, иначе None.
     Берём последний hero_set для chat_id и проверяем until > now.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT user_id, reason FROM history
-            WHERE action='hero_set' AND reason LIKE ?
-            ORDER BY id DESC LIMIT 20
-        """, (f"%chat_id={chat_id}%",)) as cur:
-            rows = await cur.fetchall()
-
     now = _utc_now()
-    for uid, reason in rows:
-        until = None
-        for part in (reason or "").split(";"):
-            p = part.strip()
-            if p.startswith("until="):
-                try:
-                    until = datetime.fromisoformat(p.split("=",1)[1])
-                except Exception:
-                    until = None
+    for uid, until in await _hero_rows(chat_id):
         if until and now < until:
             return int(uid)
         # если встретили протухшую запись — продолжаем искать выше по истории
@@ -1077,50 +2966,25 @@ async def hero_has_claimed_today(chat_id: int, user_id: int, hours: int = 0) ->
     True, если с последнего hero_claim в этом чате прошло меньше `hours` часов.
     По умолчанию — 12 часов.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT date FROM history
-            WHERE user_id=? AND action='hero_claim' AND reason LIKE ?
+    async with _reader() as db:
+        async with db.execute(f"""
+            SELECT {SQL_NOW_TS} - ts FROM history
+            WHERE user_id=? AND action='hero_claim' AND chat_id=? AND id > ?
             ORDER BY id DESC LIMIT 1
-        """, (user_id, f"%chat_id={chat_id}%")) as cur:
+        """, (user_id, chat_id, _club_since())) as cur:
             row = await cur.fetchone()
 
-    if not row:
-        return False
-
-    # SQLite кладёт 'YYYY-MM-DD HH:MM:SS' (без таймзоны) — считаем это UTC.
-    ts = row[0]
-    try:
-        last = datetime.fromisoformat(ts + ("+00:00" if "Z" not in ts and "+" not in ts else ""))
-    except Exception:
+    if not row or row[0] is None:
         return False
-
-    now = datetime.now(timezone.utc)
-    return (now - last) < timedelta(hours=hours)
+    return int(row[0]) < hours * 3600
 
 async def hero_record_claim(chat_id: int, user_id: int, amount: int):
     """Фиксируем разовый гонорар героя дня в конкретном чате."""
-    await insert_history(user_id, "hero_claim", amount, f"chat_id={chat_id}")
+    await insert_history(user_id, "hero_claim", amount, f"chat_id={chat_id}", chat_id=chat_id)
 
 async def hero_get_current_with_until(chat_id: int) -> tuple[int | None, datetime | None]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT user_id, reason FROM history
-            WHERE action='hero_set' AND reason LIKE ?
-            ORDER BY id DESC LIMIT 20
-        """, (f"%chat_id={chat_id}%",)) as cur:
-            rows = await cur.fetchall()
-
     now = _utc_now()
-    for uid, reason in rows:
-        until = None
-        for part in (reason or "").split(";"):
-            p = part.strip()
-            if p.startswith("until="):
-                try:
-                    until = datetime.fromisoformat(p.split("=",1)[1])
-                except Exception:
-                    until = None
+    for uid, until in await _hero_rows(chat_id):
         if until and now < until:
             return int(uid), until
         if until:
@@ -1177,6 +3041,38 @@ async def add_to_blacklist(uid: int) -> None:
     ids.add(int(uid))
     await _set_json_cfg(CFG_BLACKLIST, {"ids": list(ids)})
 
+async def strip_user(uid: int, reason: str, blacklist: bool = False) -> Dict[str, Any]:
+    """
+    Снять с игрока всё одной транзакцией: карман в ноль, все перки (minted--),
+    роль, ячейку; blacklist=True — ещё и занести в ЧС. Вернёт, что было снято.
+    """
+    uid = int(uid)
+    async with _writer() as db:
+        async with db.execute(f"SELECT {SQL_BALANCE} FROM users WHERE user_id=?", (uid,)) as cur:
+            row = await cur.fetchone()
+        bal = int(row[0] or 0) if row else 0
+        if bal > 0:
+            await _debit_tx(db, uid, bal, reason)
+        async with db.execute("SELECT perk_code FROM user_perks WHERE user_id=? ORDER BY perk_code", (uid,)) as cur:
+            perks = [code for (code,) in await cur.fetchall()]
+        for code in perks:
+            await revoke_perk(uid, code)
+        if perks:
+            # кэш конфига обновится только после COMMIT — minted правим одной записью
+            minted = await get_perk_minted()
+            for code in perks:
+                minted[code] = max(0, int(minted.get(code, 0)) - 1)
+            await _set_json_cfg(CFG_PERK_MINTED, minted)
+        async with db.execute("SELECT role_name, role_desc FROM roles WHERE user_id=?", (uid,)) as cur:
+            row = await cur.fetchone()
+        had_role = bool(row and (row[0] or row[1]))
+        if had_role:
+            await set_role(uid, None, None)
+        cell, _ = await _cell_take_tx(db, uid, 1 << 62, "bank_user_zero")
+        if blacklist:
+            await add_to_blacklist(uid)
+    return {"balance": bal, "perks": perks, "role": had_role, "cell": cell}
+
 async def remove_from_blacklist(uid: int) -> None:
     data = await _get_json_cfg(CFG_BLACKLIST)
     ids = set(int(x) for x in data.get("ids", []))
@@ -1185,28 +3081,19 @@ async def remove_from_blacklist(uid: int) -> None:
 
 # --- string config helpers (нужны для JSON-конфигов) ---
 async def get_config_str(key: str, default: str = "") -> str:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT reason FROM history WHERE action = ? ORDER BY id DESC LIMIT 1",
-            (f"config_str:{key}",)
-        )
-        row = await cur.fetchone()
-    if not row:
-        return default
-    try:
-        payload = json.loads(row[0])
-        return str(payload.get("value", default))
-    except Exception:
-        return str(row[0])
+    val = (await _cfg_cache()).get(key, (None, None))[1]
+    return val if val is not None else default
 
 async def set_config_str(key: str, value: str) -> None:
-    payload = json.dumps({"value": str(value)}, ensure_ascii=False)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO history (user_id, action, amount, reason) VALUES (?, ?, ?, ?)",
-            (0, f"config_str:{key}", 0, payload)
-        )
-        await db.commit()
+    value = str(value)
+    payload = json.dumps({"value": value}, ensure_ascii=False)
+    async with _writer() as db:
+        await _history_add(db, 0, "config_str", 0, key, payload=payload)
+        await db.execute("""
+            INSERT INTO config (key, str_value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(key) DO UPDATE SET str_value=excluded.str_value, updated_at=CURRENT_TIMESTAMP
+        """, (key, value))
+        _after_commit(lambda: _cfg_put(key, str_value=value))
 
 
 async def _get_json_cfg(key: str) -> dict:
@@ -1257,11 +3144,9 @@ async def recalc_perk_minted(perk_codes: list[str]) -> None:
     Вторичка (лоты игроков) не влияет.
     """
     m = {}
-    for uid in await get_known_users():
-        inv = await get_perks(uid)  # список кодов перков на руках
-        for code in inv:
-            k = str(code).strip().lower()
-            m[k] = m.get(k, 0) + 1
+    for code, cnt in await get_perks_summary():  # перки на руках у игроков
+        k = str(code).strip().lower()
+        m[k] = m.get(k, 0) + int(cnt)
 
     # ваучеры, если у тебя есть таблица/хранилище ваучеров:
     for code, cnt in await list_all_vouchers_counts():  # верни словарь {"кража":2,...}
@@ -1316,37 +3201,28 @@ async def add_generosity_points(user_id: int, pts: int, source: str):
     await insert_history(user_id, "generosity_add", pts, f"src={source}")
 
 async def get_generosity_points(user_id: int) -> int:
-    # сумма add - сумма списаний (выплат) в очках
-    total = 0
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT COALESCE(SUM(amount),0) FROM history
-            WHERE user_id=? AND action='generosity_add'
-        """,(user_id,)) as cur:
-            a = await cur.fetchone()
-            total += int(a[0] or 0)
-        async with db.execute("""
-            SELECT COALESCE(SUM(amount),0) FROM history
-            WHERE user_id=? AND action='generosity_pay_points'
-        """,(user_id,)) as cur:
-            b = await cur.fetchone()
-            total -= int(b[0] or 0)
-    return max(0, total)
+    # сумма add - сумма списаний (выплат) в очках, ведётся в user_state
+    async with _reader() as db:
+        async with db.execute("SELECT generosity_points FROM user_state WHERE user_id=?", (user_id,)) as cur:
+            row = await cur.fetchone()
+    return max(0, int(row[0] or 0)) if row else 0
 
 async def generosity_try_payout(user_id: int) -> int:
     """
     Если очки >= порога — списываем порог очков и выдаём столько же нуаров.
     Возвращает размер выплаты (0 если не было).
     """
-    points = await get_generosity_points(user_id)
     threshold = await get_generosity_threshold()
-    if points < threshold:
-        return 0
-    # списываем порог очков
-    await insert_history(user_id, "generosity_pay_points", threshold, None)
-    # выдаём столько же нуаров из сейфа
-    await insert_history(user_id, "generosity_payout", threshold, None)
-    await change_balance(user_id, threshold, "щедрость", user_id)
+    bl = await get_blacklist()
+    async with _writer() as db:
+        async with db.execute("SELECT generosity_points FROM user_state WHERE user_id=?", (user_id,)) as cur:
+            row = await cur.fetchone()
+        if not row or int(row[0] or 0) < threshold:
+            return 0
+        # списываем порог очков и выдаём столько же нуаров из сейфа
+        await _history_add(db, user_id, "generosity_pay_points", threshold, None)
+        await _history_add(db, user_id, "generosity_payout", threshold, None)
+        await _credit_tx(db, user_id, threshold, "щедрость", bl)
     return threshold
 
 
@@ -1374,39 +3250,48 @@ async def set_price_pin_loud(v: int):
 # codeword_cancel: user_id=куратор, amount=NULL, reason="chat_id=<id>;word=<w>"
 
 async def codeword_set(chat_id: int, word: str, prize: int, curator_id: int):
-    return await insert_history(curator_id, "codeword_set", prize, f"chat_id={chat_id};word={word};active=1")
+    return await insert_history(curator_id, "codeword_set", prize, f"chat_id={chat_id};word={word};active=1",
+                                chat_id=chat_id, payload={"word": word, "active": 1})
 
 async def codeword_cancel_active(chat_id: int, curator_id: int):
     cw = await codeword_get_active(chat_id)
     if not cw:
         return False
     word = cw["word"]
-    await insert_history(curator_id, "codeword_cancel", None, f"chat_id={chat_id};word={word}")
+    await insert_history(curator_id, "codeword_cancel", None, f"chat_id={chat_id};word={word}",
+                         chat_id=chat_id, payload={"word": word})
     # снимаем флаг активной (записываем «деактивацию» отдельной записью)
-    await insert_history(curator_id, "codeword_set", cw["prize"], f"chat_id={chat_id};word={word};active=0")
+    await insert_history(curator_id, "codeword_set", cw["prize"], f"chat_id={chat_id};word={word};active=0",
+                         chat_id=chat_id, payload={"word": word, "active": 0})
     return True
 
+# проекция: {chat_id: deque[(id, user_id, amount, payload, date)]} — последние 20 codeword_set
+_CODEWORDS: Dict[int, deque] = {}
+
+@_projection("codewords", ("codeword_set",), _CODEWORDS.clear)
+def _codewords_apply(ev: HistoryEvent):
+    if ev.chat_id is not None:
+        _CODEWORDS.setdefault(int(ev.chat_id), deque(maxlen=20)).appendleft(
+            (ev.id, ev.user_id, ev.amount, ev.payload, ev.date)
+        )
+
 async def codeword_get_active(chat_id: int):
     # ищем последнюю запись set для заданного чата и проверяем её активность
     last = None
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT id, user_id, amount, reason, date
-            FROM history WHERE action='codeword_set' AND reason LIKE ?
-            ORDER BY id DESC LIMIT 20
-        """, (f"%chat_id={chat_id}%",)) as cur:
-            rows = await cur.fetchall()
-    for rid, uid, amount, reason, date in rows:
-        # читаем word=...;active=x
-        word = None
-        active = None
-        for part in (reason or "").split(";"):
-            part = part.strip()
-            if part.startswith("word="):
-                word = part.split("=",1)[1]
-            elif part.startswith("active="):
-                try: active = int(part.split("=",1)[1])
-                except: active = None
+    if _proj_ready("codewords"):
+        rows = list(_CODEWORDS.get(int(chat_id), ()))
+    else:
+        async with _reader() as db:
+            async with db.execute("""
+                SELECT id, user_id, amount, payload, date
+                FROM history WHERE action='codeword_set' AND chat_id=? AND id > ?
+                ORDER BY id DESC LIMIT 20
+            """, (chat_id, _club_since())) as cur:
+                rows = await cur.fetchall()
+    for rid, uid, amount, payload, date in rows:
+        data = _payload(payload)
+        word = data.get("word")
+        active = data.get("active")
         if active == 1 and word:
             last = {"id": rid, "curator_id": uid, "prize": int(amount or 0), "word": word, "date": date}
             break
@@ -1415,47 +3300,61 @@ async def codeword_get_active(chat_id: int):
     return last
 
 async def codeword_mark_win(chat_id: int, winner_id: int, prize: int, word: str):
-    await insert_history(winner_id, "codeword_win", prize, f"chat_id={chat_id};word={word}")
+    await insert_history(winner_id, "codeword_win", prize, f"chat_id={chat_id};word={word}",
+                         chat_id=chat_id, payload={"word": word})
     # деактивируем
-    await insert_history(winner_id, "codeword_set", prize, f"chat_id={chat_id};word={word};active=0")
+    await insert_history(winner_id, "codeword_set", prize, f"chat_id={chat_id};word={word};active=0",
+                         chat_id=chat_id, payload={"word": word, "active": 0})
 
 
 # ==== NEW: обороты рынка ====
 # Суммируем суммы по событиям (perk_buy / emerald_buy / offer_sold) за окно в днях
 async def get_market_turnover_days(days: int) -> int:
-    total = 0
-    async with aiosqlite.connect(DB_PATH) as db:
-        for action in ("perk_buy", "emerald_buy", "offer_sold"):
-            async with db.execute(f"""
-                SELECT COALESCE(SUM(amount),0) FROM history
-                WHERE action='{action}' AND date >= datetime('now', ?)
-            """, (f'-{days} days',)) as cur:
-                row = await cur.fetchone()
-                total += int(row[0] or 0)
-    return total
+    async with _reader() as db:
+        async with db.execute(f"""
+            SELECT COALESCE(SUM(amount),0) FROM history_log
+            WHERE action_id IN (SELECT id FROM actions WHERE name IN ('perk_buy','emerald_buy','offer_sold'))
+              AND ts >= {SQL_NOW_TS} - ? AND id > ?
+        """, (int(days) * 86400, _club_since())) as cur:
+            row = await cur.fetchone()
+    return int(row[0] or 0)
 
 # ==== Ограбление банка (КД и лог) ====
 async def get_seconds_since_last_bank_rob(user_id: int) -> int | None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT CAST(strftime('%s','now') AS INTEGER) - CAST(strftime('%s', date) AS INTEGER)
-            FROM history
-            WHERE user_id=? AND action='bank_rob'
-            ORDER BY id DESC LIMIT 1
-        """, (user_id,)) as cur:
-            row = await cur.fetchone()
-            return None if row is None else int(row[0])
+    return await _user_state_since(user_id, "last_bank_rob_ts")
 
 async def record_bank_rob(user_id: int, outcome: str, amount: int):
     # outcome: success | fail | busted
     await insert_history(user_id, "bank_rob", amount, outcome)
 
+async def bank_rob(user_id: int, outcome: str, cooldown_sec: int) -> Tuple[Optional[int], int]:
+    """
+    Налёт одной транзакцией: проверка КД, запись попытки, при success — вынос всех
+    ячеек в карман, при busted — изъятие перка. Вернёт (остаток КД в секундах, добыча);
+    если КД не прошёл, ничего не записано и остаток не None.
+    """
+    bl = await get_blacklist()
+    async with _writer() as db:
+        async with db.execute(
+            f"SELECT {SQL_NOW_TS} - last_bank_rob_ts FROM user_state WHERE user_id=?", (user_id,)
+        ) as cur:
+            row = await cur.fetchone()
+        since = None if row is None or row[0] is None else int(row[0])
+        if since is not None and since < cooldown_sec:
+            return cooldown_sec - since, 0
+        loot = await _bank_sweep_tx(db) if outcome == "success" else 0
+        await _history_add(db, user_id, "bank_rob", loot, outcome)
+        if loot > 0:
+            await _credit_tx(db, user_id, loot, "bank_rob_success", bl)
+        if outcome == "busted":
+            await revoke_perk(user_id, "грабитель")
+    return None, loot
+
 async def touch_user(user_id: int, username: str | None = None):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _writer() as db:
         await ensure_user(db, user_id)
         if username is not None:
             await db.execute("UPDATE users SET username=? WHERE user_id=?", (username, user_id))
-            await db.commit()
 
 async def get_bravo_window_sec() -> int:
     return await get_config_int(CFG_BRAVO_WINDOW_SEC, 600)
@@ -1470,44 +3369,57 @@ async def set_pin_q_mult(v: int):
     await set_config_int(CFG_PIN_Q_MULT, max(1, v))
 
 async def hero_save_claim_msg(chat_id: int, hero_id: int, msg_id: int, ts_unix: int):
-    await insert_history(hero_id, "hero_claim_msg", None, f"chat_id={chat_id};msg_id={msg_id};ts={ts_unix}")
+    await insert_history(hero_id, "hero_claim_msg", None, f"chat_id={chat_id};msg_id={msg_id};ts={ts_unix}",
+                         chat_id=chat_id, ref_id=msg_id, payload={"ts": ts_unix})
+
+# проекция: {chat_id: (hero_id, msg_id, payload)} — последнее сообщение героя
+_HERO_CLAIM_MSGS: Dict[int, tuple] = {}
+
+@_projection("hero_claim_msgs", ("hero_claim_msg",), _HERO_CLAIM_MSGS.clear)
+def _hero_claim_msgs_apply(ev: HistoryEvent):
+    if ev.chat_id is not None:
+        _HERO_CLAIM_MSGS[int(ev.chat_id)] = (ev.user_id, ev.ref_id, ev.payload)
 
 async def hero_get_last_claim_msg(chat_id: int) -> dict|None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT user_id, reason, date FROM history
-            WHERE action='hero_claim_msg' AND reason LIKE ?
-            ORDER BY id DESC LIMIT 1
-        """,(f"%chat_id={chat_id}%",)) as cur:
-            row = await cur.fetchone()
+    if _proj_ready("hero_claim_msgs"):
+        row = _HERO_CLAIM_MSGS.get(int(chat_id))
+    else:
+        async with _reader() as db:
+            async with db.execute("""
+                SELECT user_id, ref_id, payload FROM history
+                WHERE action='hero_claim_msg' AND chat_id=? AND id > ?
+                ORDER BY id DESC LIMIT 1
+            """,(chat_id, _club_since())) as cur:
+                row = await cur.fetchone()
     if not row: return None
-    uid, reason, date = row
+    uid, msg_id, payload = row
     return {
         "hero_id": int(uid),
-        "msg_id": int(_reason_get(reason, "msg_id") or 0),
-        "ts": int(_reason_get(reason, "ts") or 0)
+        "msg_id": int(msg_id or 0),
+        "ts": int(_payload(payload).get("ts") or 0)
     }
 
 async def bravo_count_for_msg(chat_id: int, msg_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _reader() as db:
         async with db.execute("""
             SELECT COUNT(1) FROM history
-            WHERE action='bravo_claim' AND reason=?
-        """,(f"chat_id={chat_id};msg_id={msg_id}",)) as cur:
+            WHERE action='bravo_claim' AND chat_id=? AND ref_id=? AND id > ?
+        """,(chat_id, msg_id, _club_since())) as cur:
             row = await cur.fetchone()
             return int(row[0] or 0)
 
 async def bravo_already_claimed(user_id: int, chat_id: int, msg_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _reader() as db:
         async with db.execute("""
             SELECT 1 FROM history
-            WHERE user_id=? AND action='bravo_claim' AND reason=?
+            WHERE user_id=? AND action='bravo_claim' AND chat_id=? AND ref_id=? AND id > ?
             LIMIT 1
-        """,(user_id, f"chat_id={chat_id};msg_id={msg_id}")) as cur:
+        """,(user_id, chat_id, msg_id, _club_since())) as cur:
             return (await cur.fetchone()) is not None
 
 async def record_bravo(user_id: int, chat_id: int, msg_id: int, reward: int):
-    await insert_history(user_id, "bravo_claim", reward, f"chat_id={chat_id};msg_id={msg_id}")
+    await insert_history(user_id, "bravo_claim", reward, f"chat_id={chat_id};msg_id={msg_id}",
+                         chat_id=chat_id, ref_id=msg_id)
 
 # --- SAFE FREE = vault - bank(total) ---
 async def get_vault_free_amount() -> int:
@@ -1516,12 +3428,18 @@ async def get_vault_free_amount() -> int:
     свободный сейф = сейф - сумма всех ячеек (банк).
     Возвращает 0, если сейф выключен или ушли в минус.
     """
-    stats = await get_economy_stats()  # уже собирает текущий сейф
-    if not stats:
-        return 0
     # важно: сперва «дотронуться» до банка, чтобы применились комиссии хранения
-    total_bank = await bank_touch_all_and_total()
-    return max(0, int(stats["vault"]) - int(total_bank))
+    async with _reader() as db:
+        due = await _bank_due(db, await _now_ts(db))
+        st = await _econ_row(db)
+    if due:
+        await bank_touch_all_and_total()
+        async with _reader() as db:
+            st = await _econ_row(db)
+    if st["cap"] is None:
+        return 0
+    vault = max(0, st["cap"] - st["burned"] - st["circulating"])
+    return max(0, vault - st["bank_total"])
 
 
 ARMAGEDDON_PRICE_KEY = "armageddon_price"
@@ -1535,3 +3453,879 @@ async def get_armageddon_price() -> int:
 
 async def set_armageddon_price(n: int) -> None:
     await set_config_str(ARMAGEDDON_PRICE_KEY, str(max(0, int(n))))
+
+
+# ==== Архив history: холодные месячные файлы ====
+# Закрытые записи (состояние уже лежит в таблицах: config, cells, user_state,
+# user_perks, users.key, economy_state) старше ARCHIVE_AFTER_DAYS переносятся
+# в <каталог базы>/archive/history-YYYY-MM.sqlite — обычные SQLite-файлы, куда
+# только дописываем. Сначала строки фиксируются в архиве, потом удаляются из
+# history_log: после сбоя между шагами строка временно есть в обоих местах,
+# следующий проход дописывает её через INSERT OR IGNORE и удаляет из горячей.
+# Лоты, эскроу, vault_init, герои, код-слова, сбросы и журнал конфигов не
+# архивируются никогда (конфиги ужимает compact_config_log, их хвост остаётся
+# в горячей части). Месяц файла — по ts строки, а не по id: id и ts не обязаны
+# расти вместе, поэтому чтение нескольких месяцев сливает их по id.
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_BATCH = 5000
+ARCHIVE_MAX_BATCHES = 20          # за один проход задачи обслуживания
+ARCHIVE_EVERY_SEC = 6 * 3600
+ARCHIVE_DIR: Optional[str] = None  # None — рядом с DB_PATH
+ARCHIVE_ACTIONS = (
+    "change_balance", "blocked_blacklist", "reset_balance", "msg_processed",
+    "cell_dep", "cell_wd", "cell_fee", "cell_ts", "cell_deposit_fee",
+    "balance_adjust", "cell_adjust",
+    "grant_key", "revoke_key",
+    "generosity_add", "generosity_pay_points", "generosity_payout",
+    "theft", "bank_rob", "salary_claim",
+    "perk_grant", "perk_revoke", "perk_credit_add", "perk_credit_use",
+    "perk_buy", "emerald_buy", "hero_claim", "hero_claim_msg", "bravo_claim", "burn",
+)
+HISTORY_COLS = ("id", "user_id", "action", "amount", "reason", "date",
+                "chat_id", "ref_id", "perk_code", "payload", "ts", "balance_after", "cell_after")
+
+CREATE_ARCHIVE_HISTORY = """
+CREATE TABLE IF NOT EXISTS history (
+    id        INTEGER PRIMARY KEY,
+    user_id   INTEGER,
+    action    TEXT,
+    amount    INTEGER,
+    reason    TEXT,
+    date      TIMESTAMP,
+    chat_id   INTEGER,
+    ref_id    INTEGER,
+    perk_code TEXT,
+    payload   TEXT,
+    ts        INTEGER,
+    balance_after INTEGER,
+    cell_after    INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_archive_user ON history(user_id);
+CREATE INDEX IF NOT EXISTS idx_archive_action ON history(action);
+"""
+
+_ARCHIVE_STATS = {"runs": 0, "moved_total": 0, "last_moved": 0, "last_ts": 0}
+_ARCHIVE_LOCK = asyncio.Lock()
+
+def _archive_dir() -> str:
+    return ARCHIVE_DIR or os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "archive")
+
+def _archive_files() -> List[Tuple[str, str]]:
+    """[(YYYY-MM, путь)] по возрастанию месяца."""
+    d = _archive_dir()
+    if not os.path.isdir(d):
+        return []
+    out = []
+    for name in os.listdir(d):
+        m = re.fullmatch(r"history-(\d{4}-\d{2})\.sqlite", name)
+        if m:
+            out.append((m.group(1), os.path.join(d, name)))
+    return sorted(out)
+
+async def _archive_upgrade(adb):
+    """Файлы, созданные до v13, — без колонок цепочек балансов."""
+    await _add_column(adb, "history", "balance_after", "INTEGER")
+    await _add_column(adb, "history", "cell_after", "INTEGER")
+
+async def _archive_append(month: str, rows: List[tuple]):
+    os.makedirs(_archive_dir(), exist_ok=True)
+    path = os.path.join(_archive_dir(), f"history-{month}.sqlite")
+    async with aiosqlite.connect(path) as adb:
+        await adb.executescript(CREATE_ARCHIVE_HISTORY)
+        await _archive_upgrade(adb)
+        await adb.executemany(
+            f"INSERT OR IGNORE INTO history ({', '.join(HISTORY_COLS)}) VALUES ({', '.join('?' * len(HISTORY_COLS))})",
+            rows,
+        )
+        await adb.commit()
+
+async def history_archive_run(now_ts: Optional[int] = None) -> int:
+    """Перенести закрытые записи старше ARCHIVE_AFTER_DAYS в архив. Вернёт число строк."""
+    if _ARCHIVE_LOCK.locked():
+        return 0
+    async with _ARCHIVE_LOCK:
+        async with _reader() as db:
+            if now_ts is None:
+                now_ts = await _now_ts(db)
+            marks = ",".join("?" * len(ARCHIVE_ACTIONS))
+            async with db.execute(f"SELECT name, id FROM actions WHERE name IN ({marks})", ARCHIVE_ACTIONS) as cur:
+                ids = {name: int(aid) for name, aid in await cur.fetchall()}
+            epoch_id = (await _econ_row(db))["epoch_id"] or 0
+            # непроверенный хвост цепочек балансов (verify_balance_chains) не трогаем
+            chain_id = await _state_get(db, "chain_verified_id") or 0
+        if not ids:
+            return 0
+        cutoff = int(now_ts) - ARCHIVE_AFTER_DAYS * 86400
+        id_marks = ",".join("?" * len(ids))
+        # поиск по (action_id, ts); жалование с другим кодом и сжигания текущей
+        # эпохи ещё читаются из history — их оставляем
+        sql = f"""
+            SELECT h.id, h.user_id, a.name, h.amount, h.reason, h.date, h.chat_id, h.ref_id,
+                   h.perk_code, h.payload, h.ts, h.balance_after, h.cell_after
+            FROM history_log h JOIN actions a ON a.id = h.action_id
+            WHERE h.action_id IN ({id_marks}) AND h.ts < ?
+              AND (h.action_id <> ? OR h.reason = ?)
+              AND (h.action_id <> ? OR h.id < ?)
+              AND (h.id <= ? OR (h.balance_after IS NULL AND h.cell_after IS NULL))
+            ORDER BY h.id
+            LIMIT ?
+        """
+        params = (*ids.values(), cutoff,
+                  ids.get("salary_claim", -1), SALARY_STATE_CODE,
+                  ids.get("burn", -1), epoch_id, chain_id, ARCHIVE_BATCH)
+        moved = 0
+        for _ in range(ARCHIVE_MAX_BATCHES):
+            async with _reader() as db:
+                async with db.execute(sql, params) as cur:
+                    rows = await cur.fetchall()
+            if not rows:
+                break
+            by_month: Dict[str, List[tuple]] = {}
+            ts_col = HISTORY_COLS.index("ts")
+            for r in rows:
+                by_month.setdefault(_month_of(r[ts_col]), []).append(tuple(r))
+            for month, chunk in sorted(by_month.items()):
+                await _archive_append(month, chunk)
+            async with _writer() as db:
+                await db.execute(
+                    "DELETE FROM history_log WHERE id IN (SELECT value FROM json_each(?))",
+                    (json.dumps([r[0] for r in rows]),),
+                )
+            moved += len(rows)
+            if len(rows) < ARCHIVE_BATCH:
+                break
+    _ARCHIVE_STATS["runs"] += 1
+    _ARCHIVE_STATS["moved_total"] += moved
+    _ARCHIVE_STATS["last_moved"] = moved
+    _ARCHIVE_STATS["last_ts"] = int(time.time())
+    if moved:
+        logging.info("db: archived %s history rows to %s", moved, _archive_dir())
+    return moved
+
+async def iter_history(user_id: Optional[int] = None, action: Optional[str] = None,
+                       since_ts: Optional[int] = None, until_ts: Optional[int] = None,
+                       batch: int = 1000):
+    """
+    Журнал по возрастанию id из архивных месяцев и горячей history вместе.
+    Строки — кортежи в порядке HISTORY_COLS. Для выгрузок и разборов.
+    """
+    where, args = [], []
+    if user_id is not None:
+        where.append("user_id = ?"); args.append(int(user_id))
+    if action is not None:
+        where.append("action = ?"); args.append(action)
+    if since_ts is not None:
+        where.append("ts >= ?"); args.append(int(since_ts))
+    if until_ts is not None:
+        where.append("ts < ?"); args.append(int(until_ts))
+    cond = " AND ".join(where) or "1"
+    cols = ", ".join(HISTORY_COLS)
+
+    since_month = (datetime.fromtimestamp(since_ts, timezone.utc).strftime("%Y-%m")
+                   if since_ts is not None else None)
+    until_month = (datetime.fromtimestamp(until_ts, timezone.utc).strftime("%Y-%m")
+                   if until_ts is not None else None)
+
+    async def cold():
+        # месяцы разбиты по ts, поэтому диапазоны id соседних файлов могут
+        # перекрываться — сливаем все файлы по id
+        paths = [path for month, path in _archive_files()
+                 if not ((since_month and month < since_month) or (until_month and month > until_month))]
+        async with AsyncExitStack() as stack:
+            heap = []
+            its = []
+            for path in paths:
+                adb = await stack.enter_async_context(aiosqlite.connect(f"file:{path}?mode=ro", uri=True))
+                cur = await stack.enter_async_context(
+                    adb.execute(f"SELECT {cols} FROM history WHERE {cond} ORDER BY id", args)
+                )
+                it = cur.__aiter__()
+                row = await anext(it, None)
+                if row is not None:
+                    heap.append((row[0], len(its), tuple(row)))
+                its.append(it)
+            heapq.heapify(heap)
+            while heap:
+                _rid, i, row = heapq.heappop(heap)
+                yield row
+                nxt = await anext(its[i], None)
+                if nxt is not None:
+                    heapq.heappush(heap, (nxt[0], i, tuple(nxt)))
+
+    async def hot():
+        # кусками, не держа читателя между выдачами
+        last_id = 0
+        while True:
+            async with _reader() as db:
+                async with db.execute(
+                    f"SELECT {cols} FROM history WHERE {cond} AND id > ? ORDER BY id LIMIT ?",
+                    (*args, last_id, batch),
+                ) as cur:
+                    rows = await cur.fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield tuple(row)
+            last_id = rows[-1][0]
+
+    # слияние двух упорядоченных потоков; одинаковый id (строка, недоудалённая
+    # после сбоя архиватора) выдаём один раз
+    c_it, h_it = cold(), hot()
+    c = await anext(c_it, None)
+    h = await anext(h_it, None)
+    while c is not None or h is not None:
+        if h is None or (c is not None and c[0] <= h[0]):
+            if h is not None and c[0] == h[0]:
+                h = await anext(h_it, None)
+            yield c
+            c = await anext(c_it, None)
+        else:
+            yield h
+            h = await anext(h_it, None)
+
+def get_archive_stats() -> Dict[str, Any]:
+    files = _archive_files()
+    return {
+        "dir": _archive_dir(),
+        "files": len(files),
+        "months": f"{files[0][0]}..{files[-1][0]}" if files else "—",
+        "size_kb": sum(os.path.getsize(p) for _, p in files) // 1024,
+        "after_days": ARCHIVE_AFTER_DAYS,
+        **_ARCHIVE_STATS,
+    }
+
+
+# ==== Сверка таблиц состояния с журналом ====
+# Один проход по history (архив + горячая часть, по возрастанию id, кусками)
+# пересобирает балансы, перки, ваучеры, эскроу, ячейки и очки щедрости.
+# Память — O(пользователей), не O(строк). Хвост журнала, пришедший за время
+# прохода, дочитывается уже внутри транзакции записи — сравнение и исправления
+# видят согласованный снимок.
+RECONCILE_SAMPLE = 10   # сколько расхождений на раздел показывать
+RECONCILE_BATCH = 5000
+
+class _Rebuild:
+    __slots__ = ("balances", "perks", "credits", "escrow", "cells", "generosity", "last_id", "rows")
+
+    def __init__(self):
+        self.balances: Dict[int, int] = {}
+        self.perks: set = set()
+        self.credits: Dict[tuple, int] = {}
+        self.escrow: Dict[int, tuple] = {}
+        self.cells: Dict[int, int] = {}
+        self.generosity: Dict[int, int] = {}
+        self.last_id = 0
+        self.rows = 0
+
+    def apply(self, row: tuple):
+        rid, uid, action, amount, _reason, _date, _chat, ref_id, perk_code = row[:9]
+        self.last_id = rid
+        self.rows += 1
+        if action == CLUB_RESET_ACTION:
+            # всё состояние начинается заново; балансы — нулями, как в SQL_BALANCE
+            self.balances = dict.fromkeys(self.balances, 0)
+            for part in (self.perks, self.credits, self.escrow, self.cells, self.generosity):
+                part.clear()
+            return
+        if uid is None and action != "reset_all_balances":
+            return
+        amount = int(amount or 0)
+        if action == "change_balance":
+            # как в change_balance: баланс не уходит ниже нуля
+            self.balances[uid] = max(0, self.balances.get(uid, 0) + amount)
+        elif action == "reset_balance":
+            self.balances[uid] = 0
+        elif action == "reset_all_balances":
+            self.balances = dict.fromkeys(self.balances, 0)
+        elif action == "perk_grant":
+            self.perks.add((uid, perk_code))
+        elif action == "perk_revoke":
+            self.perks.discard((uid, perk_code))
+        elif action == "perk_credit_add":
+            self.credits[(uid, perk_code)] = self.credits.get((uid, perk_code), 0) + 1
+        elif action == "perk_credit_use":
+            left = self.credits.get((uid, perk_code), 0) - 1
+            if left > 0:
+                self.credits[(uid, perk_code)] = left
+            else:
+                self.credits.pop((uid, perk_code), None)
+        elif action == "perk_escrow_open":
+            self.escrow[ref_id] = (uid, perk_code)
+        elif action == "perk_escrow_close":
+            self.escrow.pop(ref_id, None)
+        elif action == "cell_dep":
+            self.cells[uid] = self.cells.get(uid, 0) + amount
+        elif action in ("cell_wd", "cell_fee"):
+            self.cells[uid] = max(0, self.cells.get(uid, 0) - amount)
+        elif action == "generosity_add":
+            self.generosity[uid] = self.generosity.get(uid, 0) + amount
+        elif action == "generosity_pay_points":
+            self.generosity[uid] = self.generosity.get(uid, 0) - amount
+
+def _diff_maps(table: Dict, rebuilt: Dict, default=0) -> List[tuple]:
+    """[(ключ, в_таблице, по_журналу)] для несовпадающих ключей."""
+    out = []
+    for k in table.keys() | rebuilt.keys():
+        a, b = table.get(k, default), rebuilt.get(k, default)
+        if a != b:
+            out.append((k, a, b))
+    out.sort(key=lambda d: str(d[0]))
+    return out
+
+async def _reconcile_tables(db) -> Dict[str, Dict[Any, Any]]:
+    async def fetch(sql):
+        async with db.execute(sql) as cur:
+            return await cur.fetchall()
+    return {
+        "balances": {u: int(b or 0) for u, b in await fetch(f"SELECT user_id, {SQL_BALANCE} FROM users")},
+        "perks": {(u, c): 1 for u, c in await fetch("SELECT user_id, perk_code FROM user_perks")},
+        "credits": {(u, c): int(n) for u, c, n in await fetch("SELECT user_id, perk_code, credits FROM perk_credits WHERE credits > 0")},
+        "escrow": {o: (u, c) for o, u, c in await fetch("SELECT offer_id, user_id, perk_code FROM perk_escrow")},
+        "cells": {u: int(b or 0) for u, b in await fetch("SELECT user_id, balance FROM cells")},
+        "generosity": {u: int(p or 0) for u, p in await fetch("SELECT user_id, generosity_points FROM user_state")},
+    }
+
+# поправки сверки пишутся в журнал своими действиями: amount — изменение таблицы,
+# *_after — значение после. Пересборка их пропускает (журнал и так даёт это значение),
+# цепочка балансов от такой строки отсчитывается заново
+RECONCILE_REASON = "сверка"
+RECONCILE_ACTIONS = ("balance_adjust", "cell_adjust", "perk_adjust", "perk_credit_adjust",
+                     "perk_escrow_adjust", "generosity_adjust")
+
+async def _reconcile_fix(db, diffs: Dict[str, List[tuple]]):
+    for uid, have, val in diffs["balances"]:
+        await ensure_user(db, uid)
+        await db.execute("UPDATE users SET balance=? WHERE user_id=?", (val, uid))
+        await _history_add(db, uid, "balance_adjust", val - have, RECONCILE_REASON, balance_after=val)
+        _after_commit(lambda uid=uid, val=val: _bal_put(uid, val))
+    for (uid, code), _, want in diffs["perks"]:
+        if want:
+            await db.execute("INSERT OR IGNORE INTO user_perks (user_id, perk_code) VALUES (?, ?)", (uid, code))
+        else:
+            await db.execute("DELETE FROM user_perks WHERE user_id=? AND perk_code=?", (uid, code))
+        await _history_add(db, uid, "perk_adjust", 1 if want else -1, RECONCILE_REASON, perk_code=code)
+    for (uid, code), have, n in diffs["credits"]:
+        if n > 0:
+            await db.execute("""
+                INSERT INTO perk_credits (user_id, perk_code, credits) VALUES (?, ?, ?)
+                ON CONFLICT(user_id, perk_code) DO UPDATE SET credits=excluded.credits
+            """, (uid, code, n))
+        else:
+            await db.execute("DELETE FROM perk_credits WHERE user_id=? AND perk_code=?", (uid, code))
+        await _history_add(db, uid, "perk_credit_adjust", n - have, RECONCILE_REASON, perk_code=code)
+    for offer_id, have, want in diffs["escrow"]:
+        if want is None:
+            await db.execute("DELETE FROM perk_escrow WHERE offer_id=?", (offer_id,))
+            uid, code = have
+        else:
+            await db.execute("INSERT OR REPLACE INTO perk_escrow (offer_id, user_id, perk_code) VALUES (?, ?, ?)",
+                             (offer_id, want[0], want[1]))
+            uid, code = want
+        await _history_add(db, uid, "perk_escrow_adjust", 1 if want else -1, RECONCILE_REASON,
+                           ref_id=offer_id, perk_code=code)
+    now = await _now_ts(db)
+    for uid, have, bal in diffs["cells"]:
+        # новая ячейка начинает отсчёт хранения сейчас (при last_ts NULL плата не начисляется)
+        await db.execute("""
+            INSERT INTO cells (user_id, balance, last_ts) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET balance=excluded.balance,
+                                               last_ts=COALESCE(cells.last_ts, excluded.last_ts)
+        """, (uid, bal, now))
+        await _history_add(db, uid, "cell_adjust", bal - have, RECONCILE_REASON, cell_after=bal)
+    for uid, have, pts in diffs["generosity"]:
+        await db.execute("""
+            INSERT INTO user_state (user_id, generosity_points) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET generosity_points=excluded.generosity_points
+        """, (uid, pts))
+        await _history_add(db, uid, "generosity_adjust", pts - have, RECONCILE_REASON)
+    # счётчики экономики — по исправленным таблицам
+    await _econ_store(db, await _econ_recompute(db))
+
+async def reconcile_projections(fix: bool = False) -> Dict[str, Any]:
+    """
+    Пересобрать состояние из журнала и сравнить с таблицами.
+    fix=True — записать пересобранные значения. Вернёт отчёт по разделам.
+    """
+    t0 = time.perf_counter()
+    rb = _Rebuild()
+    async with _ARCHIVE_LOCK:  # архиватор не переносит строки посреди прохода
+        async for row in iter_history(batch=RECONCILE_BATCH):
+            rb.apply(row)
+        streamed = time.perf_counter() - t0
+        return await _reconcile_finish(rb, fix, t0, streamed)
+
+async def _reconcile_finish(rb: _Rebuild, fix: bool, t0: float, streamed: float) -> Dict[str, Any]:
+    async with _writer(timeout=None) as db:
+        # дочитываем то, что закоммитили за время прохода
+        async with db.execute(
+            "SELECT id, user_id, action, amount, reason, date, chat_id, ref_id, perk_code FROM history WHERE id > ? ORDER BY id",
+            (rb.last_id,),
+        ) as cur:
+            async for row in cur:
+                rb.apply(tuple(row))
+        tables = await _reconcile_tables(db)
+        rebuilt = {
+            "balances": rb.balances,
+            "perks": dict.fromkeys(rb.perks, 1),
+            "credits": rb.credits,
+            "escrow": rb.escrow,
+            "cells": rb.cells,
+            "generosity": rb.generosity,
+        }
+        diffs = {}
+        for name in rebuilt:
+            default = None if name == "escrow" else 0
+            d = _diff_maps(tables[name], rebuilt[name], default)
+            if name == "perks":
+                d = [(k, bool(a), bool(b)) for k, a, b in d]
+            diffs[name] = d
+        if fix and any(diffs.values()):
+            await _reconcile_fix(db, diffs)
+
+    report: Dict[str, Any] = {
+        "rows": rb.rows,
+        "last_id": rb.last_id,
+        "stream_sec": round(streamed, 2),
+        "total_sec": round(time.perf_counter() - t0, 2),
+        "fixed": bool(fix and any(diffs.values())),
+    }
+    for name, d in diffs.items():
+        report[name] = {"diffs": len(d), "sample": d[:RECONCILE_SAMPLE]}
+    if any(diffs.values()):
+        logging.warning("reconcile: %s", {k: len(v) for k, v in diffs.items()})
+    return report
+
+
+# ------- цепочки балансов: balance_after / cell_after -------
+# Каждая строка history, меняющая карман или ячейку, хранит баланс после себя
+# (в той же транзакции). «Баланс на дату» — одна строка по индексу цепочки,
+# выписка — страница по ключу (ts, id). Сверка цепочки идёт инкрементально:
+# с сохранённого id проверяем prev -> next и хвост против таблиц.
+
+CHAIN_BALANCE_ACTIONS = ("change_balance", "reset_balance", "reset_all_balances", "balance_adjust")
+CHAIN_CELL_ACTIONS = ("cell_dep", "cell_wd", "cell_fee", "cell_adjust")
+# поправки сверки задают значение после себя, а не шаг от предыдущего
+CHAIN_ANCHOR_ACTIONS = ("balance_adjust", "cell_adjust")
+CHAIN_VERIFY_SEC = 1800
+CHAIN_VERIFY_BATCH = 5000
+STATEMENT_PAGE = 15
+
+_CHAIN_STATS = {"runs": 0, "rows_total": 0, "breaks_total": 0, "table_diffs": 0, "last_id": 0, "last_ts": 0}
+
+def _chain_step(action: str, prev: int, amount: Optional[int]) -> int:
+    """Баланс после строки по балансу до неё (правила change_balance и ячеек)."""
+    amount = int(amount or 0)
+    if action == "change_balance":
+        return max(0, prev + amount)
+    if action in ("cell_dep", "balance_adjust", "cell_adjust"):
+        return prev + amount
+    if action in ("cell_wd", "cell_fee"):
+        return max(0, prev - amount)
+    return 0  # reset_balance
+
+def _month_of(ts: int) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m")
+
+async def _chain_backfill(db):
+    """Миграция v13: проставить цепочки по всему журналу (архив + горячая часть)."""
+    names = CHAIN_BALANCE_ACTIONS + CHAIN_CELL_ACTIONS
+    marks = ",".join("?" * len(names))
+    events: List[tuple] = []  # (id, user_id, action, amount, файл архива или None)
+    for _month, path in _archive_files():
+        async with aiosqlite.connect(path) as adb:
+            await _archive_upgrade(adb)
+            await adb.commit()
+            async with adb.execute(
+                f"SELECT id, user_id, action, amount FROM history WHERE action IN ({marks})", names
+            ) as cur:
+                events.extend((*r, path) for r in await cur.fetchall())
+    async with db.execute(f"""
+        SELECT h.id, h.user_id, a.name, h.amount FROM history_log h JOIN actions a ON a.id = h.action_id
+        WHERE h.action_id IN (SELECT id FROM actions WHERE name IN ({marks}))
+    """, names) as cur:
+        events.extend((*r, None) for r in await cur.fetchall())
+    events.sort(key=lambda e: e[0])
+
+    bal: Dict[int, int] = {}
+    cell: Dict[int, int] = {}
+    updates: Dict[Optional[str], List[tuple]] = {}
+    for rid, uid, action, amount, src in events:
+        if action == "reset_all_balances":
+            bal = dict.fromkeys(bal, 0)
+            continue
+        if uid is None:
+            continue
+        if action in CHAIN_BALANCE_ACTIONS:
+            bal[uid] = _chain_step(action, bal.get(uid, 0), amount)
+            updates.setdefault(src, []).append((bal[uid], None, rid))
+        else:
+            cell[uid] = _chain_step(action, cell.get(uid, 0), amount)
+            updates.setdefault(src, []).append((None, cell[uid], rid))
+
+    sql = "UPDATE {t} SET balance_after = COALESCE(?, balance_after), cell_after = COALESCE(?, cell_after) WHERE id = ?"
+    for src, rows in updates.items():
+        if src is None:
+            await db.executemany(sql.format(t="history_log"), rows)
+        else:
+            # архивные файлы правим отдельно; повтор миграции запишет те же значения
+            async with aiosqlite.connect(src) as adb:
+                await adb.executemany(sql.format(t="history"), rows)
+                await adb.commit()
+
+async def _chain_last(user_id: int, col: str, before: Tuple[int, int], db=None) -> Optional[tuple]:
+    """
+    Последняя строка цепочки col (balance_after/cell_after) с (ts, id) < before: (ts, id, значение).
+    db — уже открытое соединение (чтение в снимке вызывающего), иначе берём читателя.
+    """
+    ts, rid = before
+    sql = f"""
+        SELECT ts, id, {col} FROM {{t}}
+        WHERE user_id = ? AND {col} IS NOT NULL AND (ts < ? OR (ts = ? AND id < ?))
+        ORDER BY ts DESC, id DESC LIMIT 1
+    """
+    args = (int(user_id), ts, ts, rid)
+    async with (nullcontext(db) if db is not None else _reader()) as db:
+        async with db.execute(sql.format(t="history_log"), args) as cur:
+            best = await cur.fetchone()
+    best = tuple(best) if best else None
+    # архив: по месяцам назад, пока месяц не старше найденного в горячей части
+    for month, path in reversed(_archive_files()):
+        if month > _month_of(ts):
+            continue
+        if best is not None and month < _month_of(best[0]):
+            break
+        async with aiosqlite.connect(f"file:{path}?mode=ro", uri=True) as adb:
+            async with adb.execute(sql.format(t="history"), args) as cur:
+                row = await cur.fetchone()
+        if row is not None:
+            if best is None or tuple(row[:2]) > best[:2]:
+                best = tuple(row)
+            break
+    return best
+
+# сбросы, обнуляющие цепочку (общие строки user_id=NULL; не архивируются)
+CHAIN_RESETS = {
+    "balance_after": ("reset_all_balances", CLUB_RESET_ACTION),
+    "cell_after": (CLUB_RESET_ACTION,),
+}
+
+async def _reset_all_before(before: Tuple[int, int], col: str = "balance_after",
+                            db=None) -> Optional[Tuple[int, int]]:
+    ts, rid = before
+    names = CHAIN_RESETS[col]
+    async with (nullcontext(db) if db is not None else _reader()) as db:
+        async with db.execute(f"""
+            SELECT ts, id FROM history_log
+            WHERE action_id IN (SELECT id FROM actions WHERE name IN ({",".join("?" * len(names))}))
+              AND (ts < ? OR (ts = ? AND id < ?))
+            ORDER BY ts DESC, id DESC LIMIT 1
+        """, (*names, ts, ts, rid)) as cur:
+            row = await cur.fetchone()
+    return tuple(row) if row else None
+
+async def get_balance_at(user_id: int, ts: int) -> int:
+    """Баланс кармана на момент ts (по последней строке цепочки до него)."""
+    last = await _chain_last(user_id, "balance_after", (int(ts), 0))
+    reset = await _reset_all_before((int(ts), 0))
+    if last is None or (reset is not None and reset > last[:2]):
+        return 0
+    return int(last[2])
+
+async def get_cell_balance_at(user_id: int, ts: int) -> int:
+    """Баланс ячейки на момент ts (без ещё не списанного хранения)."""
+    last = await _chain_last(user_id, "cell_after", (int(ts), 0))
+    reset = await _reset_all_before((int(ts), 0), "cell_after")
+    if last is None or (reset is not None and reset > last[:2]):
+        return 0
+    return int(last[2])
+
+async def _history_key(rid: int) -> Optional[Tuple[int, int]]:
+    """(ts, id) строки по id — из горячей части или архива."""
+    async with _reader() as db:
+        async with db.execute("SELECT ts FROM history_log WHERE id = ?", (int(rid),)) as cur:
+            row = await cur.fetchone()
+    if row is None:
+        for _month, path in reversed(_archive_files()):
+            async with aiosqlite.connect(f"file:{path}?mode=ro", uri=True) as adb:
+                async with adb.execute("SELECT ts FROM history WHERE id = ?", (int(rid),)) as cur:
+                    row = await cur.fetchone()
+            if row is not None:
+                break
+    return (int(row[0]), int(rid)) if row and row[0] is not None else None
+
+async def get_statement(user_id: int, before_id: Optional[int] = None,
+                        limit: int = STATEMENT_PAGE) -> Tuple[List[tuple], Optional[int]]:
+    """
+    Страница выписки кармана от новых к старым: [(id, date, action, amount, reason, balance_after)]
+    и id для следующей страницы (None — дальше пусто).
+    """
+    key = (1 << 62, 0)
+    if before_id is not None:
+        key = await _history_key(before_id)
+        if key is None:
+            return [], None
+    ts, rid = key
+    where = "user_id = ? AND balance_after IS NOT NULL AND (ts < ? OR (ts = ? AND id < ?))"
+    args = (int(user_id), ts, ts, rid, limit + 1)
+    async with _reader() as db:
+        async with db.execute(f"""
+            SELECT ts, id, date, (SELECT name FROM actions WHERE actions.id = h.action_id),
+                   amount, reason, balance_after
+            FROM history_log h WHERE {where}
+            ORDER BY ts DESC, id DESC LIMIT ?
+        """, args) as cur:
+            rows = [tuple(r) for r in await cur.fetchall()]
+    cold: List[tuple] = []
+    for month, path in reversed(_archive_files()):
+        if before_id is not None and month > _month_of(ts):
+            continue
+        if len(cold) > limit or (len(rows) > limit and month < _month_of(rows[limit][0])):
+            break
+        async with aiosqlite.connect(f"file:{path}?mode=ro", uri=True) as adb:
+            async with adb.execute(f"""
+                SELECT ts, id, date, action, amount, reason, balance_after FROM history
+                WHERE {where} ORDER BY ts DESC, id DESC LIMIT ?
+            """, args) as cur:
+                cold.extend(tuple(r) for r in await cur.fetchall())
+    merged = sorted({r[1]: r for r in rows + cold}.values(), key=lambda r: r[:2], reverse=True)
+    page = [r[1:] for r in merged[:limit]]
+    return page, (page[-1][0] if len(merged) > limit else None)
+
+async def verify_balance_chains() -> Dict[str, Any]:
+    """
+    Инкрементальная сверка цепочек с сохранённого id: каждая новая строка
+    должна продолжать предыдущую (prev -> шаг -> after), а последние значения
+    затронутых пользователей — совпадать с users/cells. Всё в одном снимке чтения.
+    """
+    rows = 0
+    breaks: List[tuple] = []
+    last: Dict[Tuple[str, int], tuple] = {}  # (цепочка, user_id) -> (ts, id, значение)
+    reset_at: Dict[str, Tuple[int, int]] = {}  # цепочка -> последний сброс в проходе
+    # один читатель и одна транзакция чтения на весь проход; хелперы получают его же db
+    async with _reader() as db:
+        await db.execute("BEGIN")
+        try:
+            start = await _state_get(db, "chain_verified_id") or 0
+            last_id = start
+            while True:
+                async with db.execute("""
+                    SELECT h.id, h.ts, h.user_id, a.name, h.amount, h.balance_after, h.cell_after
+                    FROM history_log h LEFT JOIN actions a ON a.id = h.action_id
+                    WHERE h.id > ? AND (h.balance_after IS NOT NULL OR h.cell_after IS NOT NULL
+                                        OR a.name IN ('reset_all_balances', ?))
+                    ORDER BY h.id LIMIT ?
+                """, (last_id, CLUB_RESET_ACTION, CHAIN_VERIFY_BATCH)) as cur:
+                    batch = await cur.fetchall()
+                if not batch:
+                    break
+                for rid, ts, uid, action, amount, bal_after, cell_after in batch:
+                    last_id = rid
+                    rows += 1
+                    if action in ("reset_all_balances", CLUB_RESET_ACTION):
+                        cols = [c for c, names in CHAIN_RESETS.items() if action in names]
+                        for c in cols:
+                            reset_at[c] = (ts, rid)
+                        for k in list(last):
+                            if k[0] in cols:
+                                last[k] = (ts, rid, 0)
+                        continue
+                    for col, val in (("balance_after", bal_after), ("cell_after", cell_after)):
+                        if val is None or uid is None:
+                            continue
+                        prev = last.get((col, uid))
+                        if prev is None:
+                            prev = await _chain_last(uid, col, (ts, rid), db) or (0, 0, 0)
+                            r = reset_at.get(col) or await _reset_all_before((ts, rid), col, db)
+                            if r is not None and r > prev[:2]:
+                                prev = (*r, 0)
+                        if action in CHAIN_ANCHOR_ACTIONS:
+                            want = val
+                        else:
+                            want = _chain_step(action, int(prev[2]), amount)
+                        if want != val:
+                            breaks.append((rid, uid, col, want, val))
+                        last[(col, uid)] = (ts, rid, val)
+            # хвост против таблиц — в том же снимке
+            table_diffs: List[tuple] = []
+            for (col, uid), (_ts, _rid, val) in last.items():
+                sql = (f"SELECT {SQL_BALANCE} FROM users WHERE user_id = ?" if col == "balance_after"
+                       else "SELECT balance FROM cells WHERE user_id = ?")
+                async with db.execute(sql, (uid,)) as cur:
+                    row = await cur.fetchone()
+                have = int(row[0] or 0) if row else 0
+                if have != val:
+                    table_diffs.append((uid, col, val, have))
+        finally:
+            await db.execute("COMMIT")
+    if last_id != start:
+        async with _writer() as db:
+            await _state_set(db, "chain_verified_id", last_id)
+    _CHAIN_STATS["runs"] += 1
+    _CHAIN_STATS["rows_total"] += rows
+    _CHAIN_STATS["breaks_total"] += len(breaks)
+    _CHAIN_STATS["table_diffs"] = len(table_diffs)
+    _CHAIN_STATS["last_id"] = last_id
+    _CHAIN_STATS["last_ts"] = int(time.time())
+    if breaks or table_diffs:
+        logging.warning("balance chains: %s breaks, %s table diffs (e.g. %s %s)",
+                        len(breaks), len(table_diffs), breaks[:3], table_diffs[:3])
+    return {"rows": rows, "breaks": breaks[:RECONCILE_SAMPLE], "breaks_total": len(breaks),
+            "table_diffs": table_diffs[:RECONCILE_SAMPLE], "table_diffs_total": len(table_diffs)}
+
+def get_chain_stats() -> Dict[str, Any]:
+    return dict(_CHAIN_STATS)
+
+
+# ------- резервные копии -------
+# Онлайн-бэкап через SQLite backup API: отдельное соединение только для чтения
+# держит одну транзакцию чтения (снимок WAL), страницы копируются шагами по
+# BACKUP_PAGES_PER_STEP с паузой между шагами — писатель и обработчики не ждут.
+# Копия сжимается в <каталог базы>/backups/club-YYYYmmdd-HHMMSS-h<id>.sqlite.gz,
+# где id — последний id history в снимке; хранятся BACKUP_KEEP последних.
+# Архивные месяцы (archive/) — отдельные файлы только на дозапись, в копию не входят.
+BACKUP_EVERY_SEC = 6 * 3600
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP = 0.005
+BACKUP_KEEP = 7
+BACKUP_DIR: Optional[str] = None  # None — рядом с DB_PATH
+
+_BACKUP_LOCK = asyncio.Lock()
+_BACKUP_STATS: Dict[str, Any] = {
+    "runs": 0, "failed": 0, "restores": 0, "last_sec": 0.0, "max_sec": 0.0,
+    "last_pages": 0, "last_steps": 0, "pages_per_step": 0, "last_kb": 0,
+    "last_history_id": 0, "last_file": "—", "last_ts": 0,
+}
+
+def _backup_dir() -> str:
+    return BACKUP_DIR or os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "backups")
+
+def _backup_files() -> List[Tuple[str, str]]:
+    """[(имя, путь)] от новых к старым."""
+    d = _backup_dir()
+    if not os.path.isdir(d):
+        return []
+    out = [(n, os.path.join(d, n)) for n in os.listdir(d)
+           if re.fullmatch(r"club-\d{8}-\d{6}-h\d+\.sqlite\.gz", n)]
+    # по времени записи: после восстановления id-водяной знак может уменьшиться
+    return sorted(out, key=lambda f: (os.path.getmtime(f[1]), f[0]), reverse=True)
+
+def _gzip_file(src: str, dst: str):
+    with open(src, "rb") as f_in, gzip.open(dst + ".part", "wb", compresslevel=6) as f_out:
+        shutil.copyfileobj(f_in, f_out, 1 << 20)
+    os.replace(dst + ".part", dst)
+
+def _gunzip_file(src: str, dst: str):
+    with gzip.open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out, 1 << 20)
+
+async def backup_run() -> Optional[str]:
+    """Снять онлайн-копию базы и сжать её. Вернёт имя файла (None — копия уже идёт)."""
+    if _BACKUP_LOCK.locked():
+        return None
+    async with _BACKUP_LOCK:
+        d = _backup_dir()
+        os.makedirs(d, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+        tmp = os.path.join(d, f".club-{stamp}.sqlite")
+        t0 = time.perf_counter()
+        progress = {"steps": 0, "pages": 0}
+
+        def on_step(_status, remaining, total):
+            # вызывается в потоке соединения после каждого шага
+            progress["steps"] += 1
+            progress["pages"] = total - remaining
+
+        try:
+            src = await aiosqlite.connect(f"file:{os.path.abspath(DB_PATH)}?mode=ro", uri=True, isolation_level=None)
+            try:
+                await src.execute("BEGIN")
+                # id-водяной знак и страницы — из одного снимка
+                async with src.execute("SELECT COALESCE(MAX(id), 0) FROM history_log") as cur:
+                    hid = int((await cur.fetchone())[0])
+                async with aiosqlite.connect(tmp) as dst:
+                    await src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=on_step, sleep=BACKUP_STEP_SLEEP)
+                    await src.execute("COMMIT")
+                    # копия — самостоятельный файл: без WAL, с отметкой снимка
+                    async with dst.execute("PRAGMA journal_mode=DELETE"):
+                        pass
+                    await _state_set(dst, "backup_history_id", hid)
+                    await dst.commit()
+            finally:
+                await src.close()
+            name = f"club-{stamp}-h{hid}.sqlite.gz"
+            await asyncio.to_thread(_gzip_file, tmp, os.path.join(d, name))
+        except Exception:
+            _BACKUP_STATS["failed"] += 1
+            raise
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        for _name, path in _backup_files()[BACKUP_KEEP:]:
+            os.remove(path)
+    sec = time.perf_counter() - t0
+    _BACKUP_STATS["runs"] += 1
+    _BACKUP_STATS.update(
+        last_sec=round(sec, 2), max_sec=round(max(_BACKUP_STATS["max_sec"], sec), 2),
+        last_pages=progress["pages"], last_steps=progress["steps"],
+        pages_per_step=progress["pages"] // max(1, progress["steps"]),
+        last_kb=os.path.getsize(os.path.join(d, name)) // 1024,
+        last_history_id=hid, last_file=name, last_ts=int(time.time()),
+    )
+    logging.info("db: backup %s: %s pages in %s steps, %.2fs", name, progress["pages"], progress["steps"], sec)
+    return name
+
+async def restore_backup(name: str) -> Dict[str, Any]:
+    """
+    Восстановить базу из копии name. Перед подменой снимается свежая копия
+    текущей базы. Пул закрывается полностью: новые записи и чтения отклоняются,
+    очередь писателя дорабатывает, выданные читатели возвращаются. Затем файл
+    заменяется целиком и init_db() открывает его заново; запросы, пришедшие
+    в это время, ждут открытия пула.
+    """
+    path = dict(_backup_files()).get(name)
+    if path is None:
+        raise ValueError(f"нет такой копии: {name}")
+    await backup_run()
+    async with _BACKUP_LOCK:
+        db_path = os.path.abspath(DB_PATH)
+        tmp = db_path + ".restore"
+        await asyncio.to_thread(_gunzip_file, path, tmp)
+        try:
+            async with aiosqlite.connect(tmp) as rdb:
+                async with rdb.execute("PRAGMA quick_check") as cur:
+                    check = (await cur.fetchone())[0]
+                hid = await _state_get(rdb, "backup_history_id")
+            if check != "ok":
+                raise ValueError(f"копия повреждена: {check}")
+            async with _POOL_OPEN_LOCK:  # _get_pool() не откроет старый файл посреди подмены
+                await close_db()
+                for suffix in ("-wal", "-shm"):
+                    if os.path.exists(db_path + suffix):
+                        os.remove(db_path + suffix)
+                os.replace(tmp, db_path)
+                _caches_reset()
+                await _open_pool()
+                await init_db()
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    # ленивые кэши ещё раз — на случай записи в них с кэшированных значений старой базы
+    _cfg_cache_reset()
+    _bal_cache_reset()
+    _loaders_invalidate()
+    _BACKUP_STATS["restores"] += 1
+    logging.warning("db: restored from %s (history id %s)", name, hid)
+    return {"file": name, "history_id": hid}
+
+def get_backup_stats() -> Dict[str, Any]:
+    files = _backup_files()
+    return {
+        "dir": _backup_dir(),
+        "files": len(files),
+        "size_kb": sum(os.path.getsize(p) for _, p in files) // 1024,
+        **_BACKUP_STATS,
+    }
+
+def list_backups() -> List[Tuple[str, int]]:
+    """[(имя, размер в КБ)] от новых к старым."""
+    return [(n, os.path.getsize(p) // 1024) for n, p in _backup_files()]
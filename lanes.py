@@ -0,0 +1,97 @@
+# lanes.py
+# Последовательные «полосы» для операций с деньгами пользователя.
+#
+# Операции одного пользователя (передача, кража, снегопад, рынок, ячейка,
+# армагеддон, ставки) выполняются строго по очереди, а разные пользователи
+# идут параллельно. Полосы шардированы: user_id % LANE_SHARDS -> asyncio.Lock
+# (очередь ожидающих у asyncio.Lock — FIFO, поэтому порядок сохраняется).
+#
+# Многосторонние операции берут шарды в порядке возрастания номера —
+# так две встречные передачи A->B и B->A не зацепятся друг за друга.
+# Поэтому все нужные пользователи перечисляются в одном lane(...): вложенная
+# полоса может только повторно войти в уже взятые шарды, новые — ошибка.
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+log = logging.getLogger(__name__)
+
+LANE_SHARDS = 64
+LANE_SLOW_WAIT_MS = 500  # ожидание дольше этого — предупреждение в лог
+
+_LOCKS = [asyncio.Lock() for _ in range(LANE_SHARDS)]
+
+# шарды, уже захваченные текущей задачей (для вложенных вызовов)
+_HELD: ContextVar[frozenset] = ContextVar("lanes_held", default=frozenset())
+
+_STATS = {
+    "acquisitions": 0,
+    "contended": 0,
+    "wait_ms_total": 0.0,
+    "wait_ms_max": 0.0,
+    "slow_waits": 0,
+    "nested_escalations": 0,
+}
+
+
+def _shard(user_id: int) -> int:
+    return int(user_id) % LANE_SHARDS
+
+
+@asynccontextmanager
+async def lane(*user_ids):
+    """Выполнить блок в полосах указанных пользователей (None пропускаются)."""
+    held = _HELD.get()
+    need = sorted({_shard(u) for u in user_ids if u is not None} - held)
+    if not need:
+        yield
+        return
+    if held:
+        # дозахват новых шардов ломает общий порядок и может зациклить две задачи
+        _STATS["nested_escalations"] += 1
+        raise RuntimeError(f"lanes: nested acquire of shards {need} while holding {sorted(held)}")
+
+    t0 = time.perf_counter()
+    contended = any(_LOCKS[s].locked() for s in need)
+    taken = []
+    try:
+        for s in need:
+            await _LOCKS[s].acquire()
+            taken.append(s)
+        waited = (time.perf_counter() - t0) * 1000.0
+        _STATS["acquisitions"] += 1
+        if contended:
+            _STATS["contended"] += 1
+        _STATS["wait_ms_total"] += waited
+        if waited > _STATS["wait_ms_max"]:
+            _STATS["wait_ms_max"] = waited
+        if waited >= LANE_SLOW_WAIT_MS:
+            _STATS["slow_waits"] += 1
+            log.warning("lanes: waited %.0f ms for users %s", waited, list(user_ids))
+
+        token = _HELD.set(held | frozenset(taken))
+        try:
+            yield
+        finally:
+            _HELD.reset(token)
+    finally:
+        for s in reversed(taken):
+            _LOCKS[s].release()
+
+
+def get_lane_stats() -> dict:
+    """Метрики ожидания полос для команды «метрики»."""
+    n = _STATS["acquisitions"]
+    return {
+        "shards": LANE_SHARDS,
+        "busy_now": sum(1 for lk in _LOCKS if lk.locked()),
+        "acquisitions": n,
+        "contended": _STATS["contended"],
+        "avg_wait_ms": round(_STATS["wait_ms_total"] / n, 2) if n else 0.0,
+        "max_wait_ms": round(_STATS["wait_ms_max"], 2),
+        "slow_waits": _STATS["slow_waits"],
+        "nested_escalations": _STATS["nested_escalations"],
+    }
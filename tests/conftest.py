@@ -0,0 +1,27 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db as db_module  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def run():
+    # один цикл событий на все тесты: блокировки модуля db привязываются к циклу
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch, run):
+    """Модуль db поверх пустой базы во временном каталоге."""
+    monkeypatch.setattr(db_module, "DB_PATH", str(tmp_path / "bot.sqlite"))
+    monkeypatch.setattr(db_module, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    monkeypatch.setattr(db_module, "BACKUP_DIR", str(tmp_path / "backups"))
+    yield db_module
+    run(db_module.close_db())
@@ -0,0 +1,23 @@
+def test_actions_stored_as_codes(db, run):
+    async def check():
+        await db.init_db()
+        await db.change_balance(1, 5, "x", 1)
+        await db.insert_history(1, "новое_действие", 1, None)
+        await db.insert_history(2, "новое_действие", 2, None)
+        async with db._writer() as c:
+            # старые запросы пишут в представление history по имени действия
+            await c.execute("INSERT INTO history (user_id, action, amount) VALUES (3, 'через_view', 3)")
+        async with db._reader() as c:
+            async with c.execute("SELECT name, COUNT(*) FROM actions GROUP BY name HAVING COUNT(*) > 1") as cur:
+                assert await cur.fetchall() == []
+            async with c.execute("""
+                SELECT h.user_id, a.name, typeof(h.action_id) FROM history_log h JOIN actions a ON a.id = h.action_id
+                WHERE a.name IN ('новое_действие', 'через_view') ORDER BY h.id
+            """) as cur:
+                rows = [tuple(r) for r in await cur.fetchall()]
+            assert rows == [(1, "новое_действие", "integer"), (2, "новое_действие", "integer"),
+                            (3, "через_view", "integer")]
+            async with c.execute("SELECT action, amount FROM history WHERE user_id = 3") as cur:
+                assert tuple(await cur.fetchone()) == ("через_view", 3)
+
+    run(check())
@@ -0,0 +1,48 @@
+import os
+from datetime import datetime, timezone
+
+
+def _ts(s):
+    return int(datetime.fromisoformat(s).replace(tzinfo=timezone.utc).timestamp())
+
+
+def test_archive_and_merged_reads(db, run):
+    async def check():
+        await db.init_db()
+        ids = [
+            await db.insert_history(1, "theft", 0, "x"),        # январь
+            await db.grant_perk(1, "кража"),                      # март
+            await db.insert_history(2, "theft", 0, "x"),        # январь
+            await db.insert_history(1, "perk_revoke", None, "щит", perk_code="щит"),  # февраль
+        ]
+        months = ["2025-01-10", "2025-03-05", "2025-01-20", "2025-02-01"]
+        async with db._writer() as c:
+            for rid, day in zip(ids, months):
+                await c.execute("UPDATE history_log SET ts = ?, date = ? WHERE id = ?",
+                                (_ts(day), day + " 00:00:00", rid))
+        await db.change_balance(1, 5, "hot", 1)
+        await db.verify_balance_chains()
+        before = [r async for r in db.iter_history()]
+
+        moved = await db.history_archive_run()
+        assert moved == 4
+        assert [m for m, _ in db._archive_files()] == ["2025-01", "2025-02", "2025-03"]
+        assert all(os.path.exists(p) for _, p in db._archive_files())
+        async with db._reader() as c:
+            async with c.execute("SELECT id FROM history_log WHERE id IN (?, ?, ?, ?)", ids) as cur:
+                assert await cur.fetchall() == []
+
+        # id в файлах месяцев перемежаются, а чтение идёт одним потоком по id
+        after = [r async for r in db.iter_history()]
+        assert after == before
+        assert [r[0] for r in after] == sorted(r[0] for r in after)
+        assert [r[0] for r in [r async for r in db.iter_history(user_id=1, action="theft")]] == [ids[0]]
+        feb = [r[0] async for r in db.iter_history(since_ts=_ts("2025-02-01"), until_ts=_ts("2025-03-01"))]
+        assert feb == [ids[3]]
+
+        assert await db.get_perks(1) == {"кража"}
+        rep = await db.reconcile_projections(fix=False)
+        assert not any(rep[k]["diffs"] for k in ("balances", "perks", "credits", "escrow", "cells", "generosity")), rep
+        assert await db.history_archive_run() == 0
+
+    run(check())
@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+
+def test_restore_round_trip(db, run, monkeypatch):
+    monkeypatch.setattr(db, "BACKUP_PAGES_PER_STEP", 4)
+
+    async def writes():
+        for _ in range(20):
+            await db.change_balance(2, 1, "w", 1)
+            await asyncio.sleep(0)
+
+    async def check():
+        await db.init_db()
+        await db.change_balance(1, 70, "before", 1)
+        await db.set_income(9)
+        # копия снимается по шагам, пока идут записи
+        name, _ = await asyncio.gather(db.backup_run(), writes())
+        st = db.get_backup_stats()
+        assert st["last_file"] == name and st["last_steps"] > 1
+
+        await db.change_balance(1, 30, "after", 1)
+        await db.set_income(11)
+        await db.grant_perk(1, "кража")
+        assert await db.get_balance(1) == 100
+
+        rep = await db.restore_backup(name)
+        assert rep["history_id"] == st["last_history_id"]
+        # кэши не отдают значения из базы до восстановления
+        assert await db.get_balance(1) == 70
+        assert await db.get_income() == 9
+        assert await db.get_perks(1) == set()
+        assert len(db.list_backups()) == 2  # + копия перед восстановлением
+        r = await db.verify_balance_chains()
+        assert r["breaks_total"] == 0 and r["table_diffs_total"] == 0, r
+
+        # после восстановления база пишется как обычно
+        await db.change_balance(1, 5, "again", 1)
+        assert await db.get_balance(1) == 75
+
+        with pytest.raises(ValueError):
+            await db.restore_backup("nope.sqlite.gz")
+
+    run(check())
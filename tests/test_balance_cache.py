@@ -0,0 +1,52 @@
+import pytest
+
+
+def test_cache_write_through_and_check(db, run):
+    async def check():
+        await db.init_db()
+        assert await db.get_balance(1) == 0
+        await db.change_balance(1, 10, "t", 0)
+        assert db._BAL[1] == 10
+        hits = db._BAL_STATS["hits"]
+        assert await db.get_balance(1) == 10
+        assert db._BAL_STATS["hits"] == hits + 1
+
+        # откат не трогает кэш: колбэки ставятся только после COMMIT
+        with pytest.raises(RuntimeError):
+            async with db._writer() as c:
+                await db._debit_tx(c, 1, 4, "t")
+                assert await db.get_balance(1) == 6  # внутри транзакции — своё незакоммиченное
+                raise RuntimeError("rollback")
+        assert db._BAL[1] == 10 and await db.get_balance(1) == 10
+
+        # запись мимо хелперов ловит самопроверка и выбрасывает из кэша
+        async with db._writer() as c:
+            await c.execute("UPDATE users SET balance = 999 WHERE user_id = 1")
+        assert await db.get_balance(1) == 10
+        assert await db.balance_cache_check(fix=True) == {1: (10, 999)}
+        assert 1 not in db._BAL
+        assert await db.get_balance(1) == 999
+        assert await db.balance_cache_check() == {}
+
+        await db.change_balance(2, 5, "t", 0)
+        await db.reset_all_balances()
+        assert db._BAL[1] == 0 and db._BAL[2] == 0
+        assert await db.balance_cache_check() == {}
+
+    run(check())
+
+
+def test_cache_lru_eviction(db, run, monkeypatch):
+    monkeypatch.setattr(db, "BALANCE_CACHE_MAX", 2)
+
+    async def check():
+        await db.init_db()
+        for uid in (1, 2, 3):
+            await db.change_balance(uid, uid, "t", 0)
+        assert list(db._BAL) == [2, 3]
+        assert await db.get_balance(2) == 2   # 2 становится свежим
+        assert await db.get_balance(1) == 1   # промах, вытесняет 3
+        assert list(db._BAL) == [2, 1]
+        assert db._BAL_STATS["evictions"] >= 2
+
+    run(check())
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+
+def test_cell_deposit_from_pocket_is_atomic(db, run, monkeypatch):
+    async def check():
+        await db.init_db()
+        await db.set_cell_dep_fee_pct(0)
+        await db.change_balance(1, 100, "x", 1)
+        assert await db.cell_deposit_from_pocket(1, 500) is None
+        assert await db.get_balance(1) == 100
+
+        assert await db.cell_deposit_from_pocket(1, 40) == (40, 0, 40)
+        assert await db.get_balance(1) == 60
+
+        # зачисление в ячейку упало — списание с кармана откатывается вместе с ним
+        async def boom(*a):
+            raise RuntimeError("boom")
+        monkeypatch.setattr(db, "_cell_deposit_tx", boom)
+        with pytest.raises(RuntimeError):
+            await db.cell_deposit_from_pocket(1, 10)
+        db._bal_cache_reset()
+        assert await db.get_balance(1) == 60
+        assert await db.cell_get_balance(1) == 40
+
+    run(check())
+
+
+def test_cell_withdraw_to_pocket(db, run):
+    async def check():
+        await db.init_db()
+        await db.set_cell_dep_fee_pct(0)
+        await db.change_balance(1, 100, "x", 1)
+        await db.cell_deposit_from_pocket(1, 50)
+        assert await db.cell_withdraw_to_pocket(1, 80, "out") == (50, 0)
+        assert await db.get_balance(1) == 100
+        assert await db.cell_withdraw_to_pocket(1, 10, "out") == (0, 0)
+        r = await db.verify_balance_chains()
+        assert r["breaks_total"] == 0 and r["table_diffs_total"] == 0, r
+
+    run(check())
+
+
+def test_bank_rob_cooldown_in_one_transaction(db, run):
+    async def check():
+        await db.init_db()
+        await db.set_cell_dep_fee_pct(0)
+        await db.change_balance(2, 30, "x", 1)
+        await db.cell_deposit_from_pocket(2, 30)
+        # два налёта подряд: КД проверяется и записывается в той же транзакции
+        res = await asyncio.gather(db.bank_rob(1, "success", 3600), db.bank_rob(1, "success", 3600))
+        assert sorted(r[0] is None for r in res) == [False, True]
+        assert sorted(r[1] for r in res) == [0, 30]
+        assert await db.get_balance(1) == 30
+        assert await db.cell_get_balance(2) == 0
+
+        await db.grant_perk(3, "грабитель")
+        remain, loot = await db.bank_rob(3, "busted", 3600)
+        assert remain is None and loot == 0
+        assert "грабитель" not in await db.get_perks(3)
+        remain, _ = await db.bank_rob(3, "fail", 3600)
+        assert 0 < remain <= 3600
+
+    run(check())
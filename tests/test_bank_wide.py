@@ -0,0 +1,29 @@
+def test_touch_all_and_zero_all(db, run):
+    async def check():
+        await db.init_db()
+        await db.set_cell_dep_fee_pct(0)
+        await db.set_cell_stor_fee_pct(10)
+        for uid, bal in ((1, 100), (2, 50), (3, 0)):
+            await db.cell_deposit(uid, bal)
+        assert await db.bank_touch_all_and_total() == 150
+        now = await db._now_ts()
+        async with db._writer() as c:
+            await c.execute("UPDATE cells SET last_ts = ? WHERE user_id IN (1, 2)", (now - 2 * db.FOUR_HOURS,))
+        # 100 -> 90 -> 81, 50 -> 45 -> 40
+        assert await db.bank_touch_all_and_total() == 121
+        assert await db.cell_get_balances([1, 2, 3, 4]) == {1: 81, 2: 40, 3: 0, 4: 0}
+
+        assert await db.bank_zero_all_and_sum() == 121
+        assert await db.bank_touch_all_and_total() == 0
+        assert await db.cell_get_balances([1, 2]) == {1: 0, 2: 0}
+        async with db._reader() as c:
+            async with c.execute(
+                "SELECT user_id, amount, cell_after FROM history WHERE action = 'cell_wd' ORDER BY user_id"
+            ) as cur:
+                assert [tuple(r) for r in await cur.fetchall()] == [(1, 81, 0), (2, 40, 0)]
+        assert await db.bank_zero_all_and_sum() == 0
+        assert not await db.economy_cross_check(fix=False)
+        r = await db.verify_balance_chains()
+        assert r["breaks_total"] == 0 and r["table_diffs_total"] == 0, r
+
+    run(check())
@@ -0,0 +1,31 @@
+def test_strip_user_takes_everything_at_once(db, run):
+    async def check():
+        await db.init_db()
+        await db.set_cell_dep_fee_pct(0)
+        await db.change_balance(1, 100, "x", 1)
+        await db.cell_deposit_from_pocket(1, 30)
+        for code in ("кража", "щит"):
+            await db.grant_perk(1, code)
+            await db.add_perk_minted(code, +1)
+        await db.set_role(1, "страж", "d")
+
+        taken = await db.strip_user(1, "чс", blacklist=True)
+        assert taken == {"balance": 70, "perks": ["кража", "щит"], "role": True, "cell": 30}
+        assert await db.get_balance(1) == 0
+        assert await db.cell_get_balance(1) == 0
+        assert await db.get_perks(1) == set()
+        # оба перка списаны из minted, хотя кэш конфига обновляется только после COMMIT
+        minted = await db.get_perk_minted()
+        assert minted.get("кража") == 0 and minted.get("щит") == 0
+        assert 1 in await db.get_blacklist()
+        role = await db.get_role(1)
+        assert role is None or not role["role"]
+        # в ЧС начисления блокируются
+        await db.change_balance(1, 5, "y", 1)
+        assert await db.get_balance(1) == 0
+        r = await db.verify_balance_chains()
+        assert r["breaks_total"] == 0 and r["table_diffs_total"] == 0, r
+
+        assert await db.strip_user(2, "clean") == {"balance": 0, "perks": [], "role": False, "cell": 0}
+
+    run(check())
@@ -0,0 +1,34 @@
+def test_bulk_reads_match_point_reads(db, run, monkeypatch):
+    monkeypatch.setattr(db, "LOADER_MAX_KEYS", 2)
+
+    async def check():
+        await db.init_db()
+        await db.change_balance(1, 50, "t", 0)
+        await db.change_balance(2, 7, "t", 0)
+        await db.grant_perk(1, "щит")
+        await db.grant_perk(1, "кража")
+        await db.grant_perk(3, "щит")
+        await db.set_role(2, "бард", "поёт")
+        await db.perk_credit_add(3, "щит")
+        await db.perk_credit_add(3, "щит")
+        await db.perk_credit_add(1, "кража")
+        assert await db.perk_credit_use(1, "кража")
+
+        ids = [3, 1, 2, 99, 1, None]
+        uniq = [1, 2, 3, 99]
+        bal = await db.get_balances(ids)
+        perks = await db.get_perks_bulk(ids)
+        roles = await db.get_roles_bulk(ids)
+        credits = await db.get_perk_credits_bulk(ids)
+        assert list(bal) == list(perks) == list(roles) == list(credits) == uniq
+
+        for u in uniq:
+            assert bal[u] == await db.get_balance(u)
+            assert perks[u] == await db.get_perks(u)
+            assert roles[u] == await db.get_role_with_image(u)
+            assert credits[u] == {c: n for c in ("щит", "кража") if (n := await db.get_perk_credits(u, c)) > 0}
+        assert bal[99] == 0 and perks[99] == set() and roles[99] is None and credits[99] == {}
+        assert credits[3] == {"щит": 2} and credits[1] == {}
+        assert await db.get_balances([]) == {}
+
+    run(check())
@@ -0,0 +1,74 @@
+async def _snapshot(db):
+    return (
+        await db.list_active_offers(),
+        await db.hero_get_current_with_until(-100),
+        await db.hero_get_current(-200),
+        await db.codeword_get_active(-100),
+        await db.codeword_get_active(-200),
+        await db.hero_get_last_claim_msg(-100),
+    )
+
+
+async def _fill(db):
+    o1 = await db.create_offer(1, "https://t.me/a", 10)
+    o2 = await db.create_perk_offer(2, "щит", 20)
+    await db.create_offer(3, "https://t.me/c", 30)
+    await db.cancel_offer(o1, None)
+    await db.record_offer_sold(4, o2, 2, 20)
+    await db.hero_set_for_today(-100, 5)
+    await db.hero_set_for_today(-100, 6, hours=48)
+    await db.hero_set_for_today(-200, 7, hours=-1)  # уже протух
+    await db.codeword_set(-100, "кот", 15, 9)
+    await db.codeword_set(-200, "пёс", 25, 9)
+    await db.codeword_mark_win(-200, 8, 25, "пёс")
+    await db.hero_save_claim_msg(-100, 6, 555, 1700000000)
+
+
+def test_projections_match_sql(db, run):
+    async def check():
+        await db.init_db()
+        assert all(p.ready for p in db._PROJECTIONS.values())
+        await _fill(db)
+        live = await _snapshot(db)
+        offers, (hero, until), stale, cw1, cw2, msg = live
+        assert [o["seller_id"] for o in offers] == [3]
+        assert hero == 6 and until is not None and stale is None
+        assert cw1["word"] == "кот" and cw2 is None
+        assert msg == {"hero_id": 6, "msg_id": 555, "ts": 1700000000}
+
+        # те же ответы из базы, пока проекции не готовы
+        for p in db._PROJECTIONS.values():
+            p.ready = False
+        assert await _snapshot(db) == live
+
+        # и после пересборки из history
+        db._bus_reset()
+        done = await db.bus_catch_up()
+        assert done["offers"] == 5 and done["heroes"] == 3
+        assert await _snapshot(db) == live
+
+    run(check())
+
+
+def test_projection_rebuilds_after_failure(db, run, monkeypatch):
+    async def check():
+        await db.init_db()
+        await db.create_offer(1, "https://t.me/a", 10)
+        proj = db._PROJECTIONS["offers"]
+        good = proj.apply
+
+        def boom(ev):
+            raise RuntimeError("boom")
+
+        monkeypatch.setattr(proj, "apply", boom)
+        await db.create_offer(2, "https://t.me/b", 20)
+        assert not proj.ready and proj.errors == 1
+        # пока проекция не готова, читаем из базы
+        assert [o["seller_id"] for o in await db.list_active_offers()] == [2, 1]
+
+        monkeypatch.setattr(proj, "apply", good)
+        await db.bus_catch_up()
+        assert proj.ready
+        assert [o["seller_id"] for o in await db.list_active_offers()] == [2, 1]
+
+    run(check())
@@ -0,0 +1,57 @@
+def _old_cell_touch(bal, pct, intervals):
+    # поштучные списания, как в прежнем cell_touch
+    total = 0
+    for _ in range(intervals):
+        fee = (bal * pct + 99) // 100
+        if fee <= 0:
+            break
+        total += fee
+        bal -= fee
+        if bal <= 0:
+            bal = 0
+            break
+    return total, bal
+
+
+def test_accrual_matches_per_period_fees(db, run):
+    cases = {1: (1000, 5), 2: (7, 30), 3: (999, 1), 4: (50, 0), 5: (123457, 40)}  # user: (баланс, периодов)
+
+    async def check():
+        await db.init_db()
+        await db.set_cell_dep_fee_pct(0)
+        await db.set_cell_stor_fee_pct(3)
+        for uid, (bal, _) in cases.items():
+            await db.cell_deposit(uid, bal)
+        now = await db._now_ts()
+        async with db._writer() as c:
+            for uid, (_, k) in cases.items():
+                await c.execute("UPDATE cells SET last_ts = ? WHERE user_id = ?",
+                                (now - k * db.FOUR_HOURS - 100, uid))
+        for uid, (bal, k) in cases.items():
+            fee, left = await db.cell_touch(uid)
+            assert (fee, left) == _old_cell_touch(bal, 3, k), uid
+        async with db._reader() as c:
+            async with c.execute("SELECT user_id, last_ts FROM cells") as cur:
+                last = dict(await cur.fetchall())
+            # метка двигается на целое число периодов, остаток не теряется
+            assert all(last[uid] == now - 100 for uid in cases), last
+            # по одному сводному событию на ячейку
+            async with c.execute("SELECT user_id, amount FROM history WHERE action = 'cell_fee'") as cur:
+                fees = dict(await cur.fetchall())
+        assert fees == {uid: _old_cell_touch(b, 3, k)[0] for uid, (b, k) in cases.items() if k}
+        assert not await db.economy_cross_check(fix=False)
+        r = await db.verify_balance_chains()
+        assert r["breaks_total"] == 0 and r["table_diffs_total"] == 0, r
+
+    run(check())
+
+
+def test_deposit_and_withdraw(db, run):
+    async def check():
+        await db.init_db()
+        await db.set_cell_dep_fee_pct(10)
+        assert await db.cell_deposit(1, 55) == (55, 6, 49)
+        assert await db.cell_withdraw(1, 100) == (49, 0)
+        assert await db.cell_withdraw(1, 1) == (0, 0)
+
+    run(check())
@@ -0,0 +1,88 @@
+import asyncio
+
+
+def test_verify_runs_on_one_reader(db, run, monkeypatch):
+    monkeypatch.setattr(db, "POOL_READERS", 1)
+    monkeypatch.setattr(db, "POOL_CLOSE_WAIT_SEC", 1)
+
+    async def check():
+        await db.init_db()
+        await db.change_balance(1, 10, "a", 1)
+        r = await asyncio.wait_for(db.verify_balance_chains(), 5)
+        assert r["rows"] == 1 and r["breaks_total"] == 0, r
+        # у пользователя 1 начало цепочки уже до сохранённого id — проверка
+        # дочитывает его в том же снимке, не занимая второго читателя
+        await db.change_balance(1, 5, "b", 1)
+        r = await asyncio.wait_for(db.verify_balance_chains(), 5)
+        assert r["rows"] == 1 and r["breaks_total"] == 0 and r["table_diffs_total"] == 0, r
+
+    run(check())
+
+
+def test_verify_reports_broken_chain(db, run):
+    async def check():
+        await db.init_db()
+        await db.change_balance(1, 10, "a", 1)
+        await db.change_balance(1, 5, "b", 1)
+        async with db._writer() as c:
+            async with c.execute("SELECT MAX(id) FROM history") as cur:
+                rid = (await cur.fetchone())[0]
+            await c.execute("UPDATE history_log SET balance_after = 99 WHERE id = ?", (rid,))
+        r = await db.verify_balance_chains()
+        assert r["breaks"] == [(rid, 1, "balance_after", 15, 99)], r
+        assert r["table_diffs"] == [(1, "balance_after", 99, 15)], r
+        # проверка инкрементальная: уже пройденные строки повторно не считаются
+        r = await db.verify_balance_chains()
+        assert r["rows"] == 0 and r["breaks_total"] == 0, r
+
+    run(check())
+
+
+async def _last_id(db):
+    async with db._reader() as c:
+        async with c.execute("SELECT MAX(id) FROM history_log") as cur:
+            return (await cur.fetchone())[0]
+
+
+async def _set_ts(db, rid, ts):
+    async with db._writer() as c:
+        await c.execute("UPDATE history_log SET ts = ? WHERE id = ?", (ts, rid))
+
+
+def test_balance_at_and_statement_pages(db, run):
+    async def check():
+        await db.init_db()
+        ids = []
+        for ts, amount in ((1000, 10), (2000, 5), (3000, -3)):
+            await db.change_balance(1, amount, "t", 0)
+            ids.append(await _last_id(db))
+            await _set_ts(db, ids[-1], ts)
+        await db.change_balance(2, 1, "t", 0)
+        await _set_ts(db, await _last_id(db), 3500)
+        await db.reset_all_balances()
+        await _set_ts(db, await _last_id(db), 4000)
+        await db.change_balance(1, 7, "t", 0)
+        ids.append(await _last_id(db))
+        await _set_ts(db, ids[-1], 5000)
+
+        want = {500: 0, 1500: 10, 2500: 15, 3500: 12, 4500: 0, 5500: 7}
+        for ts, bal in want.items():
+            assert await db.get_balance_at(1, ts) == bal, ts
+
+        page, nxt = await db.get_statement(1, limit=2)
+        assert [(r[0], r[3], r[5]) for r in page] == [(ids[3], 7, 7), (ids[2], -3, 12)] and nxt == ids[2]
+        page, nxt = await db.get_statement(1, before_id=nxt, limit=2)
+        assert [r[0] for r in page] == [ids[1], ids[0]] and nxt is None
+
+        # после выноса старых строк в архив ответы те же
+        r = await db.verify_balance_chains()
+        assert r["breaks_total"] == 0, r
+        assert await db.history_archive_run() > 0
+        for ts, bal in want.items():
+            assert await db.get_balance_at(1, ts) == bal, ts
+        page, nxt = await db.get_statement(1, limit=3)
+        assert [r[0] for r in page] == ids[::-1][:3] and nxt == ids[1]
+        page, nxt = await db.get_statement(1, before_id=nxt, limit=3)
+        assert [r[0] for r in page] == [ids[0]] and nxt is None
+
+    run(check())
@@ -0,0 +1,39 @@
+def test_config_write_through(db, run):
+    async def check():
+        await db.init_db()
+        assert await db.get_config_int("k", 3) == 3
+        await db.set_config_int("k", 11)
+        assert await db.get_config_int("k", 3) == 11
+        await db.set_config_str("s", "текст")
+        assert await db.get_config_str("s") == "текст"
+        assert await db.get_configs({"k": 0, "нет": 5}) == {"k": 11, "нет": 5}
+
+        # значение живёт в таблице config: после сброса кэша читается оттуда
+        db._cfg_cache_reset()
+        assert await db.get_config_int("k", 3) == 11
+        async with db._reader() as c:
+            async with c.execute("SELECT int_value FROM config WHERE key = 'k'") as cur:
+                assert (await cur.fetchone())[0] == 11
+            # и остаётся журнал изменений
+            async with c.execute("SELECT amount FROM history WHERE action = 'config' AND reason = 'k'") as cur:
+                assert [r[0] for r in await cur.fetchall()] == [11]
+
+    run(check())
+
+
+def test_config_rollback_keeps_cache(db, run):
+    async def check():
+        await db.init_db()
+        await db.set_config_int("k", 1)
+        try:
+            async with db._writer():
+                await db.set_config_int("k", 2)
+                raise ValueError
+        except ValueError:
+            pass
+        # кэш меняется только после COMMIT
+        assert await db.get_config_int("k", 0) == 1
+        db._cfg_cache_reset()
+        assert await db.get_config_int("k", 0) == 1
+
+    run(check())
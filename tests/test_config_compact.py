@@ -0,0 +1,28 @@
+def test_compact_keeps_tail_per_key(db, run, monkeypatch):
+    monkeypatch.setattr(db, "CONFIG_COMPACT_BATCH", 4)
+
+    async def check():
+        await db.init_db()
+        await db.set_config_int(db.CFG_CONFIG_LOG_TAIL, 3)
+        for i in range(10):
+            await db.set_config_int("a", i)
+        await db.set_config_int("b", 7)
+        for i in range(5):
+            await db.set_config_str("s", f"v{i}")
+
+        rep = await db.compact_config_log()
+        assert rep["rows"] == 7 + 2 and rep["keys"] == 2 and rep["tail"] == 3
+
+        async with db._reader() as c:
+            async with c.execute("SELECT reason, amount FROM history WHERE action = 'config' AND reason = 'a' ORDER BY id") as cur:
+                assert await cur.fetchall() == [("a", 7), ("a", 8), ("a", 9)]
+            async with c.execute("SELECT COUNT(*) FROM history WHERE action = 'config_str' AND reason = 's'") as cur:
+                assert (await cur.fetchone())[0] == 3
+            async with c.execute("SELECT COUNT(*) FROM history WHERE action = 'config' AND reason = 'b'") as cur:
+                assert (await cur.fetchone())[0] == 1
+        assert await db.get_config_int("a", 0) == 9
+        assert await db.get_config_int("b", 0) == 7
+        assert await db.get_config_str("s") == "v4"
+        assert (await db.compact_config_log())["rows"] == 0
+
+    run(check())
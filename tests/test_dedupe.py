@@ -0,0 +1,54 @@
+from collections import OrderedDict
+
+
+def test_claim_msg(db, run, monkeypatch):
+    monkeypatch.setattr(db, "_DEDUPE_RING", OrderedDict())
+
+    async def check():
+        await db.init_db()
+        assert await db.claim_msg(-100, 1)
+        assert not await db.claim_msg(-100, 1)
+        assert await db.claim_msg(-100, 2)
+        # после рестарта кольца в памяти нет — дубль ловит msg_dedupe
+        db._DEDUPE_RING.clear()
+        assert await db.is_msg_processed(-100, 1)
+        assert not await db.claim_msg(-100, 1)
+        assert not await db.is_msg_processed(-100, 3)
+        # в history анти-дубли больше не пишутся
+        async with db._reader() as c:
+            async with c.execute("SELECT COUNT(*) FROM history WHERE action = 'msg_processed'") as cur:
+                assert (await cur.fetchone())[0] == 0
+
+    run(check())
+
+
+def test_claim_msg_prunes_by_ttl(db, run, monkeypatch):
+    monkeypatch.setattr(db, "_DEDUPE_RING", OrderedDict())
+    monkeypatch.setattr(db, "DEDUPE_PRUNE_EVERY", 1)
+
+    async def check():
+        await db.init_db()
+        async with db._writer() as c:
+            await c.execute("INSERT INTO msg_dedupe (chat_id, message_id, ts) VALUES (-100, 1, 0)")
+        assert await db.claim_msg(-100, 2)
+        assert not await db.is_msg_processed(-100, 1)
+
+    run(check())
+
+
+def test_claim_update_id(db, run, monkeypatch):
+    monkeypatch.setattr(db, "_UPDATE_HWM", {"loaded": 0, "seen": 0, "saved": 0, "saved_at": 0.0})
+    monkeypatch.setattr(db, "UPDATE_HWM_FLUSH_SEC", 3600)
+
+    async def check():
+        await db.init_db()
+        assert await db.claim_update_id(10)
+        assert await db.claim_update_id(12)
+        assert await db.claim_update_id(11)  # до рестарта порядок не важен
+        await db.close_db()  # сохраняет HWM
+        await db.init_db()
+        assert not await db.claim_update_id(12)
+        assert not await db.claim_update_id(5)
+        assert await db.claim_update_id(13)
+
+    run(check())
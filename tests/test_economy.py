@@ -0,0 +1,38 @@
+def test_counters_follow_writes(db, run):
+    async def check():
+        await db.init_db()
+        assert await db.get_economy_stats() is None
+        await db.change_balance(1, 300, "x", 1)
+        await db.vault_init(10000, await db.get_circulating())
+        await db.change_balance(2, 200, "x", 1)
+        await db.change_balance(1, -50, "x", 1)
+        await db.transfer(2, 1, 20, "t")
+        await db.record_burn(30, "b")
+        await db.set_cell_dep_fee_pct(0)
+        await db.cell_deposit_from_pocket(1, 70)
+        st = await db.get_economy_stats()
+        assert st["cap"] == 10000 and st["burned"] == 30
+        assert st["circulating"] == 300 - 50 + 20 - 70 + 200 - 20
+        assert st["bank_total"] == 70
+        assert st["vault"] == 10000 - 30 - st["circulating"]
+        assert not await db.economy_cross_check(fix=False)
+
+    run(check())
+
+
+def test_cross_check_repairs_drift(db, run):
+    async def check():
+        await db.init_db()
+        await db.vault_init(1000, 0)
+        await db.change_balance(1, 40, "x", 1)
+        async with db._writer() as c:
+            await c.execute("UPDATE economy_state SET circulating = 999, burned = 7 WHERE id = 1")
+        assert await db.economy_cross_check(fix=True) == {"burned": (7, 0), "circulating": (999, 40)}
+        assert not await db.economy_cross_check(fix=False)
+        # новый vault_init начинает эпоху сжигания заново
+        await db.record_burn(5, "b")
+        await db.vault_init(2000, 40)
+        assert await db.get_burned_since_epoch() == 0
+        assert await db.get_last_vault_cap() == 2000
+
+    run(check())
@@ -0,0 +1,72 @@
+def test_reset_all_balances_opens_epoch(db, run):
+    async def check():
+        await db.init_db()
+        await db.vault_init(1000, 0)
+        await db.change_balance(1, 30, "t", 0)
+        await db.change_balance(2, 20, "t", 0)
+        assert len(await db.get_top_users()) == 2
+        await db.reset_all_balances()
+
+        assert await db.get_balances([1, 2]) == {1: 0, 2: 0}
+        assert await db.get_top_users() == []
+        assert await db.get_circulating() == 0
+        st = await db.get_epoch_stats()
+        assert st["balance_resets"] == 1 and st["stale_users"] == 2
+
+        # строка переводится в новую эпоху при первой записи
+        await db.change_balance(1, 4, "t", 0)
+        assert await db.get_balance(1) == 4
+        assert await db.get_top_users() == [(1, 4)]
+        assert (await db.get_epoch_stats())["stale_users"] == 1
+        assert await db.debit_if_sufficient(2, 1, "t") is None
+
+        r = await db.verify_balance_chains()
+        assert r["breaks_total"] == 0 and r["table_diffs_total"] == 0, r
+        rep = await db.reconcile_projections(fix=False)
+        assert not rep["balances"]["diffs"], rep
+
+    run(check())
+
+
+def test_club_reset_clears_state(db, run):
+    async def check():
+        await db.init_db()
+        await db.change_balance(1, 100, "t", 0)
+        await db.grant_perk(1, "щит")
+        await db.perk_credit_add(1, "щит")
+        await db.set_role(1, "бард", "поёт")
+        await db.grant_key(1)
+        assert await db.cell_deposit_from_pocket(1, 50) is not None
+        await db.create_offer(1, "https://t.me/a", 10)
+        await db.hero_set_for_today(-100, 1)
+        await db.codeword_set(-100, "кот", 5, 1)
+        await db.set_income(9)
+
+        hid = await db.club_reset(7)
+        assert await db.get_balance(1) == 0
+        assert await db.get_perks(1) == set()
+        assert await db.get_perk_credits(1, "щит") == 0
+        assert await db.get_role(1) is None
+        assert not await db.has_key(1)
+        assert await db.cell_get_balance(1) == 0
+        assert await db.list_active_offers() == []
+        assert await db.hero_get_current(-100) is None
+        assert await db.codeword_get_active(-100) is None
+        assert await db.get_income() == 5
+        st = await db.get_epoch_stats()
+        assert st["club_resets"] == 1 and st["club_since_id"] == hid
+
+        # проекции, пересобранные из history, тоже не видят прошлого
+        db._bus_reset()
+        await db.bus_catch_up()
+        assert await db.list_active_offers() == []
+        assert await db.hero_get_current(-100) is None
+
+        await db.change_balance(1, 3, "t", 0)
+        assert await db.get_balance(1) == 3
+        r = await db.verify_balance_chains()
+        assert r["breaks_total"] == 0 and r["table_diffs_total"] == 0, r
+        rep = await db.reconcile_projections(fix=False)
+        assert not any(rep[k]["diffs"] for k in ("balances", "perks", "credits", "cells")), rep
+
+    run(check())
@@ -0,0 +1,38 @@
+import json
+
+
+async def _last(db, action):
+    async with db._reader() as c:
+        async with c.execute(
+            "SELECT user_id, amount, chat_id, ref_id, perk_code, payload FROM history WHERE action = ? "
+            "ORDER BY id DESC LIMIT 1", (action,)
+        ) as cur:
+            return tuple(await cur.fetchone())
+
+
+def test_fields_go_to_columns(db, run):
+    async def check():
+        await db.init_db()
+        await db.record_theft(1, 5, 2, True)
+        uid, amount, _chat, ref_id, _code, payload = await _last(db, "theft")
+        assert (uid, amount, ref_id) == (1, 5, 2)
+        assert json.loads(payload) == {"success": True}
+
+        oid = await db.create_perk_offer(1, "Кража", 10)
+        assert (await _last(db, "offer_create"))[4] == "кража"
+        await db.perk_escrow_open(1, "кража", oid)
+        await db.perk_escrow_close(1, "кража", oid, "sold")
+        assert (await _last(db, "perk_escrow_close"))[3] == oid
+        # владелец закрытого эскроу — по ref_id, без разбора reason
+        assert await db.get_perk_escrow_owner(oid) == (1, "кража")
+
+        await db.codeword_set(-100, "слово", 10, 1)
+        assert (await _last(db, "codeword_set"))[2] == -100
+        assert (await db.codeword_get_active(-100))["word"] == "слово"
+
+        offer = await db.create_offer(2, "http://x", 7)
+        await db.record_offer_sold(3, offer, 2, 7)
+        assert (await _last(db, "offer_sold"))[3] == offer
+        assert offer not in [o["offer_id"] for o in await db.list_active_offers()]
+
+    run(check())
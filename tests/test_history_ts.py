@@ -0,0 +1,20 @@
+def test_ts_and_time_windows(db, run):
+    async def check():
+        await db.init_db()
+        now = await db._now_ts()
+        old = await db.insert_history(1, "perk_buy", 100, "кража")
+        await db.insert_history(1, "perk_buy", 20, "кража")
+        await db.insert_history(2, "emerald_buy", 3, None)
+        async with db._writer() as c:
+            await c.execute("UPDATE history_log SET ts = ? WHERE id = ?", (now - 10 * 86400, old))
+        async with db._reader() as c:
+            async with c.execute(
+                "SELECT COUNT(*) FROM history WHERE id <> ? AND ts - CAST(strftime('%s', date) AS INTEGER) <> 0",
+                (old,),
+            ) as cur:
+                assert (await cur.fetchone())[0] == 0
+        # окна считаются по целочисленному ts
+        assert await db.get_market_turnover_days(7) == 23
+        assert await db.get_market_turnover_days(30) == 123
+
+    run(check())
@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from lanes import LANE_SHARDS, lane
+
+
+def test_same_user_runs_in_order(run):
+    order = []
+
+    async def op(i):
+        async with lane(1):
+            order.append(("in", i))
+            await asyncio.sleep(0.01)
+            order.append(("out", i))
+
+    async def check():
+        await asyncio.gather(*(op(i) for i in range(5)))
+
+    run(check())
+    # блоки одного пользователя не пересекаются и идут в порядке прихода
+    assert order == [(s, i) for i in range(5) for s in ("in", "out")]
+
+
+def test_other_users_run_in_parallel(run):
+    async def op(uid):
+        async with lane(uid):
+            await asyncio.sleep(0.1)
+
+    async def check():
+        t0 = asyncio.get_running_loop().time()
+        await asyncio.gather(*(op(uid) for uid in range(1, 6)))
+        return asyncio.get_running_loop().time() - t0
+
+    assert run(check()) < 0.3
+
+
+def test_crossing_pairs_do_not_deadlock(run):
+    async def op(a, b):
+        async with lane(a, b):
+            await asyncio.sleep(0)
+
+    async def check():
+        await asyncio.wait_for(asyncio.gather(*(op(1, 2) if i % 2 else op(2, 1) for i in range(50))), 5)
+
+    run(check())
+
+
+def test_nested_lanes(run):
+    async def check():
+        async with lane(1, 2):
+            async with lane(2):  # повторный вход в уже взятый шард
+                pass
+            with pytest.raises(RuntimeError):
+                async with lane(3):
+                    pass
+        async with lane(1, 1 + LANE_SHARDS):  # один шард на двоих
+            pass
+
+    run(check())
@@ -0,0 +1,62 @@
+import asyncio
+
+
+def _delta(loader, before):
+    return {k: loader.stats[k] - before[k] for k in before}
+
+
+def test_point_reads_coalesce(db, run, monkeypatch):
+    async def check():
+        await db.init_db()
+        for uid in (1, 2, 3):
+            await db.grant_perk(uid, "щит")
+        await db.grant_perk(2, "кража")
+        await db.grant_key(3)
+        ld = db._PERKS_LOADER
+        before = dict(ld.stats)
+        res = await asyncio.gather(
+            db.get_perks(1), db.get_perks(2), db.get_perks(3), db.get_perks(1),
+            db.user_has_perk(2, "кража"), db.get_perks(4),
+        )
+        assert res == [{"щит"}, {"щит", "кража"}, {"щит"}, {"щит"}, True, set()]
+        d = _delta(ld, before)
+        assert d["requests"] == 6 and d["queries"] == 1 and d["coalesced"] == 2 and d["keys"] == 4
+
+        # разные загрузчики не мешают друг другу
+        users = dict(db._USERS_LOADER.stats)
+        assert await asyncio.gather(db.has_key(3), db.has_key(1), db.get_role(1)) == [True, False, None]
+        assert _delta(db._USERS_LOADER, users)["queries"] == 1
+
+        # длинный список режется на части по LOADER_MAX_KEYS
+        monkeypatch.setattr(db, "LOADER_MAX_KEYS", 2)
+        before = dict(ld.stats)
+        assert len(await asyncio.gather(*(db.get_perks(u) for u in range(1, 6)))) == 5
+        assert _delta(ld, before)["queries"] == 3
+
+    run(check())
+
+
+def test_request_scope_memo_and_invalidation(db, run):
+    async def check():
+        await db.init_db()
+        await db.grant_perk(1, "щит")
+        ld = db._PERKS_LOADER
+        with db.request_scope():
+            before = dict(ld.stats)
+            assert await db.get_perks(1) == {"щит"}
+            assert await db.user_has_perk(1, "щит")
+            d = _delta(ld, before)
+            assert d["queries"] == 1 and d["memo_hits"] == 1
+
+            # COMMIT сбрасывает запомненное
+            await db.grant_perk(1, "кража")
+            assert await db.get_perks(1) == {"щит", "кража"}
+            assert _delta(ld, before)["queries"] == 2
+
+        # внутри транзакции видно своё незакоммиченное, мимо загрузчика
+        async with db._writer():
+            await db.grant_perk(1, "грабитель")
+            assert "грабитель" in await db.get_perks(1)
+        assert "грабитель" in await db.get_perks(1)
+
+    run(check())
@@ -0,0 +1,118 @@
+import sqlite3
+
+
+# схема и данные версии 1 — то, с чем бот работал до миграций
+BASELINE_V1 = """
+CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, balance INTEGER NOT NULL DEFAULT 0, key INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE roles (user_id INTEGER PRIMARY KEY, role_name TEXT, role_desc TEXT, role_image TEXT);
+CREATE TABLE history (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, action TEXT, amount INTEGER, reason TEXT, date TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+PRAGMA user_version=1;
+INSERT INTO users VALUES (1,'a',70,0),(2,'b',50,1);
+INSERT INTO roles VALUES (2,'страж','охраняет',NULL);
+INSERT INTO history(user_id,action,amount,reason,date) VALUES
+  (1,'change_balance',100,'x','2025-01-01 00:00:00'),
+  (1,'change_balance',-30,'x','2025-01-01 00:00:01'),
+  (2,'change_balance',50,'x','2025-01-01 00:00:02'),
+  (NULL,'config',7,'income','2025-01-01 00:00:03'),
+  (NULL,'config',9,'income','2025-01-01 00:00:04'),
+  (0,'config_str:blacklist_json',0,'{"value": "{\\"ids\\": [5]}"}','2025-01-01 00:00:05'),
+  (1,'perk_grant',NULL,'вор','2025-01-01 00:00:06'),
+  (1,'perk_grant',NULL,'щит','2025-01-01 00:00:07'),
+  (1,'perk_revoke',NULL,'щит','2025-01-01 00:00:08'),
+  (1,'perk_credit_add',1,'code=щит','2025-01-01 00:00:09'),
+  (1,'perk_credit_add',1,'code=щит','2025-01-01 00:00:10'),
+  (1,'perk_credit_use',1,'code=щит','2025-01-01 00:00:11'),
+  (1,'offer_create',10,'perk_code=кража','2025-01-01 00:00:12'),
+  (1,'perk_escrow_open',NULL,'code=кража;offer_id=13','2025-01-01 00:00:13'),
+  (2,'offer_create',5,'link=http://a','2025-01-01 00:00:14'),
+  (1,'cell_dep',97,'gross=100;fee=3','2025-01-01 00:00:15'),
+  (1,'cell_ts',1735689600,NULL,'2025-01-01 00:00:16'),
+  (NULL,'vault_init',9880,'cap=10000','2025-01-01 00:00:17'),
+  (NULL,'burn',5,'b','2025-01-01 00:00:18'),
+  (2,'hero_set',NULL,'chat_id=-100;until=2099-01-01T00:00:00+00:00','2025-01-01 00:00:20'),
+  (1,'codeword_set',10,'chat_id=-100;word=тест;active=1','2025-01-01 00:00:21'),
+  (1,'generosity_add',60,'src=t','2025-01-01 00:00:22'),
+  (1,'generosity_pay_points',50,NULL,'2025-01-01 00:00:23');
+"""
+
+
+def test_migrate_from_baseline(db, run):
+    c = sqlite3.connect(db.DB_PATH)
+    c.executescript(BASELINE_V1)
+    c.commit()
+    c.close()
+
+    async def check():
+        await db.init_db()
+        async with db._reader() as c:
+            async with c.execute("PRAGMA user_version") as cur:
+                assert (await cur.fetchone())[0] == db.SCHEMA_VERSION
+            assert await db._schema_ok(c)
+        assert await db.get_balance(1) == 70
+        assert await db.get_balance(2) == 50
+        assert await db.get_income() == 9
+        assert 5 in await db.get_blacklist()
+        assert await db.get_perks(1) == {"кража"}
+        assert await db.get_perk_credits(1, "щит") == 1
+        assert await db.get_perk_escrow_owner(13) == (1, "кража")
+        assert len(await db.list_active_offers()) == 2
+        # cell_get_balance списал бы хранение с 2025 года — смотрим саму таблицу
+        async with db._reader() as c:
+            async with c.execute("SELECT balance, last_ts FROM cells WHERE user_id=1") as cur:
+                assert tuple(await cur.fetchone()) == (97, 1735689600)
+        assert await db.hero_get_current(-100) == 2
+        assert (await db.codeword_get_active(-100))["word"] == "тест"
+        assert await db.get_generosity_points(1) == 10
+        assert (await db.get_role(2))["role"] == "страж"
+
+        # перенесённая история сходится с таблицами-проекциями
+        r = await db.verify_balance_chains()
+        assert r["breaks_total"] == 0 and r["table_diffs_total"] == 0, r
+        rep = await db.reconcile_projections(fix=False)
+        assert not any(rep[k]["diffs"] for k in ("balances", "perks", "credits", "escrow", "cells", "generosity")), rep
+
+    run(check())
+
+
+def test_migrate_is_idempotent(db, run):
+    async def check():
+        await db.init_db()
+        await db.change_balance(1, 40, "x", 1)
+        await db.close_db()
+        # повторный запуск на той же базе ничего не меняет
+        await db.init_db()
+        assert await db.get_balance(1) == 40
+
+    run(check())
+
+
+def test_migrate_keeps_sequence_after_pruned_tail(db, run):
+    c = sqlite3.connect(db.DB_PATH)
+    c.executescript("""
+        CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, balance INTEGER NOT NULL DEFAULT 0, key INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE roles (user_id INTEGER PRIMARY KEY, role_name TEXT, role_desc TEXT, role_image TEXT);
+        CREATE TABLE history (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, action TEXT, amount INTEGER, reason TEXT, date TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        PRAGMA user_version=1;
+        INSERT INTO users VALUES (1,'a',30,0);
+        INSERT INTO history(user_id,action,amount,reason,date) VALUES
+          (1,'change_balance',10,'x','2025-01-01 00:00:00'),
+          (1,'change_balance',10,'x','2025-01-01 00:00:01'),
+          (1,'change_balance',10,'x','2025-01-01 00:00:02'),
+          (-100,'msg_processed',NULL,'-100:1','2025-01-01 00:00:03'),
+          (-100,'msg_processed',NULL,'-100:2','2025-01-01 00:00:04');
+    """)
+    c.commit()
+    c.close()
+
+    async def check():
+        # миграция удаляет msg_processed — хвост журнала с id 4-5
+        await db.init_db()
+        async with db._reader() as c:
+            async with c.execute("SELECT name, seq FROM sqlite_sequence WHERE name LIKE 'history%'") as cur:
+                assert [tuple(r) for r in await cur.fetchall()] == [("history_log", 5)]
+        await db.change_balance(1, 1, "x", 1)
+        async with db._reader() as c:
+            async with c.execute("SELECT MAX(id) FROM history") as cur:
+                assert (await cur.fetchone())[0] == 6
+
+    run(check())
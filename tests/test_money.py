@@ -0,0 +1,55 @@
+import asyncio
+
+
+def test_debit_never_goes_negative(db, run):
+    async def check():
+        await db.init_db()
+        await db.change_balance(1, 100, "x", 1)
+        assert await db.debit_if_sufficient(1, 101, "d") is None
+        assert await db.get_balance(1) == 100
+        # десять списаний по 30 наперегонки: проходят ровно три
+        res = await asyncio.gather(*(db.debit_if_sufficient(1, 30, "d") for _ in range(10)))
+        assert sorted(r for r in res if r is not None) == [10, 40, 70]
+        assert await db.get_balance(1) == 10
+        assert await db.debit_if_sufficient(1, 10, "d") == 0
+        assert await db.debit_if_sufficient(7, 1, "d") is None
+
+    run(check())
+
+
+def test_transfer_keeps_total(db, run):
+    async def check():
+        await db.init_db()
+        await db.change_balance(1, 100, "x", 1)
+        await db.change_balance(2, 100, "x", 1)
+        assert not await db.transfer(1, 2, 500, "t")
+        assert not await db.transfer(1, 2, 0, "t")
+        await db.add_to_blacklist(3)
+        assert not await db.transfer(1, 3, 10, "t")
+        assert (await db.get_balances([1, 2, 3])) == {1: 100, 2: 100, 3: 0}
+
+        # встречные переводы не теряют и не создают деньги
+        moves = [db.transfer(1, 2, 7, "t") for _ in range(20)] + [db.transfer(2, 1, 9, "t") for _ in range(20)]
+        res = await asyncio.gather(*moves)
+        bal = await db.get_balances([1, 2])
+        assert bal[1] + bal[2] == 200 and min(bal.values()) >= 0
+        sent = 7 * sum(res[:20]) - 9 * sum(res[20:])
+        assert bal == {1: 100 - sent, 2: 100 + sent}
+        assert not await db.economy_cross_check(fix=False)
+
+    run(check())
+
+
+def test_apply_movements_all_or_nothing(db, run):
+    async def check():
+        await db.init_db()
+        await db.change_balance(1, 50, "x", 1)
+        await db.change_balance(2, 10, "x", 1)
+        assert not await db.apply_movements([(1, -20, "a"), (2, -20, "a"), (3, 40, "a")])
+        assert await db.get_balances([1, 2, 3]) == {1: 50, 2: 10, 3: 0}
+        assert await db.apply_movements([(1, -20, "a"), (2, -10, "a"), (3, 25, "a")], burn=5, burn_reason="b")
+        assert await db.get_balances([1, 2, 3]) == {1: 30, 2: 0, 3: 25}
+        r = await db.verify_balance_chains()
+        assert r["breaks_total"] == 0 and r["table_diffs_total"] == 0, r
+
+    run(check())
@@ -0,0 +1,44 @@
+def test_perk_inventory(db, run):
+    async def check():
+        await db.init_db()
+        await db.grant_perk(1, "Кража")
+        await db.grant_perk(1, "щит")
+        await db.grant_perk(2, "щит")
+        await db.revoke_perk(1, "щит")
+        assert await db.get_perks(1) == {"кража"}
+        assert await db.user_has_perk(2, "ЩИТ")
+        assert await db.get_perk_holders("щит") == [2]
+        assert await db.get_perks_summary() == [("кража", 1), ("щит", 1)]
+
+        await db.perk_credit_add(1, "щит")
+        await db.perk_credit_add(1, "щит")
+        assert await db.get_perk_credits(1, "щит") == 2
+        assert await db.perk_credit_use(1, "щит")
+        assert await db.perk_credit_use(1, "щит")
+        # ваучеров больше нет — списание не проходит и не уводит в минус
+        assert not await db.perk_credit_use(1, "щит")
+        assert await db.get_perk_credits(1, "щит") == 0
+        assert await db.get_vouchers_total_for_code("щит") == 0
+
+        await db.perk_escrow_open(1, "кража", 77)
+        assert await db.get_perk_escrowed_total_for_code("кража") == 1
+        assert await db.get_perk_escrow_owner(77) == (1, "кража")
+        await db.perk_escrow_close(1, "кража", 77, "cancel")
+        assert await db.get_perk_escrowed_total_for_code("кража") == 0
+
+        rep = await db.reconcile_projections(fix=False)
+        assert not any(rep[k]["diffs"] for k in ("perks", "credits", "escrow")), rep
+
+    run(check())
+
+
+def test_blacklisted_get_no_perks(db, run):
+    async def check():
+        await db.init_db()
+        await db.add_to_blacklist(5)
+        assert await db.grant_perk(5, "кража") is None
+        await db.perk_credit_add(5, "щит")
+        assert await db.get_perks(5) == set()
+        assert await db.get_perk_credits(5, "щит") == 0
+
+    run(check())
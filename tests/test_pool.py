@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+
+def test_failed_block_rolls_back_alone(db, run):
+    hooks = []
+
+    async def good(uid):
+        async with db._writer():
+            await db.change_balance(uid, 10, "ok", 1)
+            db._after_commit(lambda: hooks.append(uid))
+
+    async def bad():
+        async with db._writer():
+            await db.change_balance(3, 10, "bad", 1)
+            db._after_commit(lambda: hooks.append(3))
+            raise ValueError("boom")
+
+    async def check():
+        await db.init_db()
+        stats = db._POOL.commits
+        batches = stats.batches
+        res = await asyncio.gather(good(1), bad(), good(2), return_exceptions=True)
+        assert res[0] is None and res[2] is None
+        assert isinstance(res[1], ValueError)
+        # все три блока ушли одной транзакцией, откатился только упавший
+        assert stats.batches == batches + 1 and stats.max_blocks >= 2
+        assert sorted(hooks) == [1, 2]
+        assert await db.get_balance(1) == 10
+        assert await db.get_balance(2) == 10
+        assert await db.get_balance(3) == 0
+        r = await db.verify_balance_chains()
+        assert r["breaks_total"] == 0 and r["table_diffs_total"] == 0, r
+
+    run(check())
+
+
+def test_savepoint_drops_its_hooks(db, run):
+    hooks = []
+
+    async def check():
+        await db.init_db()
+        async with db._writer() as c:
+            await db.change_balance(1, 5, "a", 1)
+            db._after_commit(lambda: hooks.append("outer"))
+            with pytest.raises(ValueError):
+                async with db._savepoint(c):
+                    await db.change_balance(1, 7, "b", 1)
+                    db._after_commit(lambda: hooks.append("inner"))
+                    raise ValueError
+        assert hooks == ["outer"]
+        assert await db.get_balance(1) == 5
+
+    run(check())
+
+
+def test_block_timeout(db, run):
+    async def slow():
+        async with db._writer(timeout=0.05):
+            await db.change_balance(1, 10, "slow", 1)
+            await asyncio.sleep(1)
+
+    async def check():
+        await db.init_db()
+        timeouts = db._POOL.commits.timeouts
+        with pytest.raises(asyncio.TimeoutError):
+            await slow()
+        assert db._POOL.commits.timeouts == timeouts + 1
+        assert await db.get_balance(1) == 0
+        # писатель жив и принимает следующие блоки
+        await db.change_balance(2, 3, "after", 1)
+        assert await db.get_balance(2) == 3
+
+    run(check())
+
+
+def test_child_task_of_open_block(db, run):
+    async def check():
+        await db.init_db()
+        async with db._writer():
+            child = asyncio.create_task(db.change_balance(1, 1, "child", 1))
+            with pytest.raises(RuntimeError):
+                await child
+
+    run(check())
+
+
+def test_closed_pool_rejects(db, run):
+    async def check():
+        await db.init_db()
+        pool = db._POOL
+        task = asyncio.create_task(pool.close())
+        await asyncio.sleep(0)
+        with pytest.raises(RuntimeError):
+            async with db._writer():
+                pass
+        with pytest.raises(RuntimeError):
+            async with db._reader():
+                pass
+        await task
+        db._POOL = None  # закрыли в обход close_db
+
+    run(check())
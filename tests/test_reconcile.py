@@ -0,0 +1,84 @@
+SECTIONS = ("balances", "perks", "credits", "escrow", "cells", "generosity")
+
+
+def test_reconcile_fix_restores_tables(db, run):
+    async def check():
+        await db.init_db()
+        await db.change_balance(1, 50, "x", 1)
+        await db.change_balance(2, 20, "x", 1)
+        await db.grant_perk(1, "кража")
+        await db.perk_credit_add(1, "щит")
+        await db.add_generosity_points(2, 4, "t")
+        await db.cell_deposit(1, 20)
+        cell = await db.cell_get_balance(1)
+        assert cell > 0
+
+        # портим таблицы-проекции в обход журнала
+        async with db._writer() as c:
+            await c.execute("UPDATE users SET balance = 999 WHERE user_id = 2")
+            await c.execute("DELETE FROM user_perks WHERE user_id = 1")
+            await c.execute("UPDATE perk_credits SET credits = 5 WHERE user_id = 1")
+            await c.execute("DELETE FROM cells WHERE user_id = 1")
+            await c.execute("UPDATE user_state SET generosity_points = 0 WHERE user_id = 2")
+        db._bal_cache_reset()
+
+        rep = await db.reconcile_projections(fix=True)
+        assert rep["fixed"]
+        for name in ("balances", "perks", "credits", "cells", "generosity"):
+            assert rep[name]["diffs"] >= 1, (name, rep[name])
+
+        rep = await db.reconcile_projections(fix=False)
+        assert not any(rep[k]["diffs"] for k in SECTIONS), rep
+        assert await db.get_balance(2) == 20
+        assert await db.get_perks(1) == {"кража"}
+        assert await db.get_perk_credits(1, "щит") == 1
+        assert await db.get_generosity_points(2) == 4
+        # восстановленная ячейка получает отметку времени, иначе хранение не начислится
+        async with db._reader() as c:
+            async with c.execute("SELECT balance, last_ts FROM cells WHERE user_id = 1") as cur:
+                bal, last_ts = await cur.fetchone()
+        assert bal == cell and last_ts is not None
+        r = await db.verify_balance_chains()
+        assert r["breaks_total"] == 0 and r["table_diffs_total"] == 0, r
+
+        # каждая поправка записана в журнал
+        async with db._reader() as c:
+            async with c.execute(
+                "SELECT action, user_id, amount FROM history WHERE reason = ? ORDER BY id", (db.RECONCILE_REASON,)
+            ) as cur:
+                fixes = {tuple(r) for r in await cur.fetchall()}
+        assert ("balance_adjust", 2, 20 - 999) in fixes
+        assert ("cell_adjust", 1, cell) in fixes
+        assert ("perk_adjust", 1, 1) in fixes
+        assert ("perk_credit_adjust", 1, 1 - 5) in fixes
+        assert ("generosity_adjust", 2, 4) in fixes
+
+    run(check())
+
+
+def test_reconcile_fix_keeps_chains(db, run):
+    async def check():
+        await db.init_db()
+        await db.change_balance(1, 50, "x", 1)
+        assert (await db.verify_balance_chains())["breaks_total"] == 0
+        # таблица разошлась с журналом, и следующая запись продолжила уже её
+        async with db._writer() as c:
+            await c.execute("UPDATE users SET balance = 80 WHERE user_id = 1")
+        db._bal_cache_reset()
+        await db.change_balance(1, 5, "y", 1)
+        assert await db.get_balance(1) == 85
+        r = await db.verify_balance_chains()
+        assert r["breaks_total"] == 1, r  # строка «y» продолжила испорченную таблицу
+
+        rep = await db.reconcile_projections(fix=True)
+        assert rep["balances"]["sample"] == [(1, 85, 55)]
+        assert await db.get_balance(1) == 55
+        await db.change_balance(1, 1, "z", 1)
+        r = await db.verify_balance_chains()
+        assert r["breaks_total"] == 0 and r["table_diffs_total"] == 0, r
+        rep = await db.reconcile_projections(fix=False)
+        assert rep["balances"]["diffs"] == 0, rep["balances"]
+        rows, _ = await db.get_statement(1)
+        assert [(a, n, b) for _id, _d, a, n, _r, b in rows[:2]] == [("change_balance", 1, 56), ("balance_adjust", -30, 55)]
+
+    run(check())
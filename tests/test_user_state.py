@@ -0,0 +1,27 @@
+def test_cooldowns_and_points(db, run):
+    async def check():
+        await db.init_db()
+        assert await db.get_seconds_since_last_salary_claim(1, db.SALARY_STATE_CODE) is None
+        assert await db.get_seconds_since_last_theft(1) is None
+        assert await db.get_seconds_since_last_bank_rob(1) is None
+
+        await db.record_salary_claim(1, 5, db.SALARY_STATE_CODE)
+        await db.record_theft(1, 5, 2, False)
+        await db.record_bank_rob(1, "fail", 0)
+        assert 0 <= await db.get_seconds_since_last_salary_claim(1, db.SALARY_STATE_CODE) <= 2
+        assert await db.get_seconds_since_last_salary_claim(1) is None  # другой код жалования
+        assert 0 <= await db.get_seconds_since_last_theft(1) <= 2
+        assert 0 <= await db.get_seconds_since_last_bank_rob(1) <= 2
+        # у жертвы КД не появляется
+        assert await db.get_seconds_since_last_theft(2) is None
+
+        await db.add_generosity_points(1, 7, "t")
+        await db.add_generosity_points(1, 5, "t")
+        await db.insert_history(1, "generosity_pay_points", 10, None)
+        assert await db.get_generosity_points(1) == 2
+
+        # user_state — проекция журнала: пересборка сходится
+        rep = await db.reconcile_projections(fix=False)
+        assert rep["generosity"]["diffs"] == 0, rep["generosity"]
+
+    run(check())